@@ -0,0 +1,362 @@
+"""Approximate nearest neighbor search (IVF) over dense media vectors, kept in a memory mapped file."""
+
+from array import array
+from collections import defaultdict
+import heapq
+import math
+import mmap
+import os
+from operator import mul
+import random
+import struct
+import threading
+import time
+
+MAGIC = b"MVIVF002"
+# magic, dimensions, number of lists, number of vectors, how many lists a search scans
+HEADER = struct.Struct("<8sIIQI")
+MEDIA_ID = struct.Struct("<i")
+
+MAX_LISTS = 1024
+# k-means is trained on a sample this many times the number of lists
+TRAINING_SAMPLE_PER_LIST = 40
+TRAINING_ITERATIONS = 8
+# a build searches with as few of the nearest lists as still finds this share of the exact
+# nearest neighbors of a sample of the indexed vectors, all of them if it takes that
+TARGET_RECALL = 0.9
+CALIBRATION_QUERIES = 100
+
+
+def dot(a, b):
+    return sum(map(mul, a, b))
+
+def normalize(vector):
+    norm = math.sqrt(dot(vector, vector))
+    return array("f", [value / norm for value in vector]) if norm else array("f", vector)
+
+def nearest_list(centroids, vector):
+    return max(range(len(centroids)), key=lambda list_no: dot(centroids[list_no], vector))
+
+def nearest_lists(centroids, vector, n):
+    return heapq.nlargest(n, range(len(centroids)), key=lambda list_no: dot(centroids[list_no], vector))
+
+def train_centroids(vectors, nlist, iterations=TRAINING_ITERATIONS, seed=0):
+    """Spherical k-means on a sample of the vectors"""
+
+    rng = random.Random(seed)
+    sample = rng.sample(vectors, min(len(vectors), TRAINING_SAMPLE_PER_LIST * nlist))
+    centroids = [array("f", vector) for vector in rng.sample(sample, nlist)]
+    dimensions = len(sample[0])
+
+    for iteration in range(iterations):
+        sums = [[0.0] * dimensions for centroid in centroids]
+        for vector in sample:
+            total = sums[nearest_list(centroids, vector)]
+            for i, value in enumerate(vector):
+                total[i] += value
+        # lists nothing was assigned to keep their old centroid
+        centroids = [normalize(total) if any(total) else centroid for total, centroid in zip(sums, centroids)]
+
+    return centroids
+
+def calibrate_nprobe(centroids, lists, k, queries=CALIBRATION_QUERIES, target_recall=TARGET_RECALL, seed=0):
+    """The fewest nearest lists a search has to scan for recall of at least target_recall,
+    measured against exact search for a sample of the vectors in the lists"""
+
+    everything = [vector for media_list in lists for media_id, vector in media_list]
+    if not everything:
+        return 1
+
+    samples = random.Random(seed).sample(everything, min(queries, len(everything)))
+    # nprobe: summed recall
+    found = [0.0] * (len(centroids) + 1)
+
+    for query in samples:
+        # the best k of each list, which is all a search could take from it
+        top = [heapq.nlargest(k, ((dot(query, vector), media_id) for media_id, vector in media_list)) for media_list in lists]
+        exact = {media_id for score, media_id in heapq.nlargest(k, (item for list_top in top for item in list_top))}
+
+        best = []
+        for nprobe, list_no in enumerate(nearest_lists(centroids, query, len(centroids)), 1):
+            for item in top[list_no]:
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+            found[nprobe] += len(exact & {media_id for score, media_id in best}) / len(exact)
+
+    return next(nprobe for nprobe in range(1, len(centroids) + 1) if found[nprobe] / len(samples) >= target_recall or nprobe == len(centroids))
+
+
+class IvfIndex:
+    """Inverted file index: vectors are grouped by their nearest centroid, and a search
+    only scans the lists of the centroids nearest the query.
+
+    The built index is one read only file that is memory mapped the first time it's used.
+    Vectors added afterwards are appended to a .delta file, so every worker sees them,
+    until the next build folds them in. A build starts with rotate_delta, so vectors added
+    while it runs go to a new .delta file and are kept."""
+
+    def __init__(self, path):
+        self.path = path
+        self.delta_path = path + ".delta"
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.file_version = None
+        self.dimensions = 0
+        self.nprobe = 1
+        self.centroids = []
+        self.offsets = []
+        self.ids = []
+        self.vectors = []
+        self.delta_lists = defaultdict(list)
+        self.delta_inode = None
+        self.delta_offset = 0
+        self.delta_count = 0
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self.ids) + self.delta_count
+
+    def rotate_delta(self):
+        """Moves the .delta file aside before a build collects its vectors, the build deletes it once they're folded in"""
+
+        try:
+            os.replace(self.delta_path, self.delta_path + ".old")
+        except FileNotFoundError:
+            pass
+
+    def build(self, ids, vectors, nlist=None, seed=0, k=10, nprobe=None):
+        """Clusters the vectors and writes a new index file in place of the old one,
+        tuned for searches of the k nearest unless nprobe is given"""
+
+        vectors = [normalize(vector) for vector in vectors]
+        dimensions = len(vectors[0]) if vectors else 0
+        if nlist is None:
+            nlist = max(1, min(MAX_LISTS, int(math.sqrt(len(vectors)))))
+        nlist = min(nlist, len(vectors))
+        centroids = train_centroids(vectors, nlist, seed=seed) if vectors else []
+
+        lists = [[] for centroid in centroids]
+        for media_id, vector in zip(ids, vectors):
+            lists[nearest_list(centroids, vector)].append((media_id, vector))
+
+        offsets = array("q", [0])
+        for media_list in lists:
+            offsets.append(offsets[-1] + len(media_list))
+
+        if nprobe is None:
+            nprobe = calibrate_nprobe(centroids, lists, k, seed=seed)
+
+        # written next to the old file and swapped in, so open maps of the old one stay valid
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as index_file:
+            index_file.write(HEADER.pack(MAGIC, dimensions, len(centroids), len(vectors), nprobe))
+            for centroid in centroids:
+                centroid.tofile(index_file)
+            offsets.tofile(index_file)
+            array("i", [media_id for media_list in lists for media_id, vector in media_list]).tofile(index_file)
+            for media_list in lists:
+                for media_id, vector in media_list:
+                    vector.tofile(index_file)
+        os.replace(temp_path, self.path)
+        # the vectors in it were passed in, the ones added since are in the new .delta
+        try:
+            os.remove(self.delta_path + ".old")
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            self.reset()
+            self.load()
+
+    def load(self):
+        """Maps the index file and reads the delta file, call with the lock held"""
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        with open(self.path, "rb") as index_file:
+            mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = mapped[:len(MAGIC)]
+        if magic[:5] == MAGIC[:5] and magic != MAGIC:
+            # written by an older version, there's no index until the next build
+            self.file_version = (stat.st_ino, stat.st_mtime_ns)
+            return
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a media vector index")
+
+        magic, dimensions, nlist, count, nprobe = HEADER.unpack_from(mapped, 0)
+
+        view = memoryview(mapped)
+        start = HEADER.size
+        sections = {}
+        for name, type_code, length in [("centroids", "f", nlist * dimensions), ("offsets", "q", nlist + 1),
+                                     ("ids", "i", count), ("vectors", "f", count * dimensions)]:
+            end = start + length * struct.calcsize(type_code)
+            sections[name] = view[start:end].cast(type_code)
+            start = end
+
+        self.file_version = (stat.st_ino, stat.st_mtime_ns)
+        self.dimensions = dimensions
+        self.nprobe = nprobe
+        self.centroids = [sections["centroids"][i * dimensions:(i + 1) * dimensions] for i in range(nlist)]
+        self.offsets = sections["offsets"]
+        self.ids = sections["ids"]
+        self.vectors = sections["vectors"]
+        self.read_delta()
+
+    def read_delta(self):
+        """Reads vectors appended since the last read, call with the lock held"""
+
+        if not self.centroids:
+            return
+
+        try:
+            with open(self.delta_path, "rb") as delta_file:
+                delta_inode = os.fstat(delta_file.fileno()).st_ino
+                if delta_inode != self.delta_inode:
+                    # rotated by a build, what was read from the old one is kept until the new index is loaded
+                    self.delta_inode = delta_inode
+                    self.delta_offset = 0
+                delta_file.seek(self.delta_offset)
+                data = delta_file.read()
+        except FileNotFoundError:
+            return
+
+        record_size = MEDIA_ID.size + 4 * self.dimensions
+        # a record another worker is half way through writing is read next time
+        complete = len(data) - len(data) % record_size
+        for start in range(0, complete, record_size):
+            media_id, = MEDIA_ID.unpack_from(data, start)
+            vector = array("f")
+            vector.frombytes(data[start + MEDIA_ID.size:start + record_size])
+            self.delta_lists[nearest_list(self.centroids, vector)].append((media_id, vector))
+            self.delta_count += 1
+        self.delta_offset += complete
+
+    def ensure_loaded(self):
+        """Loads the index the first time it's used, or again when a new one has been built"""
+
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.reset()
+                return
+
+            if (stat.st_ino, stat.st_mtime_ns) != self.file_version:
+                self.reset()
+                self.load()
+            else:
+                self.read_delta()
+
+    def add(self, media_id, vector):
+        """Adds one vector without a rebuild, returns False if there is no index to add to yet"""
+
+        return self.add_many([(media_id, vector)])
+
+    def add_many(self, vectors):
+        """Adds (media_id, vector) pairs without a rebuild, returns False if there is no index to add to yet"""
+
+        self.ensure_loaded()
+        if not self.centroids:
+            return False
+
+        # one write, so other workers never see a record cut in half
+        with open(self.delta_path, "ab") as delta_file:
+            delta_file.write(b"".join(MEDIA_ID.pack(media_id) + normalize(vector).tobytes() for media_id, vector in vectors))
+
+        with self.lock:
+            self.read_delta()
+
+        return True
+
+    def media_ids(self):
+        """Every media_id in the index, built or added since"""
+
+        self.ensure_loaded()
+        with self.lock:
+            return set(self.ids).union(media_id for media_list in self.delta_lists.values() for media_id, vector in media_list)
+
+    def scan(self, vector, list_nos):
+        """Scores every vector in the lists, best score for each media_id"""
+
+        dimensions = self.dimensions
+        scores = {}
+        for list_no in list_nos:
+            for i in range(self.offsets[list_no], self.offsets[list_no + 1]):
+                scores[self.ids[i]] = dot(vector, self.vectors[i * dimensions:(i + 1) * dimensions])
+            for media_id, other in self.delta_lists[list_no]:
+                scores[media_id] = dot(vector, other)
+
+        return scores
+
+    def search(self, vector, k=10, nprobe=None):
+        """The k nearest media by cosine similarity: [(similarity, media_id)], scanning the
+        nprobe nearest lists or as many as the build found it takes"""
+
+        self.ensure_loaded()
+        if not self.centroids:
+            return []
+
+        vector = normalize(vector)
+        # held so a rebuilt index isn't swapped in half way through
+        with self.lock:
+            scores = self.scan(vector, nearest_lists(self.centroids, vector, nprobe or self.nprobe))
+
+        return heapq.nlargest(k, ((score, media_id) for media_id, score in scores.items()))
+
+    def exact_search(self, vector, k=10):
+        """Brute force search over every list, for checking the approximate search"""
+
+        self.ensure_loaded()
+        vector = normalize(vector)
+        with self.lock:
+            scores = self.scan(vector, range(len(self.centroids)))
+
+        return heapq.nlargest(k, ((score, media_id) for media_id, score in scores.items()))
+
+    def sample_vectors(self, n, seed=0):
+        """Some of the indexed vectors, to use as benchmark queries"""
+
+        self.ensure_loaded()
+        dimensions = self.dimensions
+        rng = random.Random(seed)
+
+        return [self.vectors[i * dimensions:(i + 1) * dimensions] for i in rng.sample(range(len(self.ids)), min(n, len(self.ids)))]
+
+
+def benchmark(index, queries, k=10, nprobe=None):
+    """Recall and average latency of the approximate search against exact search"""
+
+    found = 0
+    exact_seconds = 0
+    approximate_seconds = 0
+
+    for query in queries:
+        start = time.perf_counter()
+        exact = {media_id for score, media_id in index.exact_search(query, k)}
+        exact_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        approximate = {media_id for score, media_id in index.search(query, k, nprobe)}
+        approximate_seconds += time.perf_counter() - start
+
+        found += len(exact & approximate) / max(1, len(exact))
+
+    count = max(1, len(queries))
+    return {
+        "queries": len(queries),
+        "k": k,
+        "nprobe": nprobe or index.nprobe,
+        "lists": len(index.centroids),
+        "recall": found / count,
+        "exact_ms": 1000 * exact_seconds / count,
+        "approximate_ms": 1000 * approximate_seconds / count,
+    }
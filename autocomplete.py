@@ -0,0 +1,234 @@
+"""Typeahead for the search bar: title prefixes looked up in a sorted array held in memory by each worker.
+
+    python autocomplete.py "the dar"
+"""
+
+from array import array
+from bisect import bisect_left
+import heapq
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from flask import current_app
+import requests
+from sqlalchemy import select, func, union_all
+
+from model import db, connect_to_db, Media, WatchedList, ToBeWatchedList, Rating
+import tmdb
+from cache import Cache
+
+# each worker rebuilds its index this often, to pick up new media
+INDEX_TTL_SECONDS = 300
+# TMDB's popular titles are fetched this often, by one worker for all of them
+POPULAR_TTL_SECONDS = 3600
+POPULAR_PAGES = 3
+# a popular title on TMDB that nobody here has touched counts about as much as this much local activity
+POPULAR_WEIGHT = 2.0
+# and the title this far down TMDB's list counts half as much
+POPULAR_HALF_RANK = 20
+MAX_RESULTS = 10
+# prefixes this short match too many titles to rank at request time, so their results are ranked when the index is built
+SHORT_PREFIX_LENGTH = 2
+MAX_SUGGESTIONS = 20
+MEDIA_TYPES = ("movie", "tv")
+
+
+def normalize(text):
+    """Lowercase, without accents or punctuation, single spaced"""
+
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def word_starts(title):
+    """Every suffix of the title that starts at a word, so "dark" finds "The Dark Knight" too"""
+
+    words = title.split(" ")
+
+    return [" ".join(words[position:]) for position in range(len(words))]
+
+
+def fetch_popular():
+    """TMDB's popular movies and shows, most popular first: [(media_type, TMDB_id, title, poster_path, rank)]"""
+
+    popular = []
+    for media_type in MEDIA_TYPES:
+        rank = 0
+        for page in range(1, POPULAR_PAGES + 1):
+            res = tmdb.get(f"{media_type}/popular", page=page)
+            res.raise_for_status()
+            for result in res.json().get("results", []):
+                popular.append((media_type, result["id"], result.get("title") or result.get("name"), result.get("poster_path"), rank))
+                rank += 1
+
+    return popular
+
+popular_cache = Cache("autocomplete", ttl=POPULAR_TTL_SECONDS)
+
+
+class TitleIndex:
+    """Titles of media in the db and of TMDB's popular media, by every word start of their normalized title.
+
+    keys is sorted, with entries[i] the title number it came from, so the titles starting with a prefix
+    are one bisect away. Titles are numbered in parallel arrays to keep each entry a single integer."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loader = None
+        self.loaded_at = None
+        self.popular = []
+        self.clear()
+
+    def clear(self):
+        self.keys = []
+        self.entries = array("i")
+        self.media_types = array("b")
+        self.TMDB_ids = array("i")
+        self.scores = array("f")
+        self.titles = []
+        self.poster_paths = []
+        # short prefix: title numbers, best first
+        self.short_prefixes = {}
+
+    def load(self):
+        """Builds the index from every media in the db and TMDB's popular titles"""
+
+        # the last list is used again while TMDB is down
+        try:
+            self.popular = popular_cache.get_or_set("popular", fetch_popular)
+        except (tmdb.TMDBUnavailable, requests.HTTPError):
+            pass
+
+        # how many lists and ratings each media is in
+        activity = union_all(select(WatchedList.media_id), select(ToBeWatchedList.media_id), select(Rating.media_id)).subquery()
+        counts = dict(db.session.execute(select(activity.c.media_id, func.count()).group_by(activity.c.media_id)).all())
+
+        # (media_type, TMDB_id): [score, title, poster_path]
+        titles = {}
+        for media_id, media_type, TMDB_id, title, poster_path in db.session.execute(
+                select(Media.media_id, Media.media_type, Media.TMDB_id, Media.title, Media.poster_path)):
+            titles[(media_type, TMDB_id)] = [counts.get(media_id, 0), title, poster_path]
+
+        for media_type, TMDB_id, title, poster_path, rank in self.popular:
+            # higher up TMDB's list counts more
+            boost = POPULAR_WEIGHT / (1 + rank / POPULAR_HALF_RANK)
+            if (media_type, TMDB_id) in titles:
+                titles[(media_type, TMDB_id)][0] += boost
+            elif title:
+                titles[(media_type, TMDB_id)] = [boost, title, poster_path]
+
+        media_types, TMDB_ids, scores, title_list, poster_paths = array("b"), array("i"), array("f"), [], []
+        keyed = []
+        for (media_type, TMDB_id), (score, title, poster_path) in titles.items():
+            if media_type not in MEDIA_TYPES:
+                continue
+            number = len(title_list)
+            media_types.append(MEDIA_TYPES.index(media_type))
+            TMDB_ids.append(TMDB_id)
+            scores.append(score)
+            title_list.append(title)
+            poster_paths.append(poster_path)
+            for key in word_starts(normalize(title)):
+                if key:
+                    keyed.append((key, number))
+
+        keyed.sort()
+
+        short_prefixes = {}
+        for key, number in keyed:
+            for length in range(1, SHORT_PREFIX_LENGTH + 1):
+                if len(key) >= length:
+                    short_prefixes.setdefault(key[:length], set()).add(number)
+        short_prefixes = {prefix: heapq.nlargest(MAX_SUGGESTIONS, numbers, key=lambda number: scores[number])
+                          for prefix, numbers in short_prefixes.items()}
+
+        # swapped in together, so requests never see half an index
+        with self.lock:
+            self.keys = [key for key, number in keyed]
+            self.entries = array("i", [number for key, number in keyed])
+            self.media_types, self.TMDB_ids, self.scores = media_types, TMDB_ids, scores
+            self.titles, self.poster_paths = title_list, poster_paths
+            self.short_prefixes = short_prefixes
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        """Builds a missing or stale index in a background thread, requests keep using the old one meanwhile
+        (and get no suggestions until the first one is built), call with an app context"""
+
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > INDEX_TTL_SECONDS:
+            if self.load_lock.acquire(blocking=False):
+                self.loader = threading.Thread(target=self.load_in_background, args=(current_app._get_current_object(),),
+                                               name="autocomplete-load", daemon=True)
+                self.loader.start()
+
+    def load_in_background(self, app):
+        try:
+            with app.app_context():
+                if self.loaded_at is None or time.monotonic() - self.loaded_at > INDEX_TTL_SECONDS:
+                    self.load()
+        finally:
+            self.load_lock.release()
+
+    def matches(self, prefix):
+        """Numbers of the titles with a word starting with prefix, best first"""
+
+        if len(prefix) <= SHORT_PREFIX_LENGTH:
+            return self.short_prefixes.get(prefix, [])
+
+        numbers = set()
+        position = bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            numbers.add(self.entries[position])
+            position += 1
+
+        return heapq.nlargest(MAX_SUGGESTIONS, numbers, key=lambda number: self.scores[number])
+
+    def suggest(self, text, media_type=None, limit=MAX_RESULTS):
+        """Titles starting with the text, or with a word that does, most popular first:
+        [{"id", "media_type", "title", "poster_path"}]"""
+
+        prefix = normalize(text)
+        if not prefix:
+            return []
+
+        with self.lock:
+            suggestions = []
+            for number in self.matches(prefix):
+                number_media_type = MEDIA_TYPES[self.media_types[number]]
+                if media_type and number_media_type != media_type:
+                    continue
+                suggestions.append({"id": self.TMDB_ids[number], "media_type": number_media_type,
+                                    "title": self.titles[number], "poster_path": self.poster_paths[number]})
+                if len(suggestions) == limit:
+                    break
+
+        return suggestions
+
+
+title_index = TitleIndex()
+
+def suggest(text, media_type=None, limit=MAX_RESULTS):
+    title_index.ensure_loaded()
+
+    return title_index.suggest(text, media_type, limit)
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        started = time.perf_counter()
+        title_index.load()
+        print(f"Indexed {len(title_index.titles)} titles under {len(title_index.keys)} keys in {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        suggestions = title_index.suggest(" ".join(sys.argv[1:]))
+        print(f"Looked up in {(time.perf_counter() - started) * 1e6:.0f}us")
+        for suggestion in suggestions:
+            print(f"{suggestion['media_type']:6} {suggestion['id']:8} {suggestion['title']}")
@@ -0,0 +1,221 @@
+"""Cache shared by every worker: Redis when CACHE_URL is set, otherwise an in-memory LRU per process.
+
+    export CACHE_URL="redis://localhost:6379/0"
+"""
+
+from collections import OrderedDict
+import os
+import pickle
+import threading
+import time
+
+CACHE_PREFIX = os.environ.get("CACHE_PREFIX", "myviews")
+DEFAULT_TTL_SECONDS = 600
+LOCAL_MAX_ENTRIES = 10000
+REDIS_TIMEOUT_SECONDS = 0.5
+
+# while one request computes a missing value, others wait this long for it instead of all computing it at once
+LOCK_SECONDS = 30
+LOCK_WAIT_SECONDS = 5
+LOCK_POLL_SECONDS = 0.05
+
+MISSING = object()
+
+
+class LocalBackend:
+    """LRU of pickled values with expiry times, for one process and for tests"""
+
+    # what one process caches here, no other process sees
+    shared = False
+
+    def __init__(self, max_entries=LOCAL_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # namespace versions are kept apart so the LRU can't drop them
+        self.counters = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Sets the key only if it isn't set already, returns whether it was"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or time.monotonic() < entry[0]):
+                return False
+            self.entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters.clear()
+
+
+class RedisBackend:
+    """Any server speaking the Redis protocol, shared by every worker and node.
+    If it can't be reached the cache misses instead of failing the request."""
+
+    shared = True
+
+    def __init__(self, url):
+        # only needed when CACHE_URL is set
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT_SECONDS, socket_connect_timeout=REDIS_TIMEOUT_SECONDS)
+        self.errors = redis.RedisError
+
+    def get(self, key):
+        try:
+            return self.client.get(key)
+        except self.errors:
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(key, value, ex=ttl or None)
+        except self.errors:
+            pass
+
+    def add(self, key, value, ttl=None):
+        try:
+            return bool(self.client.set(key, value, ex=ttl or None, nx=True))
+        except self.errors:
+            # no lock to be had, so compute it
+            return True
+
+    def delete(self, key):
+        try:
+            self.client.delete(key)
+        except self.errors:
+            pass
+
+    def get_counter(self, key):
+        try:
+            return int(self.client.get(key) or 0)
+        except self.errors:
+            return 0
+
+    def incr(self, key):
+        try:
+            return self.client.incr(key)
+        except self.errors:
+            return 0
+
+    def clear(self):
+        try:
+            for key in self.client.scan_iter(f"{CACHE_PREFIX}:*"):
+                self.client.delete(key)
+        except self.errors:
+            pass
+
+
+backend = None
+backend_lock = threading.Lock()
+
+def get_backend():
+    """The backend CACHE_URL points to, made the first time it's needed"""
+
+    global backend
+
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                url = os.environ.get("CACHE_URL")
+                backend = RedisBackend(url) if url else LocalBackend()
+
+    return backend
+
+
+class Cache:
+    """One namespace of the cache, with its own ttl.
+
+    Keys can have a version (like a users data_version), so bumping it makes the
+    old values unreachable, and clear() does the same for the whole namespace."""
+
+    def __init__(self, namespace, ttl=DEFAULT_TTL_SECONDS):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def make_key(self, key, version=None):
+        namespace_version = get_backend().get_counter(f"{CACHE_PREFIX}:{self.namespace}:version")
+        full_key = f"{CACHE_PREFIX}:{self.namespace}:{namespace_version}:{key}"
+
+        return full_key if version is None else f"{full_key}:v{version}"
+
+    def load(self, full_key):
+        value = get_backend().get(full_key)
+        return MISSING if value is None else pickle.loads(value)
+
+    def get(self, key, version=None, default=None):
+        value = self.load(self.make_key(key, version))
+        return default if value is MISSING else value
+
+    def set(self, key, value, version=None, ttl=None):
+        get_backend().set(self.make_key(key, version), pickle.dumps(value), ttl or self.ttl)
+
+    def get_or_set(self, key, compute, version=None, ttl=None):
+        """Gets the value, or computes and caches it, with only one worker computing a missing key at a time"""
+
+        full_key = self.make_key(key, version)
+        value = self.load(full_key)
+        if value is not MISSING:
+            return value
+
+        lock_key = f"{full_key}:lock"
+        if get_backend().add(lock_key, b"1", LOCK_SECONDS):
+            try:
+                value = compute()
+                get_backend().set(full_key, pickle.dumps(value), ttl or self.ttl)
+            finally:
+                get_backend().delete(lock_key)
+            return value
+
+        # another request is computing it
+        deadline = time.monotonic() + LOCK_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_SECONDS)
+            value = self.load(full_key)
+            if value is not MISSING:
+                return value
+
+        return compute()
+
+    def invalidate(self, key, version=None):
+        get_backend().delete(self.make_key(key, version))
+
+    def clear(self):
+        """Invalidates every key in the namespace, the old values are left to expire"""
+
+        get_backend().incr(f"{CACHE_PREFIX}:{self.namespace}:version")
@@ -1,6 +1,12 @@
 """CRUD operations."""
 
-from model import db, User, Media, Rating, Playlist, PlaylistMedia, WatchedList, ToBeWatchedList, Genre, MediaGenre, connect_to_db
+from model import db, User, Media, Rating, Playlist, PlaylistMedia, WatchedList, ToBeWatchedList, Genre, MediaGenre, connect_to_db, friend, media_search_vector, FriendSuggestions, Activity, TimelineEntry, UserRecommendation, TrendBucket
+from sqlalchemy import func, or_, and_, case, select, update, distinct, exists, literal, tuple_
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import postgresql, sqlite
+import time
+from sqlalchemy.orm import joinedload
+from cache import Cache
 
 
 def create_user(username, email, password):
@@ -34,12 +40,18 @@ def get_media_by_TMDB_id(TMDB_id, media_type):
     return Media.query.filter(Media.TMDB_id == TMDB_id, Media.media_type == media_type).first()
 
 
+# TMDB titles can be longer than the title column
+MAX_TITLE_LENGTH = Media.__table__.c.title.type.length
+
+def fit_title(title):
+    return title[:MAX_TITLE_LENGTH] if title else title
+
 def add_movie_to_db(movie_info):
     """Adds movie to DB"""
 
     TMDB_id = movie_info["id"]
     media_type = "movie"
-    title = movie_info["original_title"]
+    title = fit_title(movie_info["original_title"])
     overview = movie_info["overview"]
     # added for dateTime errors for one's without release date 
     if movie_info["release_date"]:
@@ -48,14 +60,15 @@ def add_movie_to_db(movie_info):
         release_date = None
     poster_path = movie_info["poster_path"]
 
-    return Media(TMDB_id=TMDB_id, media_type=media_type, title=title, overview=overview, release_date=release_date, poster_path=poster_path)
+    return Media(TMDB_id=TMDB_id, media_type=media_type, title=title, overview=overview, release_date=release_date, poster_path=poster_path,
+                 tmdb_snapshot=movie_info, tmdb_fetched_at=datetime.now())
 
 def add_show_to_db(show_info):
     """Adds show to DB"""
 
     TMDB_id = show_info["id"]
     media_type = "tv"
-    title = show_info["name"]
+    title = fit_title(show_info["name"])
     overview = show_info["overview"]
     # added for dateTime errors for one's without release date 
     if show_info["first_air_date"]:
@@ -63,8 +76,25 @@ def add_show_to_db(show_info):
     else:
         release_date = None
     poster_path = show_info["poster_path"]
-    return Media(TMDB_id=TMDB_id, media_type=media_type, title=title, overview=overview, release_date=release_date, poster_path=poster_path )
+    return Media(TMDB_id=TMDB_id, media_type=media_type, title=title, overview=overview, release_date=release_date, poster_path=poster_path,
+                 tmdb_snapshot=show_info, tmdb_fetched_at=datetime.now())
+
+# TMDB details older than this are fetched again in the background
+SNAPSHOT_MAX_AGE = timedelta(days=1)
+
+def snapshot_is_stale(media):
+    """Whether the medias saved TMDB details are old enough to fetch again"""
+
+    return media.tmdb_fetched_at is None or datetime.now() - media.tmdb_fetched_at > SNAPSHOT_MAX_AGE
+
+def update_tmdb_snapshot(media, data):
+    """Saves newly fetched TMDB details on the media, along with the fields it keeps in their own columns"""
 
+    media.tmdb_snapshot = data
+    media.tmdb_fetched_at = datetime.now()
+    media.title = fit_title(data.get("original_title" if media.media_type == "movie" else "name")) or media.title
+    media.overview = data.get("overview")
+    media.poster_path = data.get("poster_path")
 
 def check_if_genre_in_db(genre):
     """Checks if the genre mentioned is in DB"""
@@ -86,6 +116,36 @@ def add_rating_to_db(score, user_id, media_id, comment=None):
     return rating
 
 
+def bump_data_version(user):
+    """Marks the users lists, ratings or playlists as changed, so clients fetch their data again"""
+
+    # done in sql so two requests at once can't both set the same version
+    user.data_version = User.data_version + 1
+    user.data_modified_at = datetime.utcnow()
+
+def bump_watchers_data_version(media_ids):
+    """Marks the data of everyone with one of the media in their watched list as changed, for changes to the media itself"""
+
+    watchers = select(WatchedList.user_id).where(WatchedList.media_id.in_(media_ids))
+    db.session.execute(update(User).where(User.user_id.in_(watchers))
+                       .values(data_version=User.data_version + 1, data_modified_at=datetime.utcnow())
+                       .execution_options(synchronize_session=False))
+
+def set_time_watched(media_ids, time_watched):
+    """Sets when the media were watched, returns the media_ids it changed for"""
+
+    time_watched = datetime.combine(time_watched, datetime.min.time())
+    changed = db.session.execute(select(Media.media_id).where(
+        Media.media_id.in_(media_ids), or_(Media.time_watched == None, Media.time_watched != time_watched))).scalars().all()
+
+    if changed:
+        db.session.execute(update(Media).where(Media.media_id.in_(changed)).values(time_watched=time_watched)
+                           .execution_options(synchronize_session="fetch"))
+        # time_watched is shared by everyone who watched the media, and is in their watch history
+        bump_watchers_data_version(changed)
+
+    return changed
+
 def user_rated(media, user):
     """Checks if user has rated this media previously"""
 
@@ -243,4 +303,593 @@ def get_last_show_added_to_watched_list(user):
     if shows_in_watched_list:
         return shows_in_watched_list.pop()
    
-    return False
\ No newline at end of file
+    return False
+
+def get_user_recommendations(user, media_type, limit=20):
+    """Gets the users precomputed recommendations of one media type, best first"""
+
+    # the rows are only refreshed now and then, so skip anything watched since
+    watched = (db.session.query(WatchedList.item_id)
+        .join(Media, Media.media_id == WatchedList.media_id)
+        .filter(WatchedList.user_id == user.user_id, Media.TMDB_id == UserRecommendation.TMDB_id,
+                Media.media_type == UserRecommendation.media_type)
+        .exists())
+
+    return (UserRecommendation.query
+        .filter(UserRecommendation.user_id == user.user_id, UserRecommendation.media_type == media_type, ~watched)
+        .order_by(UserRecommendation.score.desc())
+        .limit(limit).all())
+
+################################## BULK LIST CHANGES ##################################
+
+LIST_MODELS = {"watched": WatchedList, "to_be_watched": ToBeWatchedList}
+
+def get_existing_media_ids(media_ids):
+    """Returns which of the media_ids exist in the db"""
+
+    rows = db.session.query(Media.media_id).filter(Media.media_id.in_(media_ids))
+
+    return {media_id for media_id, in rows}
+
+def get_media_ids_in_list(list_model, media_ids, user):
+    """Returns which of the media_ids are already in the users watched or to be watched list"""
+
+    rows = db.session.query(list_model.media_id).filter(list_model.user_id == user.user_id, list_model.media_id.in_(media_ids))
+
+    return {media_id for media_id, in rows}
+
+def get_media_ids_in_playlist(playlist, media_ids):
+    """Returns which of the media_ids are already in the playlist"""
+
+    rows = db.session.query(PlaylistMedia.media_id).filter(PlaylistMedia.playlist_id == playlist.playlist_id, PlaylistMedia.media_id.in_(media_ids))
+
+    return {media_id for media_id, in rows}
+
+def get_user_playlists_with_media(media, user):
+    """Gets the users playlists that media is in"""
+
+    return (Playlist.query.join(PlaylistMedia, PlaylistMedia.playlist_id == Playlist.playlist_id)
+            .filter(Playlist.user_id == user.user_id, PlaylistMedia.media_id == media.media_id)
+            .order_by(Playlist.playlist_id).all())
+
+def bulk_sort_into_folder(media_ids, user, folder, time_watched):
+    """Moves many media into the watched or to be watched list at once, returns the result for each media"""
+
+    target_list = LIST_MODELS[folder]
+    other_list = LIST_MODELS["to_be_watched" if folder == "watched" else "watched"]
+
+    existing = get_existing_media_ids(media_ids)
+    in_target = get_media_ids_in_list(target_list, existing, user)
+    in_other = get_media_ids_in_list(other_list, existing, user)
+    to_add = [media_id for media_id in media_ids if media_id in existing and media_id not in in_target]
+
+    if in_other:
+        db.session.execute(other_list.__table__.delete().where(other_list.user_id == user.user_id, other_list.media_id.in_(in_other)))
+
+    if to_add:
+        db.session.execute(target_list.__table__.insert(), [{"user_id": user.user_id, "media_id": media_id} for media_id in to_add])
+        set_time_watched(to_add, time_watched)
+
+    results = []
+
+    for media_id in media_ids:
+        if media_id not in existing:
+            status = "not_found"
+        elif media_id in in_target:
+            status = "already_in_list"
+        elif media_id in in_other:
+            status = "moved"
+        else:
+            status = "added"
+        results.append({"media_id": media_id, "status": status})
+
+    return results
+
+def bulk_delete_from_list(media_ids, user, folder):
+    """Removes many media from the watched or to be watched list at once, returns the result for each media"""
+
+    list_model = LIST_MODELS[folder]
+    in_list = get_media_ids_in_list(list_model, media_ids, user)
+
+    if in_list:
+        db.session.execute(list_model.__table__.delete().where(list_model.user_id == user.user_id, list_model.media_id.in_(in_list)))
+
+    return [{"media_id": media_id, "status": "removed" if media_id in in_list else "not_in_list"} for media_id in media_ids]
+
+def bulk_add_to_playlist(media_ids, playlist):
+    """Adds many media to a playlist at once, returns the result for each media"""
+
+    existing = get_existing_media_ids(media_ids)
+    in_playlist = get_media_ids_in_playlist(playlist, existing)
+    to_add = [media_id for media_id in media_ids if media_id in existing and media_id not in in_playlist]
+
+    if to_add:
+        db.session.execute(PlaylistMedia.__table__.insert(), [{"playlist_id": playlist.playlist_id, "media_id": media_id} for media_id in to_add])
+
+    results = []
+
+    for media_id in media_ids:
+        if media_id not in existing:
+            status = "not_found"
+        elif media_id in in_playlist:
+            status = "already_in_playlist"
+        else:
+            status = "added"
+        results.append({"media_id": media_id, "status": status})
+
+    return results
+
+def bulk_delete_from_playlist(media_ids, playlist):
+    """Removes many media from a playlist at once, returns the result for each media"""
+
+    in_playlist = get_media_ids_in_playlist(playlist, media_ids)
+
+    if in_playlist:
+        db.session.execute(PlaylistMedia.__table__.delete().where(PlaylistMedia.playlist_id == playlist.playlist_id, PlaylistMedia.media_id.in_(in_playlist)))
+
+    return [{"media_id": media_id, "status": "removed" if media_id in in_playlist else "not_in_playlist"} for media_id in media_ids]
+
+
+################################## PAGING ##################################
+
+PAGE_SIZE = 24
+
+def get_page(rows, limit):
+    """Splits (key, item) rows into a page of items and the key the next page starts after"""
+
+    if len(rows) > limit:
+        next_after = rows[limit - 1][0]
+    else:
+        next_after = None
+
+    return [item for key, item in rows[:limit]], next_after
+
+def get_list_page(list_model, user, after=None, limit=PAGE_SIZE):
+    """Gets a page of the users watched or to be watched list in the order it was added"""
+
+    query = db.session.query(list_model.item_id, Media).join(Media, Media.media_id == list_model.media_id).filter(list_model.user_id == user.user_id)
+
+    if after:
+        query = query.filter(list_model.item_id > after)
+
+    return get_page(query.order_by(list_model.item_id).limit(limit + 1).all(), limit)
+
+def get_playlist_page(playlist, after=None, limit=PAGE_SIZE):
+    """Gets a page of a playlists media in the order it was added"""
+
+    query = db.session.query(PlaylistMedia.playlist_media_id, Media).join(Media, Media.media_id == PlaylistMedia.media_id).filter(PlaylistMedia.playlist_id == playlist.playlist_id)
+
+    if after:
+        query = query.filter(PlaylistMedia.playlist_media_id > after)
+
+    return get_page(query.order_by(PlaylistMedia.playlist_media_id).limit(limit + 1).all(), limit)
+
+def get_friend_ratings_page(media_id, user, after=None, limit=PAGE_SIZE):
+    """Gets a page of the ratings for a media by people the user follows"""
+
+    # exists rather than a join, so a follow saved twice doesn't show the rating twice
+    follows = exists().where(and_(friend.c.f1_id == user.user_id, friend.c.f2_id == Rating.user_id))
+    query = (db.session.query(Rating.rating_id, Rating)
+        .filter(Rating.media_id == media_id, follows)
+        .options(joinedload(Rating.user)))
+
+    if after:
+        query = query.filter(Rating.rating_id > after)
+
+    return get_page(query.order_by(Rating.rating_id).limit(limit + 1).all(), limit)
+
+def get_user_ratings_for_medias(user, medias):
+    """Gets the users ratings for a page of media in one query, keyed by media_id"""
+
+    media_ids = [media.media_id for media in medias]
+
+    if not media_ids:
+        return {}
+
+    ratings = Rating.query.filter(Rating.user_id == user.user_id, Rating.media_id.in_(media_ids)).all()
+
+    return {rating.media_id: rating for rating in ratings}
+
+
+################################## SEARCH GRID STATE ##################################
+
+# most results a search grid asks about at once
+MAX_STATE_ITEMS = 100
+
+def get_user_states(user, pairs):
+    """The users lists, score and playlists for many media at once, keyed by (media_type, TMDB_id).
+    One query per kind of state however many media there are, media not in the db are left out."""
+
+    pairs = set(pairs)
+    if not pairs:
+        return {}
+
+    keys = {media_id: (media_type, TMDB_id) for media_id, media_type, TMDB_id in
+            db.session.execute(select(Media.media_id, Media.media_type, Media.TMDB_id)
+                               .where(tuple_(Media.media_type, Media.TMDB_id).in_(pairs)))}
+    if not keys:
+        return {}
+
+    media_ids = list(keys)
+    watched = get_media_ids_in_list(WatchedList, media_ids, user)
+    to_be_watched = get_media_ids_in_list(ToBeWatchedList, media_ids, user)
+    scores = dict(db.session.execute(select(Rating.media_id, Rating.score)
+                                     .where(Rating.user_id == user.user_id, Rating.media_id.in_(media_ids))).all())
+
+    playlists = {}
+    rows = db.session.execute(select(PlaylistMedia.media_id, Playlist.playlist_id, Playlist.name)
+                              .join(Playlist, Playlist.playlist_id == PlaylistMedia.playlist_id)
+                              .where(Playlist.user_id == user.user_id, PlaylistMedia.media_id.in_(media_ids))
+                              .order_by(Playlist.playlist_id))
+    for media_id, playlist_id, name in rows:
+        playlists.setdefault(media_id, []).append({"playlist_id": playlist_id, "name": name})
+
+    return {key: {"watched": media_id in watched, "to_be_watched": media_id in to_be_watched,
+                  "score": scores.get(media_id), "playlists": playlists.get(media_id, [])}
+            for media_id, key in keys.items()}
+
+
+################################## LOCAL SEARCH ##################################
+
+def search_local_media(search_text, media_type, limit=20):
+    """Searches the media already saved in the db by title and overview, best matches first, of every media type if media_type is None"""
+
+    query = Media.query
+    if media_type:
+        query = query.filter(Media.media_type == media_type)
+
+    if db.engine.dialect.name == "postgresql":
+        ts_query = func.websearch_to_tsquery("english", search_text)
+        query = (query
+            .filter(or_(media_search_vector.op("@@")(ts_query), Media.title.op("%")(search_text)))
+            .order_by(func.ts_rank(media_search_vector, ts_query).desc(), func.similarity(Media.title, search_text).desc()))
+
+    else:
+        # sqlite (for tests and quick local runs) has neither, so just match the title
+        query = query.filter(Media.title.ilike(f"%{search_text}%")).order_by(Media.title)
+
+    return query.limit(limit).all()
+
+
+################################## FRIEND SEARCH ##################################
+
+def escape_like(text):
+    """Escapes the LIKE wildcards in text the user typed"""
+
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_usernames(search_text, user, limit=10, offset=0):
+    """Searches usernames by prefix, partial and fuzzy match, best matches first, returns a page of users and the next offset"""
+
+    search_text = search_text.lower()
+    lower_username = func.lower(User.username)
+    starts_with = lower_username.like(f"{escape_like(search_text)}%", escape="\\")
+
+    query = User.query.filter(User.user_id != user.user_id)
+
+    # trigrams need at least 3 letters, shorter searches only use the prefix index
+    if len(search_text) < 3:
+        query = query.filter(starts_with)
+    elif db.engine.dialect.name == "postgresql":
+        query = query.filter(or_(User.username.ilike(f"%{escape_like(search_text)}%", escape="\\"), User.username.op("%")(search_text)))
+    else:
+        query = query.filter(User.username.ilike(f"%{escape_like(search_text)}%", escape="\\"))
+
+    # exact match first, then usernames that start with it, then closest matches
+    rank = case((lower_username == search_text, 0), (starts_with, 1), else_=2)
+    if db.engine.dialect.name == "postgresql":
+        query = query.order_by(rank, func.similarity(User.username, search_text).desc(), User.username)
+    else:
+        query = query.order_by(rank, User.username)
+
+    users = query.offset(offset).limit(limit + 1).all()
+
+    if len(users) > limit:
+        return users[:limit], offset + limit
+
+    return users, None
+
+
+################################## FOLLOWING ##################################
+
+def lock_follows(user):
+    """Locks the users row until commit, so two follow or unfollow requests from the user can't interleave"""
+
+    # sqlite only has one writer at a time anyway
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(select(User.user_id).where(User.user_id == user.user_id).with_for_update())
+
+def is_following(user, followed):
+    """Checks the friends table itself, for writes that can't trust a cached answer"""
+
+    return db.session.execute(select(exists().where(and_(friend.c.f1_id == user.user_id, friend.c.f2_id == followed.user_id)))).scalar()
+
+def follow_user(user, followed):
+    """Makes user follow followed unless they already do, returns whether they didn't before"""
+
+    lock_follows(user)
+    if is_following(user, followed):
+        return False
+
+    db.session.execute(friend.insert().values(f1_id=user.user_id, f2_id=followed.user_id))
+    invalidate_friend_suggestions_for_follow(user)
+    backfill_timeline(user, followed)
+
+    return True
+
+def unfollow_user(user, followed):
+    """Stops user following followed, returns whether they did before"""
+
+    lock_follows(user)
+    # every row, in case the follow was saved more than once
+    deleted = db.session.execute(friend.delete().where(friend.c.f1_id == user.user_id, friend.c.f2_id == followed.user_id)).rowcount
+    if not deleted:
+        return False
+
+    invalidate_friend_suggestions_for_follow(user)
+    remove_from_timeline(user, followed)
+
+    return True
+
+
+################################## PEOPLE YOU MAY KNOW ##################################
+
+# how much one shared watched media counts compared to one mutual follow
+TASTE_WEIGHT = 0.5
+# how many friends of friends are looked at, so users following very popular users stay cheap
+MAX_SUGGESTION_CANDIDATES = 200
+# shared watched media change with every rating and list change, so stored suggestions are recomputed after this long
+SUGGESTIONS_MAX_AGE = timedelta(hours=6)
+
+def compute_friend_suggestions(user, limit=20):
+    """Finds the people the users follows follow, ranked by mutual follows and shared watched media"""
+
+    mine = friend.alias("mine")
+    theirs = friend.alias("theirs")
+    already_following = friend.alias("already_following")
+
+    mutual_count = func.count(distinct(theirs.c.f1_id)).label("mutual_count")
+    candidates = db.session.execute(
+        select(theirs.c.f2_id, mutual_count)
+        .select_from(mine.join(theirs, theirs.c.f1_id == mine.c.f2_id))
+        .where(mine.c.f1_id == user.user_id,
+               theirs.c.f2_id != user.user_id,
+               ~exists().where(and_(already_following.c.f1_id == user.user_id, already_following.c.f2_id == theirs.c.f2_id)))
+        .group_by(theirs.c.f2_id)
+        .order_by(mutual_count.desc())
+        .limit(MAX_SUGGESTION_CANDIDATES)
+    ).all()
+
+    if not candidates:
+        return []
+
+    mutual_counts = dict(candidates)
+
+    # taste overlap: how many of the users watched media each candidate has watched too
+    my_watched = WatchedList.__table__.alias("my_watched")
+    their_watched = WatchedList.__table__.alias("their_watched")
+    shared_watched = dict(db.session.execute(
+        select(their_watched.c.user_id, func.count())
+        .select_from(my_watched.join(their_watched, their_watched.c.media_id == my_watched.c.media_id))
+        .where(my_watched.c.user_id == user.user_id, their_watched.c.user_id.in_(mutual_counts))
+        .group_by(their_watched.c.user_id)
+    ).all())
+
+    usernames = dict(db.session.execute(select(User.user_id, User.username).where(User.user_id.in_(mutual_counts))).all())
+
+    suggestions = []
+    for user_id, mutual in mutual_counts.items():
+        shared = shared_watched.get(user_id, 0)
+        suggestions.append({
+            "user_id": user_id,
+            "username": usernames[user_id],
+            "mutual_count": mutual,
+            "shared_watched": shared,
+            "score": mutual + TASTE_WEIGHT * shared,
+        })
+
+    suggestions.sort(key=lambda suggestion: (-suggestion["score"], suggestion["username"]))
+
+    return suggestions[:limit]
+
+def get_friend_suggestions(user):
+    """Gets the users cached people you may know, computing them if they aren't cached or are too old"""
+
+    cached = FriendSuggestions.query.get(user.user_id)
+
+    if cached and cached.refreshed_at > datetime.now() - SUGGESTIONS_MAX_AGE:
+        return cached.suggestions
+
+    suggestions = compute_friend_suggestions(user)
+    db.session.merge(FriendSuggestions(user_id=user.user_id, suggestions=suggestions, refreshed_at=datetime.now()))
+
+    return suggestions
+
+def invalidate_friend_suggestions_for_follow(user):
+    """Clears the cached suggestions that change when user follows or unfollows someone:
+    the users own, and those of everyone following the user"""
+
+    followers = select(friend.c.f1_id).where(friend.c.f2_id == user.user_id)
+
+    db.session.execute(FriendSuggestions.__table__.delete().where(or_(FriendSuggestions.user_id == user.user_id, FriendSuggestions.user_id.in_(followers))))
+
+
+################################## FRIENDS ACTIVITY ##################################
+
+# users with more followers than this don't get their activity copied into every
+# follower's timeline, their followers pull it in when they read their feed instead
+FANOUT_MAX_FOLLOWERS = 5000
+# how much of someone's recent activity shows up in your feed when you follow them
+TIMELINE_BACKFILL = 20
+
+def get_follower_count(user):
+    """Counts the users followers"""
+
+    return db.session.query(func.count(distinct(friend.c.f1_id))).filter(friend.c.f2_id == user.user_id).scalar()
+
+def add_activities(user, verb, media_ids, score=None, playlist=None):
+    """Records what the user did to each media, counts it towards trending and fans it out to their followers timelines"""
+
+    if not media_ids:
+        return []
+
+    fanned_out = get_follower_count(user) <= FANOUT_MAX_FOLLOWERS
+    now = datetime.now()
+    activities = [Activity(user_id=user.user_id, verb=verb, media_id=media_id, score=score,
+                           playlist_name=playlist.name if playlist else None, fanned_out=fanned_out, created_at=now)
+                  for media_id in media_ids]
+    db.session.add_all(activities)
+    db.session.flush()
+    add_trend_events(verb, media_ids)
+
+    if fanned_out:
+        # one insert for every follower and activity
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ["user_id", "activity_id"],
+            select(friend.c.f1_id, Activity.activity_id).distinct()
+            .select_from(friend.join(Activity, Activity.user_id == friend.c.f2_id))
+            .where(Activity.activity_id.in_([activity.activity_id for activity in activities]))))
+
+    return activities
+
+def backfill_timeline(user, followed):
+    """Adds the recent activity of someone the user just followed to the users timeline"""
+
+    already_there = exists().where(and_(TimelineEntry.user_id == user.user_id, TimelineEntry.activity_id == Activity.activity_id))
+    recent = (select(literal(user.user_id), Activity.activity_id)
+        .where(Activity.user_id == followed.user_id, Activity.fanned_out == True, ~already_there)
+        .order_by(Activity.activity_id.desc())
+        .limit(TIMELINE_BACKFILL))
+
+    db.session.execute(TimelineEntry.__table__.insert().from_select(["user_id", "activity_id"], recent))
+
+def remove_from_timeline(user, unfollowed):
+    """Takes the activity of someone the user unfollowed out of the users timeline"""
+
+    theirs = select(Activity.activity_id).where(Activity.user_id == unfollowed.user_id)
+
+    db.session.execute(TimelineEntry.__table__.delete().where(TimelineEntry.user_id == user.user_id, TimelineEntry.activity_id.in_(theirs)))
+
+def get_feed_page(user, after=None, limit=PAGE_SIZE):
+    """Gets a page of the friends activity feed, newest first"""
+
+    # fanned out activity from the users own timeline
+    pushed = db.session.query(TimelineEntry.activity_id).filter(TimelineEntry.user_id == user.user_id)
+    # activity of followed users with too many followers to fan out
+    pulled = (db.session.query(Activity.activity_id)
+        .join(friend, friend.c.f2_id == Activity.user_id)
+        .filter(friend.c.f1_id == user.user_id, Activity.fanned_out == False))
+
+    if after:
+        pushed = pushed.filter(TimelineEntry.activity_id < after)
+        pulled = pulled.filter(Activity.activity_id < after)
+
+    # each side reads at most a page, then the newest of both make up this page
+    activity_ids = {activity_id for activity_id, in pushed.order_by(TimelineEntry.activity_id.desc()).limit(limit + 1)}
+    activity_ids.update(activity_id for activity_id, in pulled.order_by(Activity.activity_id.desc()).limit(limit + 1))
+    activity_ids = sorted(activity_ids, reverse=True)[:limit + 1]
+
+    activities = (Activity.query.filter(Activity.activity_id.in_(activity_ids))
+        .options(joinedload(Activity.user), joinedload(Activity.media))
+        .order_by(Activity.activity_id.desc()).all())
+
+    return get_page([(activity.activity_id, activity) for activity in activities], limit)
+
+
+################################## TRENDING ##################################
+
+# how much each kind of activity counts towards a media trending
+TREND_WEIGHTS = {"watched": 1.0, "rated": 1.5, "added_to_playlist": 1.0, "to_be_watched": 0.5}
+# trending counts are kept per media in buckets this long
+BUCKET_SECONDS = 600
+# buckets older than the longest trending window (a week) are deleted
+KEEP_BUCKETS = 7 * 24 * 3600 // BUCKET_SECONDS
+PRUNE_EVERY_SECONDS = 3600
+last_pruned_at = 0
+
+def get_bucket(timestamp=None):
+    return int((timestamp or time.time()) // BUCKET_SECONDS)
+
+def add_trend_events(verb, media_ids, timestamp=None):
+    """Adds to the media's count in the current bucket, one upsert for all of them"""
+
+    weight = TREND_WEIGHTS.get(verb)
+    if not weight or not media_ids:
+        return
+
+    dialect_insert = postgresql.insert if db.engine.dialect.name == "postgresql" else sqlite.insert
+    bucket = get_bucket(timestamp)
+    insert = dialect_insert(TrendBucket.__table__).values([{"media_id": media_id, "bucket": bucket, "events": weight} for media_id in set(media_ids)])
+    db.session.execute(insert.on_conflict_do_update(index_elements=["media_id", "bucket"], set_={"events": TrendBucket.events + insert.excluded.events}))
+
+    prune_trend_buckets()
+
+def prune_trend_buckets(force=False):
+    """Deletes buckets too old to count, at most once an hour per worker"""
+
+    global last_pruned_at
+
+    if force or time.time() - last_pruned_at > PRUNE_EVERY_SECONDS:
+        last_pruned_at = time.time()
+        db.session.execute(TrendBucket.__table__.delete().where(TrendBucket.bucket < get_bucket() - KEEP_BUCKETS))
+
+
+################################## PROFILE DASHBOARD ##################################
+
+DASHBOARD_BATCH_SIZE = 1000
+DASHBOARD_CACHE_SECONDS = 24 * 3600
+
+# user_id, version data_version: the users dashboard, so a new version is computed when their data changes
+dashboard_cache = Cache("dashboard", ttl=DASHBOARD_CACHE_SECONDS)
+
+def get_user_dashboard(user):
+    """The users genres, movie and show watch history and totals, cached until their data changes"""
+
+    return dashboard_cache.get_or_set(user.user_id, lambda: compute_user_dashboard(user), version=user.data_version)
+
+def compute_user_dashboard(user):
+    """The users genres, movie and show watch history and totals, from one pass over their watched list"""
+
+    rows = db.session.execute(
+        select(WatchedList.item_id, Media.media_type, Media.time_watched, Genre.genre_name)
+        .join(Media, Media.media_id == WatchedList.media_id)
+        .outerjoin(MediaGenre, MediaGenre.media_id == Media.media_id)
+        .outerjoin(Genre, Genre.genre_id == MediaGenre.genre_id)
+        .where(WatchedList.user_id == user.user_id)
+        .execution_options(stream_results=True)).yield_per(DASHBOARD_BATCH_SIZE)
+
+    genres = {}
+    history = {"movie": {}, "tv": {}}
+    watched = set()
+
+    # one row per genre of each media, so each media is only counted in the history once
+    for item_id, media_type, time_watched, genre_name in rows:
+        if genre_name:
+            genres[genre_name] = genres.get(genre_name, 0) + 1
+        if item_id not in watched:
+            watched.add(item_id)
+            if time_watched and media_type in history:
+                month = time_watched.strftime("%Y-%m")
+                history[media_type][month] = history[media_type].get(month, 0) + 1
+
+    def count(model):
+        return select(func.count()).where(model.user_id == user.user_id).scalar_subquery()
+
+    to_be_watched, ratings, average_score, playlists = db.session.execute(select(
+        count(ToBeWatchedList),
+        count(Rating),
+        select(func.avg(Rating.score)).where(Rating.user_id == user.user_id).scalar_subquery(),
+        count(Playlist))).one()
+
+    return {
+        "genres": sorted(genres.items(), key=lambda genre: genre[1], reverse=True),
+        "movie_history": sorted(history["movie"].items()),
+        "show_history": sorted(history["tv"].items()),
+        "totals": {
+            "watched": len(watched),
+            "to_be_watched": to_be_watched,
+            "ratings": ratings,
+            "average_score": round(float(average_score), 2) if average_score is not None else None,
+            "playlists": playlists,
+        },
+    }
@@ -0,0 +1,29 @@
+"""Cache of the rendered parts of pages that are the same for every viewer."""
+
+import os
+import zlib
+
+from cache import Cache
+
+FRAGMENT_TTL_SECONDS = 3600
+MEDIA_FRAGMENTS_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "media_fragments.html")
+
+
+def template_version(path):
+    """Changes when the template does, so fragments rendered from an old one are never used"""
+
+    with open(path, "rb") as template_file:
+        return zlib.crc32(template_file.read())
+
+TEMPLATE_VERSION = template_version(MEDIA_FRAGMENTS_TEMPLATE)
+
+# media_fragments_key(), version TEMPLATE_VERSION: the TMDB parts of the media page
+media_fragments = Cache("media_fragments", ttl=FRAGMENT_TTL_SECONDS)
+
+
+def media_fragments_key(media_type, TMDB_id, media=None):
+    """media_type/TMDB_id/when its snapshot was fetched, so fragments of an old snapshot are missed in every process"""
+
+    fetched_at = media.tmdb_fetched_at.isoformat() if media and media.tmdb_fetched_at else "none"
+
+    return f"{media_type}/{TMDB_id}/{fetched_at}"
@@ -0,0 +1,310 @@
+"""Durable background jobs kept in the jobs table, run by worker processes.
+
+    python job_queue.py work [--workers 4] [--once]
+    python job_queue.py status
+    python job_queue.py enqueue <task> ['{"user_id": 1}'] [--priority 5]
+    python job_queue.py retry-failed
+"""
+
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+
+from flask import current_app
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from model import db, connect_to_db, Job, User, Media
+import crud
+import recommendation_job
+import recommender
+import similar_media
+import tmdb
+
+MAX_ATTEMPTS = 5
+# a failed job is tried again after BACKOFF_SECONDS, then twice that, and so on up to MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+# a running job's locked_at is moved forward this often while it runs
+HEARTBEAT_SECONDS = 60
+# running jobs without a heartbeat in this long are assumed lost with their worker and queued again
+JOB_TIMEOUT_SECONDS = 600
+KEEP_DONE_DAYS = 7
+POLL_SECONDS = 1
+MAINTAIN_EVERY_SECONDS = 60
+
+TASKS = {}
+
+def task(name):
+    """Registers a function workers can run, it's called with the jobs payload as keyword arguments"""
+
+    def register(function):
+        TASKS[name] = function
+        return function
+
+    return register
+
+
+def enqueue(task_name, payload=None, priority=0, delay=0, idempotency_key=None, max_attempts=MAX_ATTEMPTS):
+    """Adds a job in the callers transaction, returns its job_id, or the job_id of the job already enqueued with the key"""
+
+    if task_name not in TASKS:
+        raise ValueError(f"unknown task {task_name}")
+
+    now = datetime.now()
+    values = {"task": task_name, "payload": payload or {}, "priority": priority, "status": "queued", "attempts": 0,
+              "max_attempts": max_attempts, "idempotency_key": idempotency_key, "run_at": now + timedelta(seconds=delay),
+              "created_at": now}
+
+    if idempotency_key is None:
+        return db.session.execute(Job.__table__.insert().values(values)).inserted_primary_key[0]
+
+    dialect_insert = postgresql.insert if db.engine.dialect.name == "postgresql" else sqlite.insert
+    db.session.execute(dialect_insert(Job.__table__).values(values).on_conflict_do_nothing(index_elements=["idempotency_key"]))
+
+    return db.session.execute(select(Job.job_id).where(Job.idempotency_key == idempotency_key)).scalar_one()
+
+def claim_job(worker_id):
+    """Takes the next due job, highest priority first, None if there isn't one"""
+
+    now = datetime.now()
+    query = (select(Job.job_id).where(Job.status == "queued", Job.run_at <= now)
+             .order_by(Job.priority.desc(), Job.run_at, Job.job_id).limit(1))
+    if db.engine.dialect.name == "postgresql":
+        # other workers skip the row this one has locked instead of waiting for it
+        query = query.with_for_update(skip_locked=True)
+
+    job_id = db.session.execute(query).scalar()
+    if job_id is None:
+        db.session.commit()
+        return None
+
+    # sqlite has no row locks, so the job is only ours if it's still queued when we update it
+    claimed = db.session.execute(update(Job).where(Job.job_id == job_id, Job.status == "queued")
+                                 .values(status="running", locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+                                 .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+
+    return db.session.get(Job, job_id) if claimed else None
+
+def backoff_seconds(attempts):
+    """Exponential backoff with jitter, so jobs that failed together don't all retry together"""
+
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1))
+
+    return delay * random.uniform(0.5, 1)
+
+def heartbeat(engine, job_id, worker_id):
+    """Moves a running jobs locked_at forward, so maintain() doesn't take it for lost, returns whether it's still ours"""
+
+    with engine.begin() as connection:
+        return connection.execute(update(Job.__table__).where(Job.job_id == job_id, Job.status == "running", Job.locked_by == worker_id)
+                                  .values(locked_at=datetime.now())).rowcount == 1
+
+@contextmanager
+def heartbeats(job):
+    """Sends the jobs heartbeats from another thread while the block runs, on its own connection"""
+
+    engine = db.engine
+    job_id, worker_id = job.job_id, job.locked_by
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            # one missed heartbeat is fine, the next one can still make it in time
+            try:
+                heartbeat(engine, job_id, worker_id)
+            except SQLAlchemyError:
+                pass
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def run_job(job):
+    """Runs a claimed job, then marks it done, queued again for a retry, or failed once it's out of attempts"""
+
+    job_id = job.job_id
+
+    try:
+        with heartbeats(job):
+            TASKS[job.task](**job.payload)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()
+        job.locked_by = None
+        if job.attempts >= job.max_attempts:
+            job.status = "failed"
+            job.finished_at = datetime.now()
+        else:
+            job.status = "queued"
+            job.run_at = datetime.now() + timedelta(seconds=backoff_seconds(job.attempts))
+        db.session.commit()
+        return False
+
+    job = db.session.get(Job, job_id)
+    job.status = "done"
+    job.locked_by = None
+    job.finished_at = datetime.now()
+    db.session.commit()
+
+    return True
+
+def maintain():
+    """Queues again the jobs of workers that died, and deletes old finished jobs"""
+
+    now = datetime.now()
+    lost = (Job.status == "running", Job.locked_at < now - timedelta(seconds=JOB_TIMEOUT_SECONDS))
+
+    db.session.execute(update(Job).where(*lost, Job.attempts >= Job.max_attempts)
+                       .values(status="failed", locked_by=None, finished_at=now, last_error="worker lost")
+                       .execution_options(synchronize_session=False))
+    db.session.execute(update(Job).where(*lost)
+                       .values(status="queued", locked_by=None, run_at=now)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(delete(Job).where(Job.status == "done", Job.finished_at < now - timedelta(days=KEEP_DONE_DAYS))
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+def work(worker_id=None, once=False):
+    """Runs jobs as they come due, or only until none are left with once, returns how many ran"""
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    ran = 0
+    maintained_at = 0
+
+    while True:
+        if time.monotonic() - maintained_at > MAINTAIN_EVERY_SECONDS:
+            maintain()
+            maintained_at = time.monotonic()
+
+        job = claim_job(worker_id)
+        if job is None:
+            if once:
+                return ran
+            time.sleep(POLL_SECONDS)
+            continue
+
+        run_job(job)
+        ran += 1
+
+def worker_process(db_uri, once):
+    """Each worker process gets its own app context and db connections, to the same db as the parent"""
+
+    from server import app
+    connect_to_db(app, db_uri)
+
+    with app.app_context():
+        work(once=once)
+
+def run_workers(workers, once=False):
+    # connections must not be shared with the forked workers
+    db.engine.dispose()
+    db_uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+
+    processes = [multiprocessing.Process(target=worker_process, args=(db_uri, once)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def queue_depth():
+    """How many jobs of each task are in each status: [(task, status, count, oldest run_at)]"""
+
+    return db.session.execute(select(Job.task, Job.status, func.count(), func.min(Job.run_at))
+                              .group_by(Job.task, Job.status).order_by(Job.task, Job.status)).all()
+
+def retry_failed():
+    """Queues every failed job again with its attempts reset, returns how many"""
+
+    retried = db.session.execute(update(Job).where(Job.status == "failed")
+                                 .values(status="queued", attempts=0, run_at=datetime.now(), finished_at=None)
+                                 .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+
+    return retried
+
+
+################################## TASKS ##################################
+
+@task("refresh_recommendations")
+def refresh_recommendations(user_id):
+    recommendation_job.refresh_user_recommendations(user_id)
+
+@task("rebuild_item_neighbors")
+def rebuild_item_neighbors():
+    recommender.rebuild_item_neighbors()
+
+@task("rebuild_similar_media")
+def rebuild_similar_media():
+    similar_media.rebuild_similar_media()
+
+@task("add_similar_media")
+def add_similar_media(media_id):
+    media = Media.query.get(media_id)
+    if media:
+        similar_media.add_media(media)
+
+@task("refresh_tmdb_snapshot")
+def refresh_tmdb_snapshot(media_id):
+    media = Media.query.get(media_id)
+    if media:
+        crud.update_tmdb_snapshot(media, tmdb.get_details(media.media_type, media.TMDB_id))
+        db.session.commit()
+
+@task("warm_dashboard")
+def warm_dashboard(user_id):
+    user = User.query.get(user_id)
+    if user:
+        crud.get_user_dashboard(user)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run and inspect background jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    work_parser = commands.add_parser("work", help="run jobs as they come due")
+    work_parser.add_argument("--workers", type=int, default=1)
+    work_parser.add_argument("--once", action="store_true", help="stop when no jobs are due")
+
+    commands.add_parser("status", help="how many jobs there are of each task and status")
+
+    enqueue_parser = commands.add_parser("enqueue", help="add a job")
+    enqueue_parser.add_argument("task", choices=sorted(TASKS))
+    enqueue_parser.add_argument("payload", nargs="?", default="{}", help="json keyword arguments for the task")
+    enqueue_parser.add_argument("--priority", type=int, default=0)
+
+    commands.add_parser("retry-failed", help="queue every failed job again")
+
+    args = parser.parse_args()
+
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        if args.command == "work":
+            run_workers(args.workers, args.once)
+        elif args.command == "status":
+            for task_name, status, count, oldest in queue_depth():
+                print(f"{task_name:30} {status:10} {count:8} oldest due {oldest:%Y-%m-%d %H:%M}")
+        elif args.command == "enqueue":
+            job_id = enqueue(args.task, json.loads(args.payload), priority=args.priority)
+            db.session.commit()
+            print(f"Enqueued job {job_id}")
+        elif args.command == "retry-failed":
+            print(f"Queued {retry_failed()} failed jobs again")
@@ -1,20 +1,76 @@
 """Models for movie app."""
 
-from flask_sqlalchemy import SQLAlchemy
+import os
+import threading
+import time
+
+from flask import has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, func, literal_column, select, DDL
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.pool import QueuePool, NullPool
 from flask_login import UserMixin, LoginManager
 from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
 # import for hashing passwords
 from passlib.hash import argon2
 
-db = SQLAlchemy()
+def mark_user_wrote():
+    """Remembers when a logged in user last changed something, so their next reads stay on the primary.
+
+    Writes made while serving a GET (filling caches, queueing background refreshes) aren't the users
+    own changes, and marking them would give anonymous visitors a session cookie pinning them to the primary."""
+
+    if (has_request_context() and request.method not in ("GET", "HEAD")
+            and "username" in flask_session):
+        flask_session["last_write_at"] = time.time()
+
+def can_read_from_replica():
+    """Only GET requests from users who haven't just written can read from the replica"""
+
+    if not has_request_context() or request.method not in ("GET", "HEAD"):
+        return False
+
+    # read-your-writes: replicas can lag a little behind the primary
+    sticky_seconds = float(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))
+    return time.time() - flask_session.get("last_write_at", 0) > sticky_seconds
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the read replica (if one is set up) and everything else to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+            mark_user_wrote()
+
+        elif (not self.info.get("wrote")
+                and "replica" in (self.app.config.get("SQLALCHEMY_BINDS") or {})
+                and can_read_from_replica()):
+            return db.get_engine(self.app, bind="replica")
+
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy that uses RoutingSession for db.session"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
 
 friend = db.Table(
     'friends',
     db.Column('friend_id', db.Integer, primary_key=True),
     db.Column('f1_id', db.Integer, db.ForeignKey('users.user_id')),
-    db.Column('f2_id', db.Integer, db.ForeignKey('users.user_id'))
+    db.Column('f2_id', db.Integer, db.ForeignKey('users.user_id')),
+    # for following (f1 -> f2) and followers (f2 <- f1) lookups
+    db.Index('ix_friends_f1_id_f2_id', 'f1_id', 'f2_id'),
+    db.Index('ix_friends_f2_id_f1_id', 'f2_id', 'f1_id'),
 )
 
+# the trigram indexes on users and medias need the pg_trgm extension (postgres only)
+event.listen(db.Model.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
 class User(UserMixin, db.Model):
     """User information"""
 
@@ -24,6 +80,9 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(50), unique=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String())
+    # bumped whenever the users lists, ratings or playlists change, for the etags of their json
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    data_modified_at = db.Column(db.DateTime)
 
     # middle tables:
     ratings = db.relationship('Rating', back_populates="user")
@@ -45,7 +104,12 @@ class User(UserMixin, db.Model):
 
     def get_all_friends(self):
         """ Get all friends, those you are following AND those following you. """
-        return self.following + self.followers
+
+        # one query, and mutual friends only show up once
+        friend_ids = (select(friend.c.f2_id).where(friend.c.f1_id == self.user_id)
+            .union(select(friend.c.f1_id).where(friend.c.f2_id == self.user_id)))
+
+        return User.query.filter(User.user_id.in_(friend_ids)).all()
 
 
     def __repr__(self):
@@ -53,14 +117,36 @@ class User(UserMixin, db.Model):
 
         return f"<User user_id = {self.user_id} username = {self.username} email = {self.email}>"
 
+# postgres only: a trigram index for partial and fuzzy username searches, and
+# a prefix index for searches too short for trigrams (under 3 letters)
+event.listen(User.__table__, "after_create", DDL("CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)").execute_if(dialect="postgresql"))
+event.listen(User.__table__, "after_create", DDL("CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops)").execute_if(dialect="postgresql"))
+
 class OAuth(OAuthConsumerMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.user_id))
     user = db.relationship(User)
 
+class FriendSuggestions(db.Model):
+    """Cached people you may know for a user"""
+
+    __tablename__ = "friend_suggestions"
+
+    # one row per user, deleted when the follows it was computed from change, and recomputed once it's too old
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), primary_key=True)
+    suggestions = db.Column(db.JSON, nullable=False)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Show info about FriendSuggestions"""
+
+        return f"<FriendSuggestions user_id: {self.user_id} suggestions: {len(self.suggestions)} refreshed_at: {self.refreshed_at}>"
+
 class Media(db.Model):
     """Media information"""
 
     __tablename__ = "medias"
+    # for finding media by their TMDB id, one at a time or a whole search grid at once
+    __table_args__ = (db.Index("ix_medias_TMDB_id_media_type", "TMDB_id", "media_type"),)
 
     media_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     TMDB_id = db.Column(db.Integer, nullable=False)
@@ -72,6 +158,9 @@ class Media(db.Model):
     seasons = db.Column(db.Integer)
     episodes = db.Column(db.Integer)
     time_watched = db.Column(db.DateTime)
+    # the full TMDB details the media page is rendered from, fetched again in the background once stale
+    tmdb_snapshot = db.Column(db.JSON().with_variant(JSONB(), "postgresql"))
+    tmdb_fetched_at = db.Column(db.DateTime)
 
     # middle table: 
     ratings = db.relationship('Rating', back_populates="media")
@@ -88,10 +177,22 @@ class Media(db.Model):
 
         return f"<Media media_id: {self.media_id} media_type: {self.media_type} media_title: {self.title} genres: {self.genres}>"
 
+# full text search over the title and overview of media saved in the db, this has
+# to match the ix_medias_search index below exactly for postgres to use the index
+media_search_vector = func.to_tsvector(literal_column("'english'"), Media.title + literal_column("' '") + func.coalesce(Media.overview, literal_column("''")))
+
+# postgres only: the full text index, and a trigram index so partial or misspelled titles still match
+event.listen(Media.__table__, "after_create", DDL("CREATE INDEX IF NOT EXISTS ix_medias_search ON medias USING gin (to_tsvector('english', title || ' ' || coalesce(overview, '')))").execute_if(dialect="postgresql"))
+event.listen(Media.__table__, "after_create", DDL("CREATE INDEX IF NOT EXISTS ix_medias_title_trgm ON medias USING gin (title gin_trgm_ops)").execute_if(dialect="postgresql"))
+
 class Rating(db.Model):
     
 
     __tablename__ = "ratings"
+    # for paging through a media's ratings
+    # and for a users ratings of a page or grid of media
+    __table_args__ = (db.Index("ix_ratings_media_id_rating_id", "media_id", "rating_id"),
+                      db.Index("ix_ratings_user_id_media_id", "user_id", "media_id"))
 
     rating_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     score = db.Column(db.Integer, nullable=False)
@@ -132,6 +233,10 @@ class Playlist(db.Model):
 class PlaylistMedia(db.Model):
   
     __tablename__ = "playlists_media"
+    # for paging through a playlist
+    # and for which playlists a media is in
+    __table_args__ = (db.Index("ix_playlists_media_playlist_id_playlist_media_id", "playlist_id", "playlist_media_id"),
+                      db.Index("ix_playlists_media_media_id", "media_id"))
 
     playlist_media_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey("playlists.playlist_id"), nullable=False)
@@ -147,6 +252,8 @@ class PlaylistMedia(db.Model):
 class WatchedList(db.Model):
     
     __tablename__ = "watched_lists"
+    # for paging through a users list
+    __table_args__ = (db.Index("ix_watched_lists_user_id_item_id", "user_id", "item_id"),)
 
     item_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
@@ -164,6 +271,8 @@ class WatchedList(db.Model):
 class ToBeWatchedList(db.Model):
 
     __tablename__ = "to_be_watched_lists"
+    # for paging through a users list
+    __table_args__ = (db.Index("ix_to_be_watched_lists_user_id_item_id", "user_id", "item_id"),)
 
     item_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
@@ -209,14 +318,291 @@ class MediaGenre(db.Model):
 
         return f"<MediaGenre media_genre_id: {self.media_genre_id} movie_title: {media.title}>"
 
+class Activity(db.Model):
+    """Something a user did that shows up in their followers friends activity"""
+
+    __tablename__ = "activities"
+    # for pulling in the recent activity of users with too many followers to fan out to
+    __table_args__ = (db.Index("ix_activities_user_id_activity_id", "user_id", "activity_id"),)
+
+    activity_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    verb = db.Column(db.String(20), nullable=False)
+    media_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), nullable=False)
+    score = db.Column(db.Integer)
+    # the name is kept since playlists can be deleted
+    playlist_name = db.Column(db.String(50))
+    # false when the user had too many followers to copy this into each of their timelines
+    fanned_out = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    user = db.relationship('User')
+    media = db.relationship('Media')
+
+    def __repr__(self):
+        """Show info about Activity"""
+
+        return f"<Activity activity_id: {self.activity_id} user_id: {self.user_id} verb: {self.verb} media_id: {self.media_id}>"
+
+class TimelineEntry(db.Model):
+    """An activity copied into the timeline of one follower"""
+
+    __tablename__ = "timelines"
+
+    # the primary key doubles as the index for paging through a users timeline
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey("activities.activity_id"), primary_key=True)
+
+    def __repr__(self):
+        """Show info about TimelineEntry"""
+
+        return f"<TimelineEntry user_id: {self.user_id} activity_id: {self.activity_id}>"
+
+class MediaNeighbor(db.Model):
+    """One of the most similar media to a media, by how users rated both"""
+
+    __tablename__ = "media_neighbors"
+
+    # rebuilt from the ratings by recommender.py
+    media_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), primary_key=True)
+    similarity = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """Show info about MediaNeighbor"""
+
+        return f"<MediaNeighbor media_id: {self.media_id} neighbor_id: {self.neighbor_id} similarity: {self.similarity}>"
+
+class SimilarMedia(db.Model):
+    """One of the media most like a media, by overview and genres"""
+
+    __tablename__ = "similar_medias"
+
+    # built by similar_media.py, and added to as new media are saved
+    media_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), primary_key=True)
+    similar_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), primary_key=True)
+    similarity = db.Column(db.Float, nullable=False)
+
+    similar = db.relationship('Media', foreign_keys=[similar_id])
+
+    def __repr__(self):
+        """Show info about SimilarMedia"""
+
+        return f"<SimilarMedia media_id: {self.media_id} similar_id: {self.similar_id} similarity: {self.similarity}>"
+
+class UserRecommendation(db.Model):
+    """A TMDB recommendation for a user, precomputed by recommendation_job.py"""
+
+    __tablename__ = "user_recommendations"
+    # for reading a users recommendations of one media type, best first
+    __table_args__ = (db.Index("ix_user_recommendations_user_id_media_type_score", "user_id", "media_type", "score"),)
+
+    # TMDB results aren't necessarily in medias, so what the page shows is kept here
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), primary_key=True)
+    media_type = db.Column(db.String(20), primary_key=True)
+    TMDB_id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    poster_path = db.Column(db.String(50))
+    score = db.Column(db.Float, nullable=False)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Show info about UserRecommendation"""
+
+        return f"<UserRecommendation user_id: {self.user_id} media_type: {self.media_type} TMDB_id: {self.TMDB_id} score: {self.score}>"
+
+class TrendBucket(db.Model):
+    """How much a media was watched, rated and added to playlists in one short time bucket"""
+
+    __tablename__ = "trend_buckets"
+    # for reading the buckets of the last week, and pruning older ones
+    __table_args__ = (db.Index("ix_trend_buckets_bucket", "bucket"),)
+
+    media_id = db.Column(db.Integer, db.ForeignKey("medias.media_id"), primary_key=True)
+    # seconds since the epoch // BUCKET_SECONDS
+    bucket = db.Column(db.Integer, primary_key=True)
+    events = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """Show info about TrendBucket"""
+
+        return f"<TrendBucket media_id: {self.media_id} bucket: {self.bucket} events: {self.events}>"
+
+class Job(db.Model):
+    """A piece of slow work waiting for, or done by, a job_queue.py worker"""
+
+    __tablename__ = "jobs"
+    # for workers finding the next job to run
+    __table_args__ = (db.Index("ix_jobs_status_priority_run_at", "status", "priority", "run_at"),)
+
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    task = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    # higher runs first
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    # queued, running, done or failed
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # a job with the same key is only ever enqueued once
+    idempotency_key = db.Column(db.String(200), unique=True)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        """Show info about Job"""
+
+        return f"<Job job_id: {self.job_id} task: {self.task} status: {self.status} attempts: {self.attempts}>"
+
+
+class PoolMetrics:
+    """Keeps track of how long requests wait for a db connection and how many are in use"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def checked_out(self):
+        with self.lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def checked_in(self):
+        with self.lock:
+            self.in_use -= 1
+
+    def to_dict(self, pool=None):
+        """Returns the metrics (and the pool's own counts if given) as a dictionary"""
+
+        with self.lock:
+            metrics = {
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "checkouts": self.checkouts,
+                "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+            }
+
+        # only QueuePool has these, NullPool (pgbouncer mode) does not
+        if isinstance(pool, QueuePool):
+            metrics["pool_size"] = pool.size()
+            metrics["checked_in"] = pool.checkedin()
+            metrics["overflow"] = pool.overflow()
+
+        return metrics
+
+# engine name ("primary" or "replica"): its PoolMetrics
+pool_metrics = {}
+
+class TimedPool:
+    """Records how long each checkout waited into the metrics of the engine the pool belongs to"""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.metrics:
+                self.metrics.record_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool, which keeps counting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+class TimedQueuePool(TimedPool, QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+class TimedNullPool(TimedPool, NullPool):
+    """NullPool that records how long each new connection took, used behind pgbouncer"""
+
+
+def get_engine_options(db_uri):
+    """Builds the engine/pool settings from environment variables"""
+
+    # sqlite (used for quick local runs) doesn't take any of the pool settings
+    if not db_uri.startswith("postgresql"):
+        return {}
+
+    statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+    # pgbouncer in transaction mode does its own pooling and doesn't allow
+    # startup options, so don't pool here and set the timeout per transaction instead
+    if os.environ.get("DB_PGBOUNCER", "").lower() in ("1", "true", "yes"):
+        return {"poolclass": TimedNullPool}
+
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+        "connect_args": {"options": f"-c statement_timeout={statement_timeout}"},
+    }
+
+def add_pool_listeners(engine, name="primary"):
+    """Hooks up the engines own pool metrics (and the pgbouncer statement timeout) to the engine"""
+
+    metrics = pool_metrics[name] = PoolMetrics()
+    engine.pool.metrics = metrics
+
+    event.listen(engine, "checkout", lambda *args: metrics.checked_out())
+    event.listen(engine, "checkin", lambda *args: metrics.checked_in())
+
+    if isinstance(engine.pool, TimedNullPool):
+        statement_timeout = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+        # SET LOCAL only lasts for the transaction, so it's safe with pgbouncer
+        # handing the server connection to someone else afterwards
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {statement_timeout}")
+
+def connect_to_db(flask_app, db_uri=None, echo=False, replica_uri=None):
+    if not db_uri:
+        db_uri = os.environ.get("DATABASE_URL", "postgresql:///project_db")
+    if not replica_uri:
+        replica_uri = os.environ.get("DATABASE_REPLICA_URL")
 
-def connect_to_db(flask_app, db_uri="postgresql:///project_db", echo=False):
     flask_app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
     flask_app.config["SQLALCHEMY_ECHO"] = echo
     flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(db_uri)
+
+    # reads in GET requests go to the replica, see RoutingSession
+    if replica_uri:
+        flask_app.config["SQLALCHEMY_BINDS"] = {"replica": replica_uri}
+    else:
+        flask_app.config.pop("SQLALCHEMY_BINDS", None)
 
     db.app = flask_app
-    db.init_app(flask_app)
+    # flask takes no more setup once an app has served a request, and the
+    # engine picks up a changed uri by itself, so only set the app up once
+    if "sqlalchemy" not in flask_app.extensions:
+        db.init_app(flask_app)
+
+    with flask_app.app_context():
+        add_pool_listeners(db.engine)
+        if replica_uri:
+            add_pool_listeners(db.get_engine(bind="replica"), "replica")
 
     print("Successfully connected to DB")
 
@@ -0,0 +1,84 @@
+"""Searching movies and shows at once: both TMDB searches run concurrently, and their results are merged into one ranking."""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import math
+
+import tmdb
+from autocomplete import normalize, word_starts
+
+MEDIA_TYPES = ("movie", "tv")
+# whatever has come back by then is shown, so a slow search doesn't hold up the other
+DEADLINE_SECONDS = 2.5
+SEARCH_THREADS = 16
+MATCH_WEIGHT = 0.6
+POPULARITY_WEIGHT = 0.4
+# media already on MyViews have no TMDB popularity with them, so they count as this popular
+LOCAL_POPULARITY = 0.5
+
+# shared by every request, so a search doesn't start threads of its own
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="tmdb-search")
+
+
+def search_tmdb(search_text, media_types=MEDIA_TYPES, deadline=DEADLINE_SECONDS):
+    """Searches TMDB for each media type at the same time, returns (results tagged with their media_type,
+    whether TMDB couldn't be reached, whether a search missed the deadline)"""
+
+    futures = {search_executor.submit(tmdb.get, f"search/{media_type}", query=search_text): media_type for media_type in media_types}
+    done, not_done = wait(futures, timeout=deadline)
+
+    results = []
+    degraded = False
+    for future in done:
+        try:
+            data = future.result().json()
+        except (tmdb.TMDBUnavailable, ValueError):
+            degraded = True
+            continue
+        for result in data.get("results", []):
+            result["media_type"] = futures[future]
+            results.append(result)
+
+    # they finish in the background, nothing waits on them
+    for future in not_done:
+        future.cancel()
+
+    return results, degraded, bool(not_done)
+
+def title_match(search, title):
+    """How well a normalized title matches the normalized search, from 1 for the same title down to 0"""
+
+    if not search or not title:
+        return 0
+    if title == search:
+        return 1
+    if title.startswith(search):
+        return 0.8
+    if any(start.startswith(search) for start in word_starts(title)):
+        return 0.6
+    if set(search.split(" ")) <= set(title.split(" ")):
+        return 0.4
+
+    return 0.1 if search in title else 0
+
+def rank_results(search_text, results):
+    """Dedupes the results by media, keeping the first of each, and orders them by title match and popularity"""
+
+    search = normalize(search_text)
+    unique = {}
+    for result in results:
+        unique.setdefault((result["media_type"], result["id"]), result)
+
+    most_popular = max((result.get("popularity") or 0 for result in unique.values()), default=0)
+
+    def score(result):
+        titles = {result.get(key) for key in ("original_title", "title", "name")}
+        match = max(title_match(search, normalize(title)) for title in titles)
+        if result.get("source") == "local":
+            popularity = LOCAL_POPULARITY
+        elif most_popular:
+            popularity = math.log1p(result.get("popularity") or 0) / math.log1p(most_popular)
+        else:
+            popularity = 0
+        return MATCH_WEIGHT * match + POPULARITY_WEIGHT * popularity
+
+    return sorted(unique.values(), key=score, reverse=True)
@@ -0,0 +1,185 @@
+"""Batch job that precomputes each active users recommendations into user_recommendations.
+
+    python recommendation_job.py [--workers 4] [--all]
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+
+from flask import current_app
+from sqlalchemy import select, distinct
+
+from model import db, connect_to_db, Media, Rating, WatchedList, ToBeWatchedList, Activity, UserRecommendation
+import tmdb
+from cache import Cache
+
+# users who rated, sorted or added to a playlist this recently get their recommendations refreshed
+ACTIVE_DAYS = 30
+RECOMMENDATIONS_PER_TYPE = 20
+SEEDS_PER_KIND = 3
+# how much each kind of seed counts
+RECENT_WATCH_WEIGHT = 1.0
+TOP_RATED_WEIGHT = 1.2
+TO_BE_WATCHED_WEIGHT = 0.7
+MIN_SEED_SCORE = 4
+# TMDB's recommendations for a title change slowly, and many users share seeds
+TMDB_CACHE_SECONDS = 12 * 3600
+
+tmdb_recommendations_cache = Cache("tmdb_recommendations", ttl=TMDB_CACHE_SECONDS)
+
+
+def fetch_recommendations(media_type, TMDB_id):
+    """TMDB recommendations for one title, cached since many users share seeds"""
+
+    def fetch():
+        # raises TMDBUnavailable, so the job is retried later instead of caching no results
+        res = tmdb.get(f"{media_type}/{TMDB_id}/recommendations")
+
+        if not res.ok:
+            return ()
+
+        return tuple(res.json().get("results", []))
+
+    return tmdb_recommendations_cache.get_or_set(f"{media_type}/{TMDB_id}", fetch)
+
+def get_seeds(user_id):
+    """The users recent watches, top ratings and to be watched media, with how much each counts: {Media: weight}"""
+
+    seeds = {}
+
+    def add(medias, weight):
+        for media in medias:
+            seeds[media] = max(weight, seeds.get(media, 0))
+
+    for media_type in ("movie", "tv"):
+        add(Media.query.join(WatchedList, WatchedList.media_id == Media.media_id)
+            .filter(WatchedList.user_id == user_id, Media.media_type == media_type)
+            .order_by(WatchedList.item_id.desc()).limit(SEEDS_PER_KIND), RECENT_WATCH_WEIGHT)
+
+        top_rated = (db.session.query(Media, Rating.score).join(Rating, Rating.media_id == Media.media_id)
+            .filter(Rating.user_id == user_id, Media.media_type == media_type, Rating.score >= MIN_SEED_SCORE)
+            .order_by(Rating.score.desc(), Rating.rating_id.desc()).limit(SEEDS_PER_KIND))
+        for media, score in top_rated:
+            add([media], TOP_RATED_WEIGHT * score / 5)
+
+        add(Media.query.join(ToBeWatchedList, ToBeWatchedList.media_id == Media.media_id)
+            .filter(ToBeWatchedList.user_id == user_id, Media.media_type == media_type)
+            .order_by(ToBeWatchedList.item_id.desc()).limit(SEEDS_PER_KIND), TO_BE_WATCHED_WEIGHT)
+
+    return seeds
+
+def get_known_media(user_id):
+    """(media_type, TMDB_id) of everything the user has watched, rated or plans to watch"""
+
+    known = set()
+    for list_model in (WatchedList, ToBeWatchedList, Rating):
+        rows = db.session.execute(select(Media.media_type, Media.TMDB_id).join(list_model, list_model.media_id == Media.media_id)
+                                  .where(list_model.user_id == user_id))
+        known.update((media_type, TMDB_id) for media_type, TMDB_id in rows)
+
+    return known
+
+def compute_user_recommendations(user_id):
+    """Merges the recommendations of every seed, best first for each media type: {media_type: [(score, result)]}"""
+
+    known = get_known_media(user_id)
+    scores = {}
+    results = {}
+
+    for seed, weight in get_seeds(user_id).items():
+        for rank, result in enumerate(fetch_recommendations(seed.media_type, seed.TMDB_id)):
+            key = (seed.media_type, result["id"])
+            if key in known:
+                continue
+            # higher up TMDB's list counts more, and titles several seeds agree on add up
+            scores[key] = scores.get(key, 0) + weight / (1 + 0.1 * rank)
+            results[key] = result
+
+    by_type = {"movie": [], "tv": []}
+    for key, score in scores.items():
+        by_type[key[0]].append((score, results[key]))
+
+    for media_type, recommendations in by_type.items():
+        recommendations.sort(key=lambda recommendation: -recommendation[0])
+        by_type[media_type] = recommendations[:RECOMMENDATIONS_PER_TYPE]
+
+    return by_type
+
+def refresh_user_recommendations(user_id):
+    """Replaces the users stored recommendations, returns how many were stored"""
+
+    by_type = compute_user_recommendations(user_id)
+    now = datetime.now()
+
+    db.session.execute(UserRecommendation.__table__.delete().where(UserRecommendation.user_id == user_id))
+
+    rows = [{"user_id": user_id, "media_type": media_type, "TMDB_id": result["id"],
+             "title": result.get("title") or result.get("name") or "", "poster_path": result.get("poster_path"),
+             "score": score, "refreshed_at": now}
+            for media_type, recommendations in by_type.items()
+            for score, result in recommendations]
+
+    if rows:
+        db.session.execute(UserRecommendation.__table__.insert(), rows)
+    db.session.commit()
+
+    return len(rows)
+
+def get_active_user_ids(all_users=False):
+    """Users who did something in the last ACTIVE_DAYS, or everyone with a watched list"""
+
+    if all_users:
+        query = select(distinct(WatchedList.user_id))
+    else:
+        query = select(distinct(Activity.user_id)).where(Activity.created_at >= datetime.now() - timedelta(days=ACTIVE_DAYS))
+
+    return db.session.execute(query).scalars().all()
+
+
+def init_worker(db_uri):
+    """Each worker process gets its own app context and db connections, to the same db as the parent"""
+
+    from server import app
+    connect_to_db(app, db_uri)
+    app.app_context().push()
+
+def refresh_in_worker(user_id):
+    try:
+        return user_id, refresh_user_recommendations(user_id)
+    except Exception as error:
+        db.session.rollback()
+        return user_id, error
+
+def run(user_ids, workers=1):
+    """Refreshes the users recommendations, spread over worker processes, returns the users that failed"""
+
+    if workers > 1:
+        # connections must not be shared with the forked workers
+        db.engine.dispose()
+        db_uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(db_uri,)) as pool:
+            results = list(pool.imap_unordered(refresh_in_worker, user_ids, chunksize=10))
+    else:
+        results = [refresh_in_worker(user_id) for user_id in user_ids]
+
+    return [(user_id, result) for user_id, result in results if isinstance(result, Exception)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations for active users")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--all", action="store_true", help="every user with a watched list, not only active ones")
+    args = parser.parse_args()
+
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        user_ids = get_active_user_ids(args.all)
+        failed = run(user_ids, args.workers)
+
+    print(f"Refreshed recommendations for {len(user_ids) - len(failed)} of {len(user_ids)} users")
+    for user_id, error in failed:
+        print(f"user {user_id}: {error}")
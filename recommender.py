@@ -0,0 +1,146 @@
+"""Item-item collaborative filtering over the ratings users have given media."""
+
+from collections import defaultdict
+import heapq
+import math
+
+from sqlalchemy import select
+
+from model import db, connect_to_db, Rating, WatchedList, MediaNeighbor, Media
+from cache import Cache
+
+# how many similar media are kept for each media
+NEIGHBORS_PER_MEDIA = 20
+# pairs rated by only a few users get their similarity shrunk towards 0
+SHRINKAGE = 10
+# a users most recent ratings past this are left out of the similarity build,
+# so a handful of users who rated everything can't make it quadratic
+MAX_RATINGS_PER_USER = 500
+INSERT_BATCH_SIZE = 5000
+# how many predictions are cached for each user
+RECOMMENDATIONS_PER_USER = 50
+
+CACHE_TTL_SECONDS = 600
+
+
+def load_ratings():
+    """Loads the ratings as sparse rows: {user_id: {media_id: score}}"""
+
+    users = defaultdict(dict)
+    rows = db.session.execute(select(Rating.user_id, Rating.media_id, Rating.score)
+                              .order_by(Rating.user_id, Rating.rating_id.desc())
+                              .execution_options(stream_results=True))
+
+    for user_id, media_id, score in rows.yield_per(INSERT_BATCH_SIZE):
+        if len(users[user_id]) < MAX_RATINGS_PER_USER:
+            users[user_id].setdefault(media_id, score)
+
+    return users
+
+def compute_item_neighbors(users, k=NEIGHBORS_PER_MEDIA):
+    """Adjusted cosine similarity between media, returns the top k neighbors of each: {media_id: [(similarity, neighbor_id)]}"""
+
+    # center each users scores on their own average, so harsh and generous raters compare
+    columns = defaultdict(list)
+    for user_id, scores in users.items():
+        mean = sum(scores.values()) / len(scores)
+        for media_id, score in scores.items():
+            if score != mean:
+                columns[media_id].append((user_id, score - mean))
+
+    norms = {media_id: math.sqrt(sum(value * value for user_id, value in column)) for media_id, column in columns.items()}
+    centered_users = defaultdict(list)
+    for media_id, column in columns.items():
+        for user_id, value in column:
+            centered_users[user_id].append((media_id, value))
+
+    # one media at a time, so memory only grows with that media's co-rated media
+    neighbors = {}
+    for media_id, column in columns.items():
+        dots = defaultdict(float)
+        counts = defaultdict(int)
+        for user_id, value in column:
+            for other_id, other_value in centered_users[user_id]:
+                if other_id != media_id:
+                    dots[other_id] += value * other_value
+                    counts[other_id] += 1
+
+        similarities = []
+        for other_id, dot in dots.items():
+            similarity = dot / (norms[media_id] * norms[other_id]) * counts[other_id] / (counts[other_id] + SHRINKAGE)
+            if similarity > 0:
+                similarities.append((similarity, other_id))
+
+        if similarities:
+            neighbors[media_id] = heapq.nlargest(k, similarities)
+
+    return neighbors
+
+def save_item_neighbors(neighbors):
+    """Replaces the media_neighbors table with the new neighbors"""
+
+    db.session.execute(MediaNeighbor.__table__.delete())
+
+    rows = [{"media_id": media_id, "neighbor_id": neighbor_id, "similarity": similarity}
+            for media_id, media_neighbors in neighbors.items()
+            for similarity, neighbor_id in media_neighbors]
+
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(MediaNeighbor.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+def rebuild_item_neighbors():
+    """Recomputes every media's neighbors from the ratings, returns how many media have neighbors"""
+
+    neighbors = compute_item_neighbors(load_ratings())
+    save_item_neighbors(neighbors)
+    db.session.commit()
+    recommendation_cache.clear()
+
+    return len(neighbors)
+
+
+def predict_for_user(user_id, limit=20):
+    """Predicts scores for media similar to what the user rated, best first: [(media_id, predicted score)]"""
+
+    scores = dict(db.session.execute(select(Rating.media_id, Rating.score).where(Rating.user_id == user_id)).all())
+
+    if not scores:
+        return []
+
+    watched = set(db.session.execute(select(WatchedList.media_id).where(WatchedList.user_id == user_id)).scalars())
+    rows = db.session.execute(select(MediaNeighbor.media_id, MediaNeighbor.neighbor_id, MediaNeighbor.similarity)
+                              .where(MediaNeighbor.media_id.in_(scores)))
+
+    # weighted average of the users scores for the rated media each candidate is similar to
+    weighted = defaultdict(float)
+    total_similarity = defaultdict(float)
+    for media_id, neighbor_id, similarity in rows:
+        if neighbor_id not in scores and neighbor_id not in watched:
+            weighted[neighbor_id] += similarity * scores[media_id]
+            total_similarity[neighbor_id] += similarity
+
+    predictions = [(weighted[media_id] / total, total, media_id) for media_id, total in total_similarity.items()]
+    best = heapq.nlargest(limit, predictions)
+
+    return [(media_id, predicted) for predicted, total, media_id in best]
+
+
+# user_id: the users predictions, invalidated when their ratings or watched list change
+recommendation_cache = Cache("recommendations", ttl=CACHE_TTL_SECONDS)
+
+def get_recommendations(user, limit=20):
+    """Gets the media recommended to the user from their ratings, best first"""
+
+    predictions = recommendation_cache.get_or_set(user.user_id, lambda: predict_for_user(user.user_id, RECOMMENDATIONS_PER_USER))
+    media_ids = [media_id for media_id, predicted in predictions[:limit]]
+    medias = {media.media_id: media for media in Media.query.filter(Media.media_id.in_(media_ids))}
+
+    return [medias[media_id] for media_id in media_ids if media_id in medias]
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        print(f"Rebuilt neighbors for {rebuild_item_neighbors()} media")
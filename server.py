@@ -1,10 +1,21 @@
 """Server for movie app."""
 
 from flask import (Flask, render_template, request, flash, session,
-                   redirect, jsonify, url_for)
-from model import connect_to_db, db, login_manager, OAuth, User
+                   redirect, jsonify, url_for, get_template_attribute, abort)
+from model import connect_to_db, db, login_manager, OAuth, User, pool_metrics
 import crud
+from social_graph import adjacency_cache
+import recommender
+import similar_media
+import trending
+import autocomplete
+import multi_search
+import fragment_cache
+import job_queue
+import tmdb
+from cache import Cache, get_backend
 import os
+import hmac
 import requests
 from jinja2 import StrictUndefined
 
@@ -18,12 +29,18 @@ from flask_dance.consumer import oauth_authorized
 from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
 from sqlalchemy.orm.exc import NoResultFound
 
-from datetime import date
+from datetime import date, datetime, timezone
 
 app = Flask(__name__)
 app.secret_key = "forsession"
 app.jinja_env.undefined = StrictUndefined
 API_KEY = os.environ['TMDB_KEY']
+TMDB_CACHE_SECONDS = 900
+TMDB_STALE_SECONDS = 24 * 3600
+# so a few ratings in a row only refresh recommendations once
+RECOMMENDATIONS_REFRESH_DELAY = 300
+# and a few list changes in a row only recompute the dashboard once
+DASHBOARD_WARM_DELAY = 60
 
 #################################################################################################
 # OAuth for Github Implemented Using https://testdriven.io/blog/flask-social-auth/#oauth
@@ -71,6 +88,26 @@ def login():
 
 ##################### End of GitHub OAuth Implementation ###########################################
 
+#### TMDB DEGRADED MODE #####
+
+@app.errorhandler(tmdb.TMDBUnavailable)
+def handle_tmdb_unavailable(error):
+    """When something can't be done without TMDB, says so right away instead of waiting on it"""
+
+    message = "TMDB isn't responding right now, please try again in a minute"
+
+    if request.path.endswith(".json") or request.is_json:
+        return jsonify({"error": message, "degraded": True}), 503
+
+    flash(message)
+    return redirect(request.referrer or "/")
+
+@app.context_processor
+def inject_tmdb_degraded():
+    """So base.html can say when TMDB data may be missing or out of date"""
+
+    return {"tmdb_degraded": tmdb.is_degraded()}
+
 @app.route("/")
 def homepage():
     """Displays homepage"""
@@ -154,7 +191,25 @@ def display_user_profile():
     if "username" in session: 
         user_username= session["username"]
         user = crud.get_user_by_username(user_username)
-        return render_template("user_profile.html", user=user)
+
+        # only the first page of each list, the rest loads as the user scrolls
+        watched, watched_next = crud.get_list_page(crud.WatchedList, user)
+        to_be_watched, to_be_watched_next = crud.get_list_page(crud.ToBeWatchedList, user)
+        playlist_pages = {playlist.playlist_id: crud.get_playlist_page(playlist) for playlist in user.playlists}
+
+        all_medias = watched + to_be_watched
+        for medias, next_after in playlist_pages.values():
+            all_medias += medias
+        ratings = crud.get_user_ratings_for_medias(user, all_medias)
+
+        friend_pages = {}
+        for friend in user.following:
+            medias, next_after = crud.get_list_page(crud.WatchedList, friend)
+            friend_pages[friend.user_id] = (medias, next_after, crud.get_user_ratings_for_medias(friend, medias))
+
+        return render_template("user_profile.html", user=user, watched=watched, watched_next=watched_next,
+                               to_be_watched=to_be_watched, to_be_watched_next=to_be_watched_next,
+                               playlist_pages=playlist_pages, ratings=ratings, friend_pages=friend_pages)
 
     else:
         # flash("Sorry, please log in:")
@@ -182,48 +237,162 @@ def show_friend_search_results():
     user2 = crud.get_user_by_username(search_text)
 
     if user2: 
-        return render_template("/search_friend_result.html", user2=user2, user=user, user2_user_id= user2.user_id)
+        return render_template("/search_friend_result.html", user2=user2, user=user, user2_user_id= user2.user_id, **get_follow_info(user, user2))
 
     else: 
         flash(f"Sorry, no user exists with the username '{search_text}'.")
         return redirect("/search-friends")
 
+@app.route("/friend-suggestions.json")
+def get_friend_suggestions_json():
+    """Returns people the user may know"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to see friend suggestions"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    suggestions = crud.get_friend_suggestions(user)
+    db.session.commit()
+
+    return jsonify({"suggestions": suggestions})
+
+# searches past this many results aren't worth paging through
+MAX_FRIEND_SEARCH_RESULTS = 100
+
+@app.route("/search-friends.json")
+def search_friends_json():
+    """Returns usernames that partially match the search, for the as you type search box"""
+
+    search_text = request.args.get("q", "").strip()
+    offset = max(0, min(request.args.get("offset", 0, type=int), MAX_FRIEND_SEARCH_RESULTS))
+
+    if "username" not in session:
+        return jsonify({"error": "log in to search for friends"}), 401
+
+    if not search_text:
+        return jsonify({"users": [], "next_offset": None})
+
+    user = crud.get_user_by_username(session["username"])
+    users, next_offset = crud.search_usernames(search_text[:50], user, offset=offset)
+
+    if next_offset and next_offset >= MAX_FRIEND_SEARCH_RESULTS:
+        next_offset = None
+
+    return jsonify({"users": [{"user_id": user2.user_id, "username": user2.username} for user2 in users], "next_offset": next_offset})
+
+def get_follow_info(user, user2):
+    """Gets the follow state and counts shown on a friends profile from the adjacency cache"""
+
+    return {
+        "is_following": adjacency_cache.is_following(user.user_id, user2.user_id),
+        "follows_you": adjacency_cache.is_following(user2.user_id, user.user_id),
+        "follower_count": adjacency_cache.follower_count(user2.user_id),
+        "following_count": adjacency_cache.following_count(user2.user_id),
+    }
+
+@app.route("/friends-activity.json")
+def get_friends_activity_json():
+    """Gets a page of what the people the user follows recently rated, watched or added to playlists"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to see your friends activity"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    activities, next_after = crud.get_feed_page(user, after=request.args.get("after", type=int))
+
+    items = []
+    for activity in activities:
+        items.append({"activity_id": activity.activity_id, "username": activity.user.username, "verb": activity.verb,
+                      "score": activity.score, "playlist_name": activity.playlist_name,
+                      "media_type": activity.media.media_type, "TMDB_id": activity.media.TMDB_id,
+                      "title": activity.media.title, "poster_path": activity.media.poster_path,
+                      "created_at": activity.created_at.isoformat()})
+
+    return jsonify({"items": items, "next_after": next_after})
+
 @app.route("/friend/follow-status.js", methods=["POST"])
 def follow_or_unfollow_friends():
     """Allows user to unfollow or follow a friend"""
 
+    if "username" not in session:
+        return jsonify({"error": "log in to follow users"}), 401
+
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
 
-    user2_user_id = request.json.get("user2ID")
-    user2 = crud.get_user_by_id(user2_user_id)
+    user2_user_id = get_request_json().get("user2ID")
+    # the page sends the id as a string
+    user2 = crud.get_user_by_id(int(user2_user_id)) if str(user2_user_id).isdecimal() else None
+
+    action = str(get_request_json().get("action") or "").lower()
 
-    action = (request.json.get("action")).lower()
+    if not user2:
+        return jsonify({"error": "user not found"}), 404
+    if action not in ("follow", "unfollow"):
+        return jsonify({"error": "action must be 'follow' or 'unfollow'"}), 400
 
-    if action == "follow": 
-        user.following.append(user2)
+    # the adjacency cache can be a minute behind other workers, so the follow state comes from the db
+    if action == "follow":
+        crud.follow_user(user, user2)
         db.session.commit()
+        adjacency_cache.follow(user.user_id, user2.user_id)
 
-    elif action == "unfollow": 
-        user.following.remove(user2)
+    else:
+        crud.unfollow_user(user, user2)
         db.session.commit()
+        adjacency_cache.unfollow(user.user_id, user2.user_id)
 
-    return jsonify({"success": "user followed/unfollowed"})
+    return jsonify({"success": "user followed/unfollowed", "following": action == "follow"})
 
 
 @app.route('/display-friend/<friend_username>')
 def display_friend_by_username(friend_username):
     """Displays friend profile when user clicks on their name in user profile"""
 
+    if "username" not in session:
+        return redirect("/")
+
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
 
     user2 = crud.get_user_by_username(friend_username)
+    if not user2:
+        abort(404)
 
-    # if user2: 
-    return render_template("/search_friend_result.html", user2=user2, user=user, user2_user_id= user2.user_id)
+    return render_template("/search_friend_result.html", user2=user2, user=user, user2_user_id= user2.user_id, **get_follow_info(user, user2))
+
+@app.route('/display-friend/<friend_username>/watched/page.json')
+def get_friend_watched_page(friend_username):
+    """Gets the next page of a friends watched list for the profile page"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to see other users lists"}), 401
+
+    user2 = crud.get_user_by_username(friend_username)
+    if not user2:
+        return jsonify({"error": "user not found"}), 404
+
+    medias, next_after = crud.get_list_page(crud.WatchedList, user2, after=request.args.get("after", type=int))
+
+    return media_page_json(medias, crud.get_user_ratings_for_medias(user2, medias), next_after)
 
 ################################################# REACT #################################################
+
+# below this many local results, TMDB is searched too
+MIN_LOCAL_RESULTS = 10
+
+def local_media_json(media):
+    """Returns a media saved in the db in the same shape as a TMDB search result"""
+
+    result = {"id": media.TMDB_id, "media_type": media.media_type, "poster_path": media.poster_path, "overview": media.overview, "source": "local"}
+
+    if media.media_type == "movie":
+        result["original_title"] = media.title
+    else:
+        result["name"] = media.title
+
+    return result
+
 @app.route("/media-search-results-react.json",  methods=["POST"])
 def get_search_results_react_json():
     """Return a JSON response with all media from search bar query"""
@@ -231,21 +400,96 @@ def get_search_results_react_json():
     # REACT getting version
     search_text = request.get_json().get("search")
     media_type = request.get_json().get("mediaType")
-    
-    url = f"https://api.themoviedb.org/3/search/{media_type}"
-    
-    payload = {"api_key": API_KEY} 
 
-    # add media title to payload
+    if media_type == "multi":
+        return get_multi_search_results_json(search_text)
+
+    # search what is already saved in the db first
+    results = []
     if search_text:
-        payload["query"]=search_text
+        results = [local_media_json(media) for media in crud.search_local_media(search_text, media_type)]
 
-    res = requests.get(url, params=payload)
-    data = res.json()
+    # only go to TMDB when there aren't enough local results
+    degraded = False
+    if len(results) < MIN_LOCAL_RESULTS:
+        payload = {}
+
+        # add media title to payload
+        if search_text:
+            payload["query"]=search_text
+
+        # the local results are still worth showing when TMDB can't be reached
+        try:
+            data = tmdb.get(f"search/{media_type}", **payload).json()
+        except tmdb.TMDBUnavailable:
+            data = {}
+            degraded = True
+
+        local_ids = {result["id"] for result in results}
+        for result in data.get("results", []):
+            if result["id"] not in local_ids:
+                result["source"] = "tmdb"
+                result["media_type"] = media_type
+                results.append(result)
+
+    return jsonify({"media": results, "search_text": search_text, "media_type": media_type, "degraded": degraded})
+
+def get_multi_search_results_json(search_text):
+    """Searches movies and shows at once, both TMDB searches at the same time, merged into one list best first"""
+
+    results = []
+    degraded = partial = False
+
+    if search_text:
+        results = [local_media_json(media) for media in crud.search_local_media(search_text, None)]
+
+        if len(results) < MIN_LOCAL_RESULTS:
+            tmdb_results, degraded, partial = multi_search.search_tmdb(search_text)
+            for result in tmdb_results:
+                result["source"] = "tmdb"
+            results += tmdb_results
+
+        results = multi_search.rank_results(search_text, results)
 
-    results = data['results']
+    return jsonify({"media": results, "search_text": search_text, "media_type": "multi", "degraded": degraded, "partial": partial})
 
-    return jsonify({"media": results, "search_text": search_text, "media_type": media_type})
+@app.route("/autocomplete.json")
+def get_autocomplete_json():
+    """Returns titles starting with what has been typed so far, from an index in memory so no TMDB call is made"""
+
+    media_type = request.args.get("mediaType")
+    if media_type not in autocomplete.MEDIA_TYPES:
+        media_type = None
+    suggestions = autocomplete.suggest(request.args.get("q", ""), media_type)
+
+    response = jsonify({"suggestions": suggestions})
+    # the same for everyone, and typing the same prefix again shouldn't cost a request
+    response.headers["Cache-Control"] = "public, max-age=60"
+
+    return response
+
+@app.route("/media-state.json", methods=["POST"])
+def get_media_states_json():
+    """Returns the users lists, score and playlists for every media in a search grid in one request"""
+
+    if "username" not in session:
+        return jsonify({"states": {}})
+
+    items = get_request_json().get("items") or []
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "items must be a list of media"}), 400
+    if len(items) > crud.MAX_STATE_ITEMS:
+        return jsonify({"error": f"at most {crud.MAX_STATE_ITEMS} media at a time"}), 400
+
+    try:
+        pairs = [(item["mediaType"], int(item["TMDB_id"])) for item in items]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "each item needs a mediaType and TMDB_id"}), 400
+
+    user = crud.get_user_by_username(session["username"])
+    states = crud.get_user_states(user, pairs)
+
+    return jsonify({"states": {f"{media_type}/{TMDB_id}": state for (media_type, TMDB_id), state in states.items()}})
 
 @app.route("/media-search-results-react")
 def show_react_search_results():
@@ -255,51 +499,131 @@ def show_react_search_results():
 
 ##############################################End REACT #################################################
 
+def get_media_details(media, media_type, TMDB_id):
+    """The medias TMDB details and whether they were found, from the snapshot saved with it when there is one"""
+
+    if media and media.tmdb_snapshot:
+        refresh_stale_snapshot(media)
+        return media.tmdb_snapshot, True
+
+    #get media information
+    try:
+        res = tmdb.get(f"{media_type}/{TMDB_id}")
+    except tmdb.TMDBUnavailable:
+        return media_fallback_details(media, media_type), False
+    data = res.json()
+
+    # media saved before snapshots were get theirs the first time they're viewed
+    if media and res.ok:
+        crud.update_tmdb_snapshot(media, data)
+        db.session.commit()
+
+    return data, res.ok
+
+def refresh_stale_snapshot(media):
+    """Has a worker fetch the medias TMDB details again if they're stale, at most once an hour,
+    the stale ones are shown meanwhile"""
+
+    if crud.snapshot_is_stale(media):
+        job_queue.enqueue("refresh_tmdb_snapshot", {"media_id": media.media_id},
+                          idempotency_key=f"refresh_tmdb_snapshot:{media.media_id}:{datetime.now():%Y-%m-%d %H}")
+        db.session.commit()
+
+def media_fallback_details(media, media_type):
+    """What the db has of the medias TMDB details, for when TMDB can't be reached"""
+
+    if media:
+        return local_media_json(media)
+
+    return {"original_title" if media_type == "movie" else "name": "", "poster_path": None, "overview": None}
+
+def render_media_fragments(data, media_type):
+    """Renders the title, poster and overview of a media page from its TMDB data"""
+
+    return {
+        "title": get_template_attribute("media_fragments.html", "title")(data, media_type),
+        "poster": get_template_attribute("media_fragments.html", "poster")(data),
+        "overview": get_template_attribute("media_fragments.html", "overview")(data),
+        "has_overview": bool(data.get("overview")),
+    }
+
 @app.route("/media-info/<media_type>/<TMDB_id>")
 def show_media(media_type, TMDB_id):
     """Shows specific media information for selected media"""
 
-    #get media information
-    url = f"https://api.themoviedb.org/3/{media_type}/{TMDB_id}"
+    media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
 
-    payload = {"api_key": API_KEY} 
+    # the TMDB parts of the page are the same for everyone, so they are only rendered once in a while
+    fragments_key = fragment_cache.media_fragments_key(media_type, TMDB_id, media)
+    fragments = fragment_cache.media_fragments.get(fragments_key, version=fragment_cache.TEMPLATE_VERSION)
 
-    res = requests.get(url, params=payload)
-    data = res.json()
-    
-    # filter for that movies ratings in db to display on media page
-    if crud.get_media_by_TMDB_id(TMDB_id, media_type):
-        media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
-        media_id = media.media_id
-        all_ratings = crud.get_all_ratings(media_id)
+    if fragments is None:
+        data, ok = get_media_details(media, media_type, TMDB_id)
+        fragments = render_media_fragments(data, media_type)
 
-    else: 
-        all_ratings = False
+        # the snapshot may have been saved just now
+        if ok:
+            fragment_cache.media_fragments.set(fragment_cache.media_fragments_key(media_type, TMDB_id, media), fragments,
+                                               version=fragment_cache.TEMPLATE_VERSION)
+
+    # cached fragments are as old as the snapshot they were rendered from, a refreshed one gets a new key
+    elif media:
+        refresh_stale_snapshot(media)
+
+    # precomputed from the media saved in the db, so no extra TMDB calls
+    more_like_this = similar_media.get_similar_media(media) if media else []
 
     # check if user is logged in in order to display playlists correctly 
     if "username" in session:
         user = crud.get_user_by_username(session["username"])
-        return render_template("media_information.html", data=data, TMDB_id=TMDB_id, user=user, media_type=media_type, all_ratings=all_ratings)
+
+        # the users own rating and the first page of their friends ratings to display on media page
+        if media:
+            user_rating = crud.user_rated(media, user)
+            friend_ratings, ratings_next = crud.get_friend_ratings_page(media.media_id, user)
+            media_state = get_media_state(media, user)
+        else:
+            user_rating = None
+            friend_ratings, ratings_next = [], None
+            media_state = None
+
+        return render_template("media_information.html", fragments=fragments, TMDB_id=TMDB_id, user=user, media_type=media_type,
+                               user_rating=user_rating, friend_ratings=friend_ratings, ratings_next=ratings_next,
+                               more_like_this=more_like_this, media_state=media_state)
 
     else:
-        return render_template("media_information.html", data=data, TMDB_id=TMDB_id, user=False, media_type=media_type, all_ratings=all_ratings)
+        return render_template("media_information.html", fragments=fragments, TMDB_id=TMDB_id, user=False, media_type=media_type,
+                               user_rating=None, friend_ratings=[], ratings_next=None, more_like_this=more_like_this,
+                               media_state=None)
+
+@app.route("/media-info/<media_type>/<TMDB_id>/ratings/page.json")
+def get_friend_ratings_page(media_type, TMDB_id):
+    """Gets the next page of friends ratings for the media page"""
+
+    user = crud.get_user_by_username(session["username"])
+    media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
+
+    # nobody has rated media that was never saved
+    if not media:
+        return jsonify({"error": "media not found"}), 404
+
+    ratings, next_after = crud.get_friend_ratings_page(media.media_id, user, after=request.args.get("after", type=int))
+
+    items = []
+    for rating in ratings:
+        items.append({"rating_id": rating.rating_id, "username": rating.user.username, "score": rating.score, "review_input": rating.review_input})
+
+    return jsonify({"items": items, "next_after": next_after})
  
-@app.route("/<media_type>/<TMDB_id>/add-to-playlist", methods=["POST"])
-def add_media_to_playlist(media_type, TMDB_id):
-    """Adds media to selected playlist"""
+def get_or_add_media(media_type, TMDB_id):
+    """Gets media from the db, adding it with its genres from TMDB if it isn't in there yet"""
+
     media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
-    playlist_id = request.form.get("playlist")
-    user_username = session["username"]
-    user = crud.get_user_by_username(user_username)
 
     # add media to database if not in there already
     if not media:
-        #get media information
-        url = f"https://api.themoviedb.org/3/{media_type}/{TMDB_id}"
-        payload = {"api_key": API_KEY} 
-
-        res = requests.get(url, params=payload)
-        data = res.json()
+        #get media information, raises TMDBUnavailable when it can't be added right now
+        data = tmdb.get(f"{media_type}/{TMDB_id}").json()
 
         # add media to db
         if media_type == "movie":
@@ -329,79 +653,48 @@ def add_media_to_playlist(media_type, TMDB_id):
                     media.genres.append(genre)
                     db.session.commit()
 
-    # add media to playlist
-    if playlist_id != "no":
-        playlist = crud.get_playlist_by_id(playlist_id, user)
-        media.playlists.append(playlist)
+        # a worker adds it to more like this, loading the index there instead of in a request
+        job_queue.enqueue("add_similar_media", {"media_id": media.media_id}, idempotency_key=f"add_similar_media:{media.media_id}")
         db.session.commit()
-        # flash(f"{media.title} successfully added to {playlist.name}")
-        return redirect (f"/media-info/{media_type}/{TMDB_id}")
-    # else:
-    #     flash("Please log in")
-
-@app.route("/media-info/<media_type>/<TMDB_id>/rating", methods=["POST"])
-def rate_media(media_type, TMDB_id):
-    """Adds rating: Sets score user inputs under ratings"""
-    
-    score = request.form.get("score")
-    comment = request.form.get("comment")
-    media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
-    time_watched = request.form.get("watch_time")
 
-    # add media to database if not in there already
-    if not media:
-        #get movie information
-        url = f"https://api.themoviedb.org/3/{media_type}/{TMDB_id}"
-        payload = {"api_key": API_KEY} 
+    return media
 
-        res = requests.get(url, params=payload)
-        data = res.json()
+def bump_data_version(user):
+    """Marks the users data as changed, and with a shared cache has a worker compute their new dashboard before they next look at it"""
 
-        # add media to db
-        if media_type == "movie":
-            media = crud.add_movie_to_db(data)
+    crud.bump_data_version(user)
+    # a dashboard the worker caches in its own memory is no use to the web processes
+    if get_backend().shared:
+        job_queue.enqueue("warm_dashboard", {"user_id": user.user_id}, delay=DASHBOARD_WARM_DELAY,
+                          idempotency_key=f"warm_dashboard:{user.user_id}:{datetime.now():%Y-%m-%d %H:%M}")
 
-        elif media_type == "tv":
-            media = crud.add_show_to_db(data)
-
-        db.session.add(media)
-        db.session.commit()
-
-        ### ADDING MEDIA GENRE INFORMATION ###
-        # add genres to media that do not exist:
-        if data["genres"]: 
-            genres = data["genres"]
-            for genre in genres:
-                # check if genre in genres:
-                if crud.check_if_genre_in_db(genre):
-                    # if yes: 
-                    genre = crud.check_if_genre_in_db(genre)
-                    media.genres.append(genre)
-                    db.session.commit()
-                else:
-                    # if not, add to genre:
-                    genre = crud.add_genre_to_db(genre)
-                    db.session.add(genre)
-                    media.genres.append(genre)
-                    db.session.commit()
+def set_time_watched(media, time_watched):
+    """Sets when the media was watched, today if no time was input"""
 
     # add time watched 
     if time_watched:
-        media.time_watched = time_watched
+        try:
+            watched_on = datetime.strptime(time_watched, "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            abort(400)
     else:
         # auto set time watched to day when added
-        media.time_watched = date.today()
-        db.session.commit()
+        watched_on = date.today()
 
-    # get user
-    user_username = session["username"]
-    user = crud.get_user_by_username(user_username)
+    crud.set_time_watched([media.media_id], watched_on)
+    db.session.commit()
+
+def save_rating(media, user, score, comment):
+    """Adds or updates the users rating of media, and moves it to their watched list"""
 
     # check if a score was input:
     if score:   
 
+        previous_rating = crud.user_rated(media, user)
+        previous_score = previous_rating.score if previous_rating else None
+
         # check if user has rated this media before:
-        if crud.user_rated(media, user):
+        if previous_rating:
 
             # update the score in db
             if comment: 
@@ -436,60 +729,196 @@ def rate_media(media_type, TMDB_id):
                 db.session.commit()
                 # flash(f"{media.title} has been added to your watched list")
 
-    return redirect(f"/media-info/{media_type}/{TMDB_id}")
+        bump_data_version(user)
+        # saving the same score again, or only a new comment, isn't news to followers or trending
+        score_changed = crud.user_rated(media, user).score != previous_score
+        if score_changed:
+            crud.add_activities(user, "rated", [media.media_id], score=score)
+            # a worker refreshes the users precomputed recommendations, at most once an hour
+            job_queue.enqueue("refresh_recommendations", {"user_id": user.user_id}, delay=RECOMMENDATIONS_REFRESH_DELAY,
+                              idempotency_key=f"refresh_recommendations:{user.user_id}:{datetime.now():%Y-%m-%d %H}")
+        db.session.commit()
+        if score_changed:
+            recommender.recommendation_cache.invalidate(user.user_id)
 
-@app.route("/<media_type>/<TMDB_id>/sort-folder", methods=["POST"])
-def add_media_to_folder(media_type, TMDB_id):
-    """Adds selected movie to watched or to be watched list"""
+def sort_into_folder(media, user, folder):
+    """Adds media to the users watched or to be watched list, taking it out of the other one, unless it's in that list already"""
 
-    folder = request.form.get("list")
-    media = crud.get_media_by_TMDB_id(TMDB_id, media_type)
-    time_watched = request.form.get("watch_time")
+    # sort into folder depending on value:
+    if folder == "watched":
+        
+        # check if user added to watched_list before:
+        if crud.user_sorted_Watched(media, user):
+            # flash(f"{media.title} is already in your Watched List")
+            return
+
+        # check if user added to to_be_watched_list before:
+        if crud.user_sorted_ToBeWatched(media, user):
+            # delete from to_be_watched_list
+            media_folder = crud.user_sorted_ToBeWatched(media, user)
+            db.session.delete(media_folder)
+            db.session.commit()
 
-    # add media to database if not in there already
-    if not media:
-        #get mmdia information
-        url = f"https://api.themoviedb.org/3/{media_type}/{TMDB_id}"
-        payload = {"api_key": API_KEY} 
+            # add to watched list
+            media_folder = crud.add_to_WatchedList(media, user)
+            db.session.add(media_folder)
+            db.session.commit()
+            # flash(f"{media.title} has been switched from your To Be Watched List to your Watched List")
 
-        res = requests.get(url, params=payload)
-        data = res.json()
+        else:
+            # add to watched list:
+            media_folder = crud.add_to_WatchedList(media, user)
+            db.session.add(media_folder)
+            db.session.commit()
+            # flash(f"{media.title} has been added to your Watched List")
 
-        # add media to db
-        if media_type == "movie":
-            media = crud.add_movie_to_db(data)
 
-        elif media_type == "tv":
-            media = crud.add_show_to_db(data)
+    elif folder == "to_be_watched":
+        # check if user added to to_be_watched_list before:
+        if crud.user_sorted_ToBeWatched(media, user):
+            # flash(f"{media.title} is already in your To Be Watched List")
+            return
 
-        db.session.add(media)
-        db.session.commit()
+        # check if user added to to_be_watched_list before:
+        if crud.user_sorted_Watched(media, user):
+            # delete from to be watched_list
+            media_folder = crud.user_sorted_Watched(media, user)
+            db.session.delete(media_folder)
+            db.session.commit()
 
-        ### ADDING MEDIA GENRE INFORMATION ###
-        # add genres to media that do not exist:
-        if data["genres"]: 
-            genres = data["genres"]
-            for genre in genres:
-                # check if genre in genres:
-                if crud.check_if_genre_in_db(genre):
-                    # if yes: 
-                    genre = crud.check_if_genre_in_db(genre)
-                    media.genres.append(genre)
-                    db.session.commit()
-                else:
-                    # if not, add to genre:
-                    genre = crud.add_genre_to_db(genre)
-                    db.session.add(genre)
-                    media.genres.append(genre)
-                    db.session.commit()
+            # add to to_be_watched list
+            media_folder = crud.add_to_ToBeWatchedList(media, user)
+            db.session.add(media_folder)
+            db.session.commit()
+            # flash(f"{media.title} has been switched from your Watched List to your To Be Watched List")
+
+        else:
+            # add to to_be_watched list:
+            media_folder = crud.add_to_ToBeWatchedList(media, user)
+            db.session.add(media_folder)
+            db.session.commit()
+            # flash(f"{media.title} has been added to your Watched List")
 
-    # add time watched 
-    if time_watched:
-        media.time_watched = time_watched
     else:
-        # auto set time watched to day when added
-        media.time_watched = date.today()
+        return
+
+    crud.add_activities(user, folder, [media.media_id])
+    bump_data_version(user)
+    db.session.commit()
+    # watched media are left out of the users recommendations
+    recommender.recommendation_cache.invalidate(user.user_id)
+
+def add_to_user_playlist(media, user, playlist_id):
+    """Adds media to one of the users playlists, if it isn't in it already"""
+
+    playlist = crud.get_playlist_by_id(playlist_id, user)
+
+    if playlist and not crud.get_media_ids_in_playlist(playlist, [media.media_id]):
+        media.playlists.append(playlist)
+        crud.add_activities(user, "added_to_playlist", [media.media_id], playlist=playlist)
+        bump_data_version(user)
         db.session.commit()
+        # flash(f"{media.title} successfully added to {playlist.name}")
+
+def get_media_state(media, user):
+    """The users rating, lists and playlists for media, what the media page shows about the user"""
+
+    rating = crud.user_rated(media, user)
+
+    return {
+        "media_id": media.media_id,
+        "rating": {"rating_id": rating.rating_id, "score": rating.score, "review_input": rating.review_input} if rating else None,
+        "lists": {"watched": bool(crud.user_sorted_Watched(media, user)), "to_be_watched": bool(crud.user_sorted_ToBeWatched(media, user))},
+        "playlists": [{"playlist_id": playlist.playlist_id, "name": playlist.name} for playlist in crud.get_user_playlists_with_media(media, user)],
+    }
+
+@app.route("/<media_type>/<TMDB_id>/add-to-playlist", methods=["POST"])
+def add_media_to_playlist(media_type, TMDB_id):
+    """Adds media to selected playlist"""
+    playlist_id = request.form.get("playlist")
+    user_username = session["username"]
+    user = crud.get_user_by_username(user_username)
+    media = get_or_add_media(media_type, TMDB_id)
+
+    # add media to playlist
+    if playlist_id != "no":
+        add_to_user_playlist(media, user, playlist_id)
+
+    return redirect (f"/media-info/{media_type}/{TMDB_id}")
+
+def is_media_path(media_type, TMDB_id):
+    """Whether the url can name a TMDB media at all, checked before it's looked up or fetched"""
+
+    return media_type in autocomplete.MEDIA_TYPES and TMDB_id.isdecimal()
+
+@app.route("/<media_type>/<TMDB_id>/add-to-playlist.json", methods=["POST"])
+def add_media_to_playlist_json(media_type, TMDB_id):
+    """Adds media to selected playlist, returns the users state for the media instead of reloading the page"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to change your playlists"}), 401
+    if not is_media_path(media_type, TMDB_id):
+        return jsonify({"error": "media not found"}), 404
+
+    # the page sends the id as a string
+    playlist_id = get_request_json().get("playlistID")
+    if not str(playlist_id).isdecimal():
+        return jsonify({"error": "playlistID must be a playlist id"}), 400
+
+    user = crud.get_user_by_username(session["username"])
+    media = get_or_add_media(media_type, TMDB_id)
+    add_to_user_playlist(media, user, int(playlist_id))
+
+    return jsonify(get_media_state(media, user))
+
+@app.route("/media-info/<media_type>/<TMDB_id>/rating", methods=["POST"])
+def rate_media(media_type, TMDB_id):
+    """Adds rating: Sets score user inputs under ratings"""
+    
+    score = request.form.get("score")
+    comment = request.form.get("comment")
+    time_watched = request.form.get("watch_time")
+    media = get_or_add_media(media_type, TMDB_id)
+    set_time_watched(media, time_watched)
+
+    # get user
+    user_username = session["username"]
+    user = crud.get_user_by_username(user_username)
+    save_rating(media, user, score, comment)
+
+    return redirect(f"/media-info/{media_type}/{TMDB_id}")
+
+@app.route("/media-info/<media_type>/<TMDB_id>/rating.json", methods=["POST"])
+def rate_media_json(media_type, TMDB_id):
+    """Adds or updates a rating, returns the users state for the media instead of reloading the page"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to rate media"}), 401
+    if not is_media_path(media_type, TMDB_id):
+        return jsonify({"error": "media not found"}), 404
+
+    data = get_request_json()
+    # the page sends the score as a string
+    if str(data.get("score")) not in ("1", "2", "3", "4", "5"):
+        return jsonify({"error": "score must be 1 to 5"}), 400
+    if not isinstance(data.get("comment", ""), (str, type(None))):
+        return jsonify({"error": "comment must be text"}), 400
+
+    user = crud.get_user_by_username(session["username"])
+    media = get_or_add_media(media_type, TMDB_id)
+    set_time_watched(media, data.get("watchTime"))
+    save_rating(media, user, int(data["score"]), data.get("comment"))
+
+    return jsonify(get_media_state(media, user))
+
+@app.route("/<media_type>/<TMDB_id>/sort-folder", methods=["POST"])
+def add_media_to_folder(media_type, TMDB_id):
+    """Adds selected movie to watched or to be watched list"""
+
+    folder = request.form.get("list")
+    time_watched = request.form.get("watch_time")
+    media = get_or_add_media(media_type, TMDB_id)
+    set_time_watched(media, time_watched)
         
     # check if folder was selected:
     if folder:
@@ -497,68 +926,69 @@ def add_media_to_folder(media_type, TMDB_id):
         if "username" in session:
             user_username = session["username"]
             user = crud.get_user_by_username(user_username)
+            sort_into_folder(media, user, folder)
 
-            # sort into folder depending on value:
-            if folder == "watched":
-                
-                # check if user added to watched_list before:
-                # if crud.user_sorted_Watched(media, user):
-                #     flash(f"{media.title} is already in your Watched List")
-
-                # check if user added to to_be_watched_list before:
-                if crud.user_sorted_ToBeWatched(media, user):
-                    # delete from to_be_watched_list
-                    media_folder = crud.user_sorted_ToBeWatched(media, user)
-                    db.session.delete(media_folder)
-                    db.session.commit()
+        # else:
+        #     flash("Sorry, only logged in users can add movies to folders")
 
-                    # add to watched list
-                    media_folder = crud.add_to_WatchedList(media, user)
-                    db.session.add(media_folder)
-                    db.session.commit()
-                    # flash(f"{media.title} has been switched from your To Be Watched List to your Watched List")
+    # else:
+    #     flash("Sorry, it seems no folder was selected.")
 
-                else:
-                    # add to watched list:
-                    media_folder = crud.add_to_WatchedList(media, user)
-                    db.session.add(media_folder)
-                    db.session.commit()
-                    # flash(f"{media.title} has been added to your Watched List")
+    return redirect(f"/media-info/{media_type}/{TMDB_id}")
 
+@app.route("/<media_type>/<TMDB_id>/sort-folder.json", methods=["POST"])
+def add_media_to_folder_json(media_type, TMDB_id):
+    """Adds media to the watched or to be watched list, returns the users state for the media instead of reloading the page"""
 
-            elif folder == "to_be_watched":
-                # check if user added to to_be_watched_list before:
-                # if crud.user_sorted_ToBeWatched(media, user):
-                    # flash(f"{media.title} is already in your To Be Watched List")
+    if "username" not in session:
+        return jsonify({"error": "log in to change your lists"}), 401
+    if not is_media_path(media_type, TMDB_id):
+        return jsonify({"error": "media not found"}), 404
 
-                # check if user added to to_be_watched_list before:
-                if crud.user_sorted_Watched(media, user):
-                    # flash(f"{media.title} is already in your To Be Watched List")
-                    # delete from to be watched_list
-                    media_folder = crud.user_sorted_Watched(media, user)
-                    db.session.delete(media_folder)
-                    db.session.commit()
+    user = crud.get_user_by_username(session["username"])
+    folder = get_request_json().get("list")
 
-                    # add to to_be_watched list
-                    media_folder = crud.add_to_ToBeWatchedList(media, user)
-                    db.session.add(media_folder)
-                    db.session.commit()
-                    # flash(f"{media.title} has been switched from your Watched List to your To Be Watched List")
+    if folder not in crud.LIST_MODELS:
+        return jsonify({"error": "list must be 'watched' or 'to_be_watched'"}), 400
 
-                else:
-                    # add to to_be_watched list:
-                    media_folder = crud.add_to_ToBeWatchedList(media, user)
-                    db.session.add(media_folder)
-                    db.session.commit()
-                    # flash(f"{media.title} has been added to your Watched List")
+    media = get_or_add_media(media_type, TMDB_id)
+    set_time_watched(media, get_request_json().get("watchTime"))
+    sort_into_folder(media, user, folder)
 
-        # else:
-        #     flash("Sorry, only logged in users can add movies to folders")
+    return jsonify(get_media_state(media, user))
 
-    # else:
-    #     flash("Sorry, it seems no folder was selected.")
+#### CONDITIONAL GETS #####
 
-    return redirect(f"/media-info/{media_type}/{TMDB_id}")
+def user_data_etag(user):
+    """Changes whenever the users lists, ratings or playlists do, or when the media they watched were watched"""
+
+    return f"user-{user.user_id}-v{user.data_version}"
+
+def user_data_not_modified(user):
+    """A 304 if the client already has this version of the users data, so nothing has to be queried, otherwise None"""
+
+    # the etag wins when the client sends both
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(user_data_etag(user))
+    elif request.if_modified_since and user.data_modified_at:
+        not_modified = user.data_modified_at.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        return add_user_data_validators(app.response_class(status=304), user)
+
+def add_user_data_validators(response, user):
+    """Adds the etag and last modified of the users data to a json response"""
+
+    response.set_etag(user_data_etag(user))
+    if user.data_modified_at:
+        response.last_modified = user.data_modified_at.replace(tzinfo=timezone.utc)
+    # only the users own browser may keep it, and has to check with us before using it
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+
+    return response
 
 @app.route("/user-profile/genres.json")
 def get_users_genres():
@@ -568,6 +998,10 @@ def get_users_genres():
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
 
+    not_modified = user_data_not_modified(user)
+    if not_modified:
+        return not_modified
+
     # get users genres:
     user_genres = crud.get_user_genres(user)
     
@@ -576,7 +1010,7 @@ def get_users_genres():
     for genre, total in user_genres.items():
         genres.append({'genre': genre.genre_name,'number_of_genre': total})
 
-    return jsonify({"data": genres})
+    return add_user_data_validators(jsonify({"data": genres}), user)
 
 @app.route("/user-profile/watch_history.json")
 def get_users_watch_history():
@@ -586,6 +1020,10 @@ def get_users_watch_history():
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
 
+    not_modified = user_data_not_modified(user)
+    if not_modified:
+        return not_modified
+
     # get users watch history
     user_movie_watch_history = crud.get_user_movie_watch_history(user)
     user_show_watch_history = crud.get_user_show_watch_history(user)
@@ -603,7 +1041,55 @@ def get_users_watch_history():
     for month, total in user_show_watch_history.items():
         show_history.append({'month': month,'number_of_shows': total})
 
-    return jsonify({"moviedata": movie_history, "showdata": show_history})
+    return add_user_data_validators(jsonify({"moviedata": movie_history, "showdata": show_history}), user)
+
+@app.route("/user-profile/dashboard.json")
+def get_users_dashboard():
+    """Gets the data for every chart on the users profile in one request"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to see your profile"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+
+    not_modified = user_data_not_modified(user)
+    if not_modified:
+        return not_modified
+
+    dashboard = crud.get_user_dashboard(user)
+
+    return add_user_data_validators(jsonify({
+        "genres": [{"genre": genre, "number_of_genre": total} for genre, total in dashboard["genres"]],
+        "moviedata": [{"month": month, "number_of_movies": total} for month, total in dashboard["movie_history"]],
+        "showdata": [{"month": month, "number_of_shows": total} for month, total in dashboard["show_history"]],
+        "totals": dashboard["totals"],
+    }), user)
+
+# TMDB responses that are the same for everyone, like the days trending media
+tmdb_cache = Cache("tmdb", ttl=TMDB_CACHE_SECONDS)
+# the last good copy of each, kept much longer for when TMDB is down
+tmdb_stale_cache = Cache("tmdb_stale", ttl=TMDB_STALE_SECONDS)
+
+def get_tmdb_json(path):
+    """GETs from the TMDB api, successful responses are cached for every worker.
+    When TMDB can't be reached it's the last good response, or no results if there isn't one."""
+
+    def fetch():
+        res = tmdb.get(path)
+        res.raise_for_status()
+        data = res.json()
+        tmdb_stale_cache.set(path, data)
+        return data
+
+    try:
+        return tmdb_cache.get_or_set(path, fetch)
+    except (tmdb.TMDBUnavailable, requests.HTTPError):
+        return tmdb_stale_cache.get(path, default={"results": []})
+
+def recommendation_result(recommendation):
+    """A stored recommendation in the shape of a TMDB result, for recommended.html"""
+
+    return {"id": recommendation.TMDB_id, "original_title": recommendation.title, "name": recommendation.title, "poster_path": recommendation.poster_path}
 
 @app.route("/recommended")
 def display_recommended_media():
@@ -613,31 +1099,32 @@ def display_recommended_media():
         user_username = session["username"]
         user = crud.get_user_by_username(user_username)
 
-        # get last things added to watched list
-        last_movie = crud.get_last_movie_added_to_watched_list(user)
-        last_show = crud.get_last_show_added_to_watched_list(user)
+        # precomputed by recommendation_job.py from several of the users media
+        movie_recommendations = crud.get_user_recommendations(user, "movie")
+        show_recommendations = crud.get_user_recommendations(user, "tv")
 
-        #get movie recommended
-        if last_movie != False:
-            url = f"https://api.themoviedb.org/3/movie/{last_movie.TMDB_id}/recommendations"
+        precomputed = bool(movie_recommendations or show_recommendations)
 
-            payload = {"api_key": API_KEY} 
+        # until the job has run for this user, get last things added to watched list
+        if not precomputed:
+            last_movie = crud.get_last_movie_added_to_watched_list(user)
+            last_show = crud.get_last_show_added_to_watched_list(user)
 
-            movie_res = requests.get(url, params=payload)
-            movie_data = movie_res.json()
+        #get movie recommended
+        if precomputed:
+            movie_results = [recommendation_result(recommendation) for recommendation in movie_recommendations]
+        elif last_movie != False:
+            movie_data = get_tmdb_json(f"movie/{last_movie.TMDB_id}/recommendations")
             movie_results=movie_data["results"]
         else:
             movie_data = None
             movie_results = None
 
         #get show recommended
-        if last_show != False:
-            url = f"https://api.themoviedb.org/3/tv/{last_show.TMDB_id}/recommendations"
-
-            payload = {"api_key": API_KEY} 
-
-            show_res = requests.get(url, params=payload)
-            show_data = show_res.json()
+        if precomputed:
+            show_results = [recommendation_result(recommendation) for recommendation in show_recommendations]
+        elif last_show != False:
+            show_data = get_tmdb_json(f"tv/{last_show.TMDB_id}/recommendations")
             show_results = show_data["results"]
 
         else:
@@ -645,50 +1132,52 @@ def display_recommended_media():
             show_results = None
 
         # get trending movies: 
-        url = f"https://api.themoviedb.org/3/trending/movie/day"
-
-        payload = {"api_key": API_KEY} 
-
-        trending_movie_res = requests.get(url, params=payload)
-        trending_movie_data = trending_movie_res.json()
+        trending_movie_data = get_tmdb_json("trending/movie/day")
         trending_movie_results = trending_movie_data["results"]
 
         # get trending shows: 
-        url = f"https://api.themoviedb.org/3/trending/tv/day"
-
-        payload = {"api_key": API_KEY} 
-
-        trending_show_res = requests.get(url, params=payload)
-        trending_show_data = trending_show_res.json()
+        trending_show_data = get_tmdb_json("trending/tv/day")
         trending_show_results = trending_show_data["results"]
 
-        return render_template("/recommended.html", user=user, movie_results=movie_results, show_results=show_results, trending_movie_results=trending_movie_results,trending_show_results=trending_show_results)
+        # from what people who rated the same media also liked
+        rated_recommendations = recommender.get_recommendations(user)
+
+        return render_template("/recommended.html", user=user, movie_results=movie_results, show_results=show_results, trending_movie_results=trending_movie_results,trending_show_results=trending_show_results, rated_recommendations=rated_recommendations,
+                               local_trending=trending.get_trending("day"))
 
     else:
         # get trending movies: 
-        url = f"https://api.themoviedb.org/3/trending/movie/day"
-
-        payload = {"api_key": API_KEY} 
-
-        trending_movie_res = requests.get(url, params=payload)
-        trending_movie_data = trending_movie_res.json()
+        trending_movie_data = get_tmdb_json("trending/movie/day")
         trending_movie_results = trending_movie_data["results"]
 
         # get trending shows: 
-        url = f"https://api.themoviedb.org/3/trending/tv/day"
-
-        payload = {"api_key": API_KEY} 
-
-        trending_show_res = requests.get(url, params=payload)
-        trending_show_data = trending_show_res.json()
+        trending_show_data = get_tmdb_json("trending/tv/day")
         trending_show_results = trending_show_data["results"]
 
-        return render_template("/recommended.html", user=None, movie_results=None, show_results=None, trending_movie_results=trending_movie_results,trending_show_results=trending_show_results)
+        return render_template("/recommended.html", user=None, movie_results=None, show_results=None, trending_movie_results=trending_movie_results,trending_show_results=trending_show_results, rated_recommendations=None,
+                               local_trending=trending.get_trending("day"))
         # flash("Sorry, please log in:")
 
         # return redirect("/")
 
 
+@app.route("/trending.json")
+def get_local_trending_json():
+    """Returns what is trending on MyViews in the last hour, day or week"""
+
+    window = request.args.get("window", "day")
+    media_type = request.args.get("media_type")
+
+    if window not in trending.WINDOWS:
+        return jsonify({"error": "window must be 'hour', 'day' or 'week'"}), 400
+
+    items = []
+    for media, score in trending.get_trending(window, media_type):
+        items.append({"media_id": media.media_id, "media_type": media.media_type, "TMDB_id": media.TMDB_id,
+                      "title": media.title, "poster_path": media.poster_path, "score": round(score, 3)})
+
+    return jsonify({"window": window, "items": items})
+
 @app.route("/create-playlist", methods=["POST"])
 def creates_playlist_for_user():
     """Adds a playlist for user to store movies in"""
@@ -700,6 +1189,7 @@ def creates_playlist_for_user():
     if playlist_name: 
         playlist = crud.create_playlist(playlist_name, user)
         db.session.add(playlist)
+        bump_data_version(user)
         db.session.commit()
         # flash(f"The playlist '{playlist_name}' has successfully been created")
 
@@ -717,7 +1207,9 @@ def deletes_rating_for_user_media_page():
     if rating_id:
         rating = crud.get_rating_by_id(rating_id, user)
         db.session.delete(rating)
+        bump_data_version(user)
         db.session.commit()
+        recommender.recommendation_cache.invalidate(user.user_id)
 
     return jsonify({"success": "The rating has successfully been deleted"})
 
@@ -731,7 +1223,9 @@ def remove_media_from_watchedlist():
     if media_id:
         media = crud.get_watchlist_media_by_id(media_id, user)
         db.session.delete(media)
+        bump_data_version(user)
         db.session.commit()
+        recommender.recommendation_cache.invalidate(user.user_id)
         # flash(f"Removed from watched list")
 
     return jsonify({"success": "Removed from watched list"})
@@ -746,19 +1240,68 @@ def remove_media_from_tobe_watchedlist():
     if media_id:
         media = crud.get_tobewatchlist_media_by_id(media_id, user)
         db.session.delete(media)
+        bump_data_version(user)
         db.session.commit()
         # flash(f"Removed from to be watched list")
 
     return jsonify({"success": "Removed from to be watched list"})
 
+def media_page_json(medias, ratings, next_after):
+    """Returns a page of media (with the list owners score) as json for infinite scrolling"""
+
+    items = []
+
+    for media in medias:
+        rating = ratings.get(media.media_id)
+        items.append({
+            "media_id": media.media_id,
+            "media_type": media.media_type,
+            "TMDB_id": media.TMDB_id,
+            "title": media.title,
+            "poster_path": media.poster_path,
+            "rating_id": rating.rating_id if rating else None,
+            "score": rating.score if rating else None,
+        })
+
+    return jsonify({"items": items, "next_after": next_after})
+
 @app.route("/user-profile/edit-playlist/<playlist_id>")
 def edit_playlist(playlist_id):
 
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
     playlist = crud.get_playlist_by_id(playlist_id, user)
+    if not playlist:
+        abort(404)
+
+    medias, next_after = crud.get_playlist_page(playlist)
+    ratings = crud.get_user_ratings_for_medias(user, medias)
     
-    return render_template("/individual_playlist.html", playlist=playlist, user=user)
+    return render_template("/individual_playlist.html", playlist=playlist, user=user, medias=medias, ratings=ratings, next_after=next_after)
+
+@app.route("/user-profile/edit-playlist/<playlist_id>/page.json")
+def get_playlist_page(playlist_id):
+    """Gets the next page of a playlist"""
+
+    user = crud.get_user_by_username(session["username"])
+
+    not_modified = user_data_not_modified(user)
+    if not_modified:
+        return not_modified
+
+    playlist = crud.get_playlist_by_id(playlist_id, user)
+    if not playlist:
+        return jsonify({"error": "playlist not found"}), 404
+
+    medias, next_after = crud.get_playlist_page(playlist, after=request.args.get("after", type=int))
+
+    return add_user_data_validators(media_page_json(medias, crud.get_user_ratings_for_medias(user, medias), next_after), user)
+
+# the edit list urls use "tobewatched" for the to be watched list
+EDIT_LISTS = {
+    "watched": (crud.WatchedList, "Watched List"),
+    "tobewatched": (crud.ToBeWatchedList, "To Be Watched List"),
+}
 
 @app.route("/user-profile/edit-list/<lst>")
 def edit_list(lst):
@@ -766,13 +1309,31 @@ def edit_list(lst):
     user_username = session["username"]
     user = crud.get_user_by_username(user_username)
 
-    if lst == "watched":
-        watched = user.watched_list
-        return render_template("/individual_lists.html", lst=watched, name="Watched List", type="watched", user=user)
+    if lst not in EDIT_LISTS:
+        abort(404)
+
+    list_model, name = EDIT_LISTS[lst]
+    medias, next_after = crud.get_list_page(list_model, user)
+    ratings = crud.get_user_ratings_for_medias(user, medias)
+    return render_template("/individual_lists.html", lst=medias, name=name, type=lst, user=user, ratings=ratings, next_after=next_after)
+
+@app.route("/user-profile/edit-list/<lst>/page.json")
+def get_list_page(lst):
+    """Gets the next page of the users watched or to be watched list"""
+
+    if lst not in EDIT_LISTS:
+        return jsonify({"error": "list must be 'watched' or 'tobewatched'"}), 404
+
+    user = crud.get_user_by_username(session["username"])
+
+    not_modified = user_data_not_modified(user)
+    if not_modified:
+        return not_modified
+
+    list_model, name = EDIT_LISTS[lst]
+    medias, next_after = crud.get_list_page(list_model, user, after=request.args.get("after", type=int))
 
-    elif lst == "tobewatched":
-        to_be_watched = user.to_be_watched_list
-        return render_template("/individual_lists.html", lst=to_be_watched, name="To Be Watched List", type="tobewatched", user=user)
+    return add_user_data_validators(media_page_json(medias, crud.get_user_ratings_for_medias(user, medias), next_after), user)
     
 @app.route("/delete-playlist", methods=["POST"])
 def deletes_playlist():
@@ -784,6 +1345,7 @@ def deletes_playlist():
     if playlist_id:
         playlist = crud.get_playlist_by_id(playlist_id, user)
         db.session.delete(playlist)
+        bump_data_version(user)
         db.session.commit()
         # flash(f"The playlist '{playlist.name}' has successfully been deleted")
 
@@ -803,10 +1365,184 @@ def remove_media_from_playlist():
     if media_id:
         media = crud.get_media_by_id(media_id)
         media.playlists.remove(playlist)
+        bump_data_version(user)
         db.session.commit()
 
     return jsonify({"success": "Removed from to be watched list"})
 
+#### BULK LIST CHANGES #####
+
+MAX_BULK_MEDIA = 500
+
+def get_request_json():
+    """The request body when it's a json object, otherwise {} so the checks on its fields turn it down"""
+
+    data = request.get_json(silent=True)
+
+    return data if isinstance(data, dict) else {}
+
+def get_bulk_media_ids():
+    """Gets the list of mediaIDs from the request json without duplicates, returns (media_ids, error)
+    with an error for the whole batch if it's too big or any id isn't a whole number, so none are skipped quietly"""
+
+    raw_ids = get_request_json().get("mediaIDs") or []
+
+    if not isinstance(raw_ids, list):
+        return [], "mediaIDs must be a list"
+    if len(raw_ids) > MAX_BULK_MEDIA:
+        return [], f"at most {MAX_BULK_MEDIA} mediaIDs at a time"
+
+    media_ids = []
+
+    for media_id in raw_ids:
+        # json true would otherwise count as media 1
+        # isdecimal, since isdigit lets through digits like "²" that int() can't parse
+        if isinstance(media_id, bool) or not str(media_id).isdecimal():
+            return [], f"mediaIDs must be whole numbers, got {media_id!r}"
+        media_id = int(media_id)
+        if media_id not in media_ids:
+            media_ids.append(media_id)
+
+    return media_ids, None
+
+def get_bulk_playlist(user):
+    """The users playlist named in the request body, None if the id isn't one of theirs"""
+
+    # the page sends the id as a string
+    playlist_id = get_request_json().get("playlistID")
+
+    return crud.get_playlist_by_id(int(playlist_id), user) if str(playlist_id).isdecimal() else None
+
+def get_bulk_watch_time():
+    """Gets the watchTime from the request json as a date, today if there isn't one, returns (date, error)"""
+
+    watch_time = get_request_json().get("watchTime")
+    if not watch_time:
+        return date.today(), None
+
+    try:
+        return datetime.strptime(watch_time, "%Y-%m-%d").date(), None
+    except (TypeError, ValueError):
+        return None, "watchTime must be a date like 2022-12-31"
+
+@app.route("/user-profile/bulk-sort-folder.json", methods=["POST"])
+def bulk_sort_media_into_folder():
+    """Moves many media into the watched or to be watched list in one transaction"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to change your lists"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    folder = get_request_json().get("list")
+    media_ids, error = get_bulk_media_ids()
+    time_watched, time_error = get_bulk_watch_time()
+
+    if folder not in crud.LIST_MODELS:
+        return jsonify({"error": "list must be 'watched' or 'to_be_watched'"}), 400
+    if error or time_error:
+        return jsonify({"error": error or time_error}), 400
+
+    results = crud.bulk_sort_into_folder(media_ids, user, folder, time_watched)
+    crud.add_activities(user, folder, [result["media_id"] for result in results if result["status"] in ("added", "moved")])
+    bump_data_version(user)
+    db.session.commit()
+    recommender.recommendation_cache.invalidate(user.user_id)
+
+    return jsonify({"results": results})
+
+@app.route("/user-profile/bulk-delete-from-list.json", methods=["POST"])
+def bulk_remove_media_from_list():
+    """Removes many media from the watched or to be watched list in one transaction"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to change your lists"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    folder = get_request_json().get("list")
+    media_ids, error = get_bulk_media_ids()
+
+    if folder not in crud.LIST_MODELS:
+        return jsonify({"error": "list must be 'watched' or 'to_be_watched'"}), 400
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = crud.bulk_delete_from_list(media_ids, user, folder)
+    bump_data_version(user)
+    db.session.commit()
+    if folder == "watched":
+        recommender.recommendation_cache.invalidate(user.user_id)
+
+    return jsonify({"results": results})
+
+@app.route("/user-profile/bulk-add-to-playlist.json", methods=["POST"])
+def bulk_add_media_to_playlist():
+    """Adds many media to a playlist in one transaction"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to change your lists"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    playlist = get_bulk_playlist(user)
+    media_ids, error = get_bulk_media_ids()
+
+    if not playlist:
+        return jsonify({"error": "playlist not found"}), 404
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = crud.bulk_add_to_playlist(media_ids, playlist)
+    crud.add_activities(user, "added_to_playlist", [result["media_id"] for result in results if result["status"] == "added"], playlist=playlist)
+    bump_data_version(user)
+    db.session.commit()
+
+    return jsonify({"results": results})
+
+@app.route("/user-profile/bulk-delete-from-playlist.json", methods=["POST"])
+def bulk_remove_media_from_playlist():
+    """Removes many media from a playlist in one transaction"""
+
+    if "username" not in session:
+        return jsonify({"error": "log in to change your lists"}), 401
+
+    user = crud.get_user_by_username(session["username"])
+    playlist = get_bulk_playlist(user)
+    media_ids, error = get_bulk_media_ids()
+
+    if not playlist:
+        return jsonify({"error": "playlist not found"}), 404
+    if error:
+        return jsonify({"error": error}), 400
+
+    results = crud.bulk_delete_from_playlist(media_ids, playlist)
+    bump_data_version(user)
+    db.session.commit()
+
+    return jsonify({"results": results})
+
+# only the app's own host, or monitoring sending this token in an X-Metrics-Token header, can see metrics
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+def is_internal_request():
+    """Whether the request comes from the machine itself or carries the metrics token"""
+
+    if METRICS_TOKEN and hmac.compare_digest(request.headers.get("X-Metrics-Token", ""), METRICS_TOKEN):
+        return True
+
+    return request.remote_addr in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+
+@app.route("/metrics/db-pool.json")
+def get_db_pool_metrics():
+    """Shows connection pool checkout wait times and in use counts, for the primary and the replica"""
+
+    if not is_internal_request():
+        return jsonify({"error": "not found"}), 404
+
+    pools = {"primary": db.engine.pool}
+    if "replica" in pool_metrics:
+        pools["replica"] = db.get_engine(bind="replica").pool
+
+    return jsonify({name: pool_metrics[name].to_dict(pool) for name, pool in pools.items() if name in pool_metrics})
+
 if __name__ == "__main__":
     connect_to_db(app)  
 
@@ -815,6 +1551,8 @@ if __name__ == "__main__":
 
     with app.app_context():
         db.create_all()
+        # built in the background, so the first searches don't wait on it
+        autocomplete.title_index.ensure_loaded()
 
     # app.run(host="0.0.0.0", debug=True)
     app.run()
\ No newline at end of file
@@ -0,0 +1,341 @@
+"""Content based "more like this": TF-IDF over titles and overviews, plus shared genres."""
+
+from array import array
+from collections import Counter, defaultdict
+import heapq
+import math
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+from sqlalchemy import select, tuple_, or_
+from sqlalchemy.orm import joinedload
+
+from model import db, connect_to_db, Media, MediaGenre, SimilarMedia
+from ann_index import IvfIndex, benchmark
+
+SIMILAR_PER_MEDIA = 12
+TEXT_WEIGHT = 0.7
+GENRE_WEIGHT = 0.3
+# words in more than this share of overviews say nothing about a media, and
+# would make every media a candidate for every other (once there are enough media to tell)
+MAX_DOCUMENT_FREQUENCY = 0.2
+MIN_POSTINGS_CUTOFF = 50
+# media without an overview only have their genres to go on
+MAX_GENRE_CANDIDATES = 500
+# each job worker adds the media saved by other workers to its index this often
+INDEX_TTL_SECONDS = 3600
+INSERT_BATCH_SIZE = 5000
+
+# past this many media, candidates come from the approximate nearest neighbor index
+# instead of the inverted lists, and are then scored exactly
+ANN_MIN_MEDIA = 5000
+ANN_CANDIDATES = 100
+# size of the dense vectors the sparse ones are hashed down to for the ann index
+ANN_DIMENSIONS = 64
+ANN_INDEX_PATH = os.environ.get("MEDIA_ANN_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_ann.idx"))
+
+STOP_WORDS = {
+    "the", "and", "for", "with", "his", "her", "their", "from", "that", "this", "who", "when",
+    "into", "after", "but", "they", "she", "him", "are", "was", "has", "have", "its", "all",
+    "out", "one", "two", "new", "will", "them", "while", "where", "what", "which", "about",
+}
+
+def tokenize(text):
+    """Splits text into lowercase words, leaving out short and common ones"""
+
+    return [word for word in re.findall(r"[a-z0-9']+", (text or "").lower()) if len(word) > 2 and word not in STOP_WORDS]
+
+
+class ContentIndex:
+    """Sparse TF-IDF vectors and genre sets for every media, with inverted lists to find candidates"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.clear()
+
+    def clear(self):
+        self.loaded_at = None
+        self.terms = {}
+        self.words = []
+        self.document_count = 0
+        self.document_frequency = Counter()
+        # media_id: (term ids, float32 weights) normalized to length 1
+        self.vectors = {}
+        self.genres = {}
+        self.postings = defaultdict(dict)
+        self.genre_postings = defaultdict(set)
+
+    def idf(self, term_id):
+        # 0 for words every media has
+        return math.log((1 + self.document_count) / (1 + self.document_frequency[term_id]))
+
+    def term_counts(self, title, overview):
+        counts = Counter()
+        for word in tokenize(title) + tokenize(overview):
+            if word not in self.terms:
+                self.terms[word] = len(self.words)
+                self.words.append(word)
+            counts[self.terms[word]] += 1
+        return counts
+
+    def vectorize(self, counts):
+        """Sublinear tf times idf, normalized"""
+
+        weights = {term_id: (1 + math.log(count)) * self.idf(term_id) for term_id, count in counts.items()}
+        weights = {term_id: weight for term_id, weight in weights.items() if weight > 0}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1
+
+        return array("i", weights), array("f", [weight / norm for weight in weights.values()])
+
+    def index(self, media_id, counts, genre_ids):
+        term_ids, weights = self.vectorize(counts)
+        self.vectors[media_id] = (term_ids, weights)
+        self.genres[media_id] = frozenset(genre_ids)
+
+        for term_id, weight in zip(term_ids, weights):
+            self.postings[term_id][media_id] = weight
+        for genre_id in genre_ids:
+            self.genre_postings[genre_id].add(media_id)
+
+    def add(self, media_id, counts, genre_ids):
+        """Adds one media's vector, the weights of media already in the index are left as they are"""
+
+        self.document_count += 1
+        self.document_frequency.update(counts.keys())
+        self.index(media_id, counts, genre_ids)
+
+    def load(self):
+        """Builds the index from every media in the db"""
+
+        self.clear()
+
+        genres = defaultdict(list)
+        for media_id, genre_id in db.session.execute(select(MediaGenre.media_id, MediaGenre.genre_id)):
+            genres[media_id].append(genre_id)
+
+        counts = {media_id: self.term_counts(title, overview)
+                  for media_id, title, overview in db.session.execute(select(Media.media_id, Media.title, Media.overview))}
+
+        # document frequencies first, so every vector uses the same idf
+        self.document_count = len(counts)
+        for media_counts in counts.values():
+            self.document_frequency.update(media_counts.keys())
+        for media_id, media_counts in counts.items():
+            self.index(media_id, media_counts, genres[media_id])
+
+        self.loaded_at = time.monotonic()
+
+    def catch_up(self):
+        """Adds the media saved since the index was loaded, returns their media_ids"""
+
+        # every id, not just higher ones, since ids can be committed out of order
+        new_ids = [media_id for media_id in db.session.execute(select(Media.media_id)).scalars() if media_id not in self.vectors]
+
+        for start in range(0, len(new_ids), INSERT_BATCH_SIZE):
+            batch = new_ids[start:start + INSERT_BATCH_SIZE]
+            genres = defaultdict(list)
+            for media_id, genre_id in db.session.execute(select(MediaGenre.media_id, MediaGenre.genre_id).where(MediaGenre.media_id.in_(batch))):
+                genres[media_id].append(genre_id)
+            for media_id, title, overview in db.session.execute(select(Media.media_id, Media.title, Media.overview).where(Media.media_id.in_(batch))):
+                self.add(media_id, self.term_counts(title, overview), genres[media_id])
+
+        self.loaded_at = time.monotonic()
+
+        return new_ids
+
+    def dense_vector(self, media_id):
+        """Hashes the sparse text vector and genres down to ANN_DIMENSIONS, keeping dot products
+        close to the blended similarity (words hash by text, so vectors outlive a reload)"""
+
+        dense = [0.0] * ANN_DIMENSIONS
+        features = []
+
+        term_ids, weights = self.vectors[media_id]
+        for term_id, weight in zip(term_ids, weights):
+            features.append((self.words[term_id], math.sqrt(TEXT_WEIGHT) * weight))
+        genres = self.genres[media_id]
+        for genre_id in genres:
+            features.append((f"genre {genre_id}", math.sqrt(GENRE_WEIGHT / len(genres))))
+
+        for feature, weight in features:
+            feature_hash = zlib.crc32(feature.encode())
+            dense[feature_hash % ANN_DIMENSIONS] += weight if feature_hash & 0x80000000 else -weight
+
+        return array("f", dense)
+
+    def text_candidates(self, media_id):
+        """Sparse dot product with every media sharing a word, through the inverted lists"""
+
+        term_ids, weights = self.vectors[media_id]
+        max_postings = max(MIN_POSTINGS_CUTOFF, MAX_DOCUMENT_FREQUENCY * len(self.vectors))
+
+        text_scores = defaultdict(float)
+        for term_id, weight in zip(term_ids, weights):
+            posting = self.postings[term_id]
+            if len(posting) <= max_postings:
+                for other_id, other_weight in posting.items():
+                    text_scores[other_id] += weight * other_weight
+
+        return text_scores
+
+    def ann_candidates(self, media_id):
+        """Exact text scores for the nearest media found by the ann index"""
+
+        term_ids, weights = self.vectors[media_id]
+        query = dict(zip(term_ids, weights))
+
+        text_scores = {}
+        for score, other_id in media_ann_index.search(self.dense_vector(media_id), ANN_CANDIDATES):
+            if other_id in self.vectors:
+                other_terms, other_weights = self.vectors[other_id]
+                text_scores[other_id] = sum(weight * query.get(term_id, 0) for term_id, weight in zip(other_terms, other_weights))
+
+        return text_scores
+
+    def most_similar(self, media_id, k=SIMILAR_PER_MEDIA):
+        """The k media most like media_id: [(similarity, media_id)]"""
+
+        genres = self.genres[media_id]
+
+        if self.document_count >= ANN_MIN_MEDIA and len(media_ann_index):
+            text_scores = self.ann_candidates(media_id)
+        else:
+            text_scores = self.text_candidates(media_id)
+
+        candidates = set(text_scores)
+        if not candidates and genres:
+            for genre_id in genres:
+                candidates.update(self.genre_postings[genre_id])
+                if len(candidates) >= MAX_GENRE_CANDIDATES:
+                    break
+        candidates.discard(media_id)
+
+        similarities = []
+        for other_id in candidates:
+            other_genres = self.genres[other_id]
+            genre_score = len(genres & other_genres) / math.sqrt(len(genres) * len(other_genres)) if genres and other_genres else 0
+            similarity = TEXT_WEIGHT * text_scores.get(other_id, 0) + GENRE_WEIGHT * genre_score
+            if similarity > 0:
+                similarities.append((similarity, other_id))
+
+        return heapq.nlargest(k, similarities)
+
+
+content_index = ContentIndex()
+# memory mapped the first time it's searched
+media_ann_index = IvfIndex(ANN_INDEX_PATH)
+
+def ensure_loaded():
+    """Loads the content index the first time, after that only adds the media saved since,
+    and adds whatever media the ann index is missing to it. Call with the content index lock held."""
+
+    if content_index.loaded_at is None:
+        content_index.load()
+        missing = content_index.vectors.keys() - media_ann_index.media_ids()
+    elif time.monotonic() - content_index.loaded_at > INDEX_TTL_SECONDS:
+        missing = content_index.catch_up()
+    else:
+        return
+
+    # no ann index is built until there are ANN_MIN_MEDIA media
+    if missing and len(media_ann_index):
+        media_ann_index.add_many([(media_id, content_index.dense_vector(media_id)) for media_id in missing])
+
+def build_ann_index():
+    """Writes a new ann index over every media in the content index, call with its lock held,
+    after media_ann_index.rotate_delta and then loading the content index"""
+
+    media_ids = list(content_index.vectors)
+    media_ann_index.build(media_ids, [content_index.dense_vector(media_id) for media_id in media_ids], k=ANN_CANDIDATES)
+
+def rebuild_similar_media():
+    """Recomputes the similar media of every media, returns how many media have some"""
+
+    with content_index.lock:
+        media_ann_index.rotate_delta()
+        content_index.load()
+        if content_index.document_count >= ANN_MIN_MEDIA:
+            build_ann_index()
+        similar = {media_id: content_index.most_similar(media_id) for media_id in content_index.vectors}
+
+    db.session.execute(SimilarMedia.__table__.delete())
+
+    rows = [{"media_id": media_id, "similar_id": similar_id, "similarity": similarity}
+            for media_id, media_similar in similar.items()
+            for similarity, similar_id in media_similar]
+
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(SimilarMedia.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+    db.session.commit()
+
+    return sum(1 for media_similar in similar.values() if media_similar)
+
+def add_media(media):
+    """Adds a newly saved media (with its genres) to the index and the similar_medias table,
+    and to the similar media of the media it's most like. Run by a job worker, loading the index takes a while."""
+
+    with content_index.lock:
+        ensure_loaded()
+        if media.media_id not in content_index.vectors:
+            content_index.add(media.media_id, content_index.term_counts(media.title, media.overview),
+                              [genre.genre_id for genre in media.genres])
+            media_ann_index.add(media.media_id, content_index.dense_vector(media.media_id))
+        similar = content_index.most_similar(media.media_id)
+
+    if not similar:
+        return []
+
+    db.session.execute(SimilarMedia.__table__.delete().where(or_(SimilarMedia.media_id == media.media_id, SimilarMedia.similar_id == media.media_id)))
+    db.session.execute(SimilarMedia.__table__.insert(),
+                       [{"media_id": media.media_id, "similar_id": similar_id, "similarity": similarity} for similarity, similar_id in similar]
+                       + [{"media_id": similar_id, "similar_id": media.media_id, "similarity": similarity} for similarity, similar_id in similar])
+
+    # the media it was added to only keep their best SIMILAR_PER_MEDIA
+    other_ids = [similar_id for similarity, similar_id in similar]
+    rows = db.session.execute(select(SimilarMedia.media_id, SimilarMedia.similar_id, SimilarMedia.similarity)
+                              .where(SimilarMedia.media_id.in_(other_ids))).all()
+    by_media = defaultdict(list)
+    for media_id, similar_id, similarity in rows:
+        by_media[media_id].append((similarity, similar_id))
+
+    extra = [(media_id, similar_id)
+             for media_id, media_similar in by_media.items()
+             for similarity, similar_id in sorted(media_similar, reverse=True)[SIMILAR_PER_MEDIA:]]
+    if extra:
+        db.session.execute(SimilarMedia.__table__.delete().where(tuple_(SimilarMedia.media_id, SimilarMedia.similar_id).in_(extra)))
+
+    return similar
+
+def get_similar_media(media, limit=SIMILAR_PER_MEDIA):
+    """Gets the media most like media, most similar first"""
+
+    rows = (SimilarMedia.query.filter(SimilarMedia.media_id == media.media_id)
+            .options(joinedload(SimilarMedia.similar))
+            .order_by(SimilarMedia.similarity.desc())
+            .limit(limit))
+
+    return [row.similar for row in rows]
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    with app.app_context():
+        if sys.argv[1:] == ["benchmark"]:
+            # recall and latency of the ann index against exact search
+            with content_index.lock:
+                media_ann_index.rotate_delta()
+                content_index.load()
+                build_ann_index()
+            # the last one uses the nprobe the build picked
+            for nprobe in (1, 4, 8, 16, None):
+                print(benchmark(media_ann_index, media_ann_index.sample_vectors(200), k=ANN_CANDIDATES, nprobe=nprobe))
+        else:
+            print(f"Rebuilt similar media for {rebuild_similar_media()} media")
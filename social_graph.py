@@ -0,0 +1,115 @@
+"""Adjacency cache of who follows who, for follow counts and follow checks."""
+
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import select
+
+from model import db, friend
+
+# each worker keeps its own cache, so entries expire to pick up follows made through other workers
+CACHE_TTL_SECONDS = 60
+MAX_CACHED_USERS = 50000
+
+
+class UserAdjacency:
+    """The sorted user_ids a user follows and is followed by"""
+
+    __slots__ = ("following", "followers", "loaded_at")
+
+    def __init__(self, following, followers):
+        self.following = array("i", sorted(following))
+        self.followers = array("i", sorted(followers))
+        self.loaded_at = time.monotonic()
+
+
+def contains(ids, user_id):
+    """Checks if a sorted array of user_ids has user_id"""
+
+    index = bisect_left(ids, user_id)
+    return index < len(ids) and ids[index] == user_id
+
+def add(ids, user_id):
+    if not contains(ids, user_id):
+        insort(ids, user_id)
+
+def remove(ids, user_id):
+    index = bisect_left(ids, user_id)
+    if index < len(ids) and ids[index] == user_id:
+        del ids[index]
+
+
+class AdjacencyCache:
+    """LRU cache of UserAdjacency by user_id"""
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_users=MAX_CACHED_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+
+    def load(self, user_id):
+        """Loads a users follows from the friends table as plain ints"""
+
+        following = db.session.execute(select(friend.c.f2_id).where(friend.c.f1_id == user_id)).scalars().all()
+        followers = db.session.execute(select(friend.c.f1_id).where(friend.c.f2_id == user_id)).scalars().all()
+
+        return UserAdjacency(set(following), set(followers))
+
+    def get(self, user_id):
+        """Gets the users adjacency, loading it if it isn't cached or has expired"""
+
+        with self.lock:
+            adjacency = self.users.get(user_id)
+            if adjacency and time.monotonic() - adjacency.loaded_at < self.ttl:
+                self.users.move_to_end(user_id)
+                return adjacency
+
+        adjacency = self.load(user_id)
+
+        with self.lock:
+            self.users[user_id] = adjacency
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+
+        return adjacency
+
+    def following_count(self, user_id):
+        return len(self.get(user_id).following)
+
+    def follower_count(self, user_id):
+        return len(self.get(user_id).followers)
+
+    def is_following(self, user_id, other_user_id):
+        """Checks if user_id follows other_user_id"""
+
+        return contains(self.get(user_id).following, other_user_id)
+
+    def follow(self, user_id, other_user_id):
+        """Write-through for a new follow, only touches users that are cached"""
+
+        with self.lock:
+            if user_id in self.users:
+                add(self.users[user_id].following, other_user_id)
+            if other_user_id in self.users:
+                add(self.users[other_user_id].followers, user_id)
+
+    def unfollow(self, user_id, other_user_id):
+        """Write-through for an unfollow, only touches users that are cached"""
+
+        with self.lock:
+            if user_id in self.users:
+                remove(self.users[user_id].following, other_user_id)
+            if other_user_id in self.users:
+                remove(self.users[other_user_id].followers, user_id)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+
+
+adjacency_cache = AdjacencyCache()
@@ -6,20 +6,64 @@ function MediaCard(props) {
         <div class="media_title"><a className="media_title" href={`/media-info/${props.mediaType}/${props.TMDB_id}`}>{props.title}</a></div>
         <br></br>
         <div class="media_poster_path"><img src={`https://image.tmdb.org/t/p/original${props.posterPath}`} alt="No Poster Path Available"/></div>
+        <MediaCardState state={props.state}/>
       </div>
     );
   }
 
+// shows if the user has already watched, queued, rated or added the media to a playlist
+function MediaCardState(props) {
+    if (!props.state) {
+      return null;
+    }
+
+    const badges = [];
+    if (props.state.watched) {
+      badges.push(<span key="watched"><i class="bi bi-check-circle"></i> Watched </span>);
+    }
+    if (props.state.to_be_watched) {
+      badges.push(<span key="to_be_watched"><i class="bi bi-clock"></i> To Be Watched </span>);
+    }
+    if (props.state.score) {
+      badges.push(<span key="score"><i class="bi bi-star-fill"></i> {props.state.score} </span>);
+    }
+    for (const playlist of props.state.playlists) {
+      badges.push(<span key={`playlist_${playlist.playlist_id}`}><i class="bi bi-collection-play"></i> {playlist.name} </span>);
+    }
+
+    return <div className="media_card_state">{badges}</div>;
+  }
+
 // creates the search feature so the user can search for a media
 function SearchMedia(props) {
     const [search, setSearch] = React.useState("");
-    const [mediaType, setmediaType] = React.useState("");
     const [mediaCards, setmediaCards] = React.useState([]);
-    const [mediaTypeToSearch, setMediaTypeToSearch] = React.useState("");
+    const [mediaTypeToSearch, setMediaTypeToSearch] = React.useState("multi");
+    const [degraded, setDegraded] = React.useState(false);
+    const [partial, setPartial] = React.useState(false);
+    const [mediaStates, setMediaStates] = React.useState({});
+    const [suggestions, setSuggestions] = React.useState([]);
+
+    // suggestions come from the titles index on the server while typing, TMDB is only searched on submit
+    React.useEffect(() => {
+      if (search.trim() == "") {
+        setSuggestions([]);
+        return;
+      }
+
+      // waits for a pause in typing
+      const timeout = setTimeout(() => {
+        fetch(`/autocomplete.json?q=${encodeURIComponent(search)}&mediaType=${mediaTypeToSearch}`)
+          .then((response) => response.json())
+          .then((suggestionsData) => setSuggestions(suggestionsData.suggestions));
+      }, 150);
+
+      return () => clearTimeout(timeout);
+    }, [search, mediaTypeToSearch]);
     
-    function searchMediaInfo() {
-      console.log(mediaTypeToSearch)
-      console.log(search)
+    function searchMediaInfo(event) {
+      event.preventDefault();
+      setSuggestions([]);
       if (mediaTypeToSearch != "" && search != ""){
 
         fetch("/media-search-results-react.json", {
@@ -33,38 +77,48 @@ function SearchMedia(props) {
           .then((response) => response.json())
           .then((mediaCardsData) => {
             setmediaCards(mediaCardsData.media)
-            setmediaType(mediaCardsData.media_type)
+            setDegraded(mediaCardsData.degraded)
+            // only multi search has a deadline, the other searches leave it out
+            setPartial(Boolean(mediaCardsData.partial))
+            getMediaStates(mediaCardsData.media)
           });
 
       }   
     };
 
+    // one request for the users state of every card in the grid
+    function getMediaStates(medias) {
+      setMediaStates({});
+      if (medias.length == 0) {
+        return;
+      }
+
+      fetch("/media-state.json", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ "items": medias.map((media) => ({ "mediaType": media["media_type"], "TMDB_id": media["id"] })) })
+      })
+        .then((response) => response.json())
+        .then((statesData) => setMediaStates(statesData.states));
+    };
+
     const mediaCardsList = [];
 
-    if (mediaType == "movie"){
-      for (const currentmediaCard of mediaCards) {
-        mediaCardsList.push(
-        <MediaCard
-            key={currentmediaCard["id"]}
-            title={currentmediaCard["original_title"]}
-            posterPath={currentmediaCard['poster_path']}
-            mediaType={mediaType}
-            TMDB_id={currentmediaCard["id"]}
-        />,
-        );
-    }
-    } else if (mediaType == "tv"){
-      for (const currentmediaCard of mediaCards) {
-        mediaCardsList.push(
-        <MediaCard
-            key={currentmediaCard["id"]}
-            title={currentmediaCard["name"]}
-            posterPath={currentmediaCard['poster_path']}
-            mediaType={mediaType}
-            TMDB_id={currentmediaCard["id"]}
-        />,
-        );
-    }
+    // each result says if it's a movie or a show, so a search of both can mix them
+    for (const currentmediaCard of mediaCards) {
+      const cardMediaType = currentmediaCard["media_type"];
+      mediaCardsList.push(
+      <MediaCard
+          key={`${cardMediaType}/${currentmediaCard["id"]}`}
+          title={cardMediaType == "movie" ? currentmediaCard["original_title"] : currentmediaCard["name"]}
+          posterPath={currentmediaCard['poster_path']}
+          mediaType={cardMediaType}
+          TMDB_id={currentmediaCard["id"]}
+          state={mediaStates[`${cardMediaType}/${currentmediaCard["id"]}`]}
+      />,
+      );
     };
 
     return (
@@ -82,14 +136,32 @@ function SearchMedia(props) {
             <div class="container-flex">
               <div class="container search_page">
                 <div class="row search_page_row">
-                  <div class="search_bar text-center">
+                  <form class="search_bar text-center" onSubmit={searchMediaInfo}>
                     <label htmlFor="searchInput"><h1 id="search_title"></h1></label>
                         <input
                             name="search"
                             onChange={(event) => setSearch(event.target.value)}
                             id="searchInput"
+                            autoComplete="off"
                             placeholder="Search for movies and tv shows by title:"
                         ></input>
+                        <ul className="autocomplete_suggestions">
+                          {suggestions.map((suggestion) => (
+                            <li key={`${suggestion.media_type}/${suggestion.id}`}>
+                              <a href={`/media-info/${suggestion.media_type}/${suggestion.id}`}>{suggestion.title}</a> ({suggestion.media_type})
+                            </li>
+                          ))}
+                        </ul>
+                    <label htmlFor="multiInput">
+                        <input
+                          type="radio"
+                          value="multi"
+                          name="mediaTypeToSearch"
+                          defaultChecked
+                          onChange={(event) => setMediaTypeToSearch(event.target.value)}
+                          id="multiInput"
+                        /> both 
+                      </label>
                     <label htmlFor="movieInput">
                         <input
                           type="radio"
@@ -108,11 +180,13 @@ function SearchMedia(props) {
                           id="showInput"
                           /> tv show 
                       </label>
-                      <button onClick={searchMediaInfo}>
+                      <button type="submit">
                           Search
                       </button>
+                  </form>
                   </div>
-                  </div>
+                  {degraded && <p className="degraded_note text-center">Only titles already on MyViews are shown while TMDB isn't responding.</p>}
+                  {!degraded && partial && <p className="degraded_note text-center">TMDB is slow right now, so some results may be missing. Try searching again.</p>}
                   <div className="grid">{mediaCardsList}</div>
                 </div>
             </div>
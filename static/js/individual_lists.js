@@ -1,9 +1,7 @@
 'use-strict';
 
 // deleting from watched list on user profile
-const deleteFromWatchedBtns = document.querySelectorAll(".deleting-from-watched-btn")
-
-for (const deleteBtn of deleteFromWatchedBtns) {
+function addDeleteFromWatchedListener(deleteBtn) {
 
   deleteBtn.addEventListener("click", evt => {
     console.log(deleteBtn.value)
@@ -26,10 +24,12 @@ for (const deleteBtn of deleteFromWatchedBtns) {
   })
 }
 
-// deleting from to be watched list on user profile
-const deleteFromToBeWatchedBtns = document.querySelectorAll(".deleting-from-to-be-watched-btn")
+for (const deleteBtn of document.querySelectorAll(".deleting-from-watched-btn")) {
+  addDeleteFromWatchedListener(deleteBtn);
+}
 
-for (const deleteBtn of deleteFromToBeWatchedBtns) {
+// deleting from to be watched list on user profile
+function addDeleteFromToBeWatchedListener(deleteBtn) {
 
   deleteBtn.addEventListener("click", evt => {
     const formInputs  = {
@@ -51,10 +51,12 @@ for (const deleteBtn of deleteFromToBeWatchedBtns) {
   })
 }
 
-// deleting a rating on edit list
-const deleteRatingBtns = document.querySelectorAll(".deleting-rating-btn")
+for (const deleteBtn of document.querySelectorAll(".deleting-from-to-be-watched-btn")) {
+  addDeleteFromToBeWatchedListener(deleteBtn);
+}
 
-for (const deleteBtn of deleteRatingBtns) {
+// deleting a rating on edit list
+function addDeleteRatingListener(deleteBtn) {
 
   deleteBtn.addEventListener("click", evt => {
     const formInputs  = {
@@ -77,3 +79,43 @@ for (const deleteBtn of deleteRatingBtns) {
       });
   })
 }
+
+for (const deleteBtn of document.querySelectorAll(".deleting-rating-btn")) {
+  addDeleteRatingListener(deleteBtn);
+}
+
+// loading the rest of the list as the user scrolls
+const pagedList = document.querySelector(".paged_list");
+
+if (pagedList) {
+  const watched = pagedList.dataset.pageUrl.includes("/watched/");
+
+  loadMoreOnScroll(pagedList, media => {
+    let rating = "";
+    if (media.rating_id) {
+      rating = `<div id="rating_div_${media.rating_id}">
+                  ${starsHTML(media.score)}
+                  <button type="button" class="deleting-rating-btn" value="${media.rating_id}">Delete Rating</button>
+                </div>`;
+    }
+
+    return `<div class="media_card_edit_lists text-center" id="${watched ? "watch_list_div" : "to_be_watch_list_div"}_${media.media_id}">
+              <br>
+              <div class="media_title media_title_grid"><a class="media_title" href="/media-info/${media.media_type}/${media.TMDB_id}">${escapeHTML(media.title)}</a></div>
+              <div class="media_rating_list">${rating}</div>
+              <div class="media_poster_path"><img src="https://image.tmdb.org/t/p/original${media.poster_path}"></div>
+              <button type="button" class="${watched ? "deleting-from-watched-btn" : "deleting-from-to-be-watched-btn"}" value="${media.media_id}">Remove from list</button>
+            </div>`;
+  },
+  card => {
+    for (const deleteBtn of card.querySelectorAll(".deleting-rating-btn")) {
+      addDeleteRatingListener(deleteBtn);
+    }
+    for (const deleteBtn of card.querySelectorAll(".deleting-from-watched-btn")) {
+      addDeleteFromWatchedListener(deleteBtn);
+    }
+    for (const deleteBtn of card.querySelectorAll(".deleting-from-to-be-watched-btn")) {
+      addDeleteFromToBeWatchedListener(deleteBtn);
+    }
+  });
+}
@@ -1,10 +1,7 @@
 'use-strict';
 
 // deleting from a playlist
-
-const deleteFromPlaylistBtns = document.querySelectorAll(".deleting-from-playlist-btn")
-
-for (const deleteBtn of deleteFromPlaylistBtns) {
+function addDeleteFromPlaylistListener(deleteBtn) {
 
   deleteBtn.addEventListener("click", evt => {
     console.log(deleteBtn)
@@ -28,10 +25,12 @@ for (const deleteBtn of deleteFromPlaylistBtns) {
   })
 }
 
-// deleting a rating on edit playlist
-const deleteRatingBtns = document.querySelectorAll(".deleting-rating-btn")
+for (const deleteBtn of document.querySelectorAll(".deleting-from-playlist-btn")) {
+  addDeleteFromPlaylistListener(deleteBtn);
+}
 
-for (const deleteBtn of deleteRatingBtns) {
+// deleting a rating on edit playlist
+function addDeleteRatingListener(deleteBtn) {
 
   deleteBtn.addEventListener("click", evt => {
     const formInputs  = {
@@ -51,4 +50,39 @@ for (const deleteBtn of deleteRatingBtns) {
       document.querySelector(`#rating_div_${deleteBtn.value}`).remove();
       });
   })
-}
\ No newline at end of file
+}
+
+for (const deleteBtn of document.querySelectorAll(".deleting-rating-btn")) {
+  addDeleteRatingListener(deleteBtn);
+}
+
+// loading the rest of the playlist as the user scrolls
+const pagedPlaylist = document.querySelector(".paged_list");
+
+if (pagedPlaylist) {
+  loadMoreOnScroll(pagedPlaylist, media => {
+    let rating = "";
+    if (media.rating_id) {
+      rating = `<div id="rating_div_${media.rating_id}">
+                  ${starsHTML(media.score)}
+                  <button type="button" class="deleting-rating-btn" value="${media.rating_id}">Delete Rating</button>
+                </div>`;
+    }
+
+    return `<div class="media_card text-center" id="playlist_media_div_${media.media_id}">
+              <br>
+              <div class="media_title"><a class="media_title" href="/media-info/${media.media_type}/${media.TMDB_id}">${escapeHTML(media.title)}</a></div>
+              <div class="media_rating">${rating}</div>
+              <div class="media_poster_path"><img src="https://image.tmdb.org/t/p/original${media.poster_path}"></div>
+              <button type="button" class="deleting-from-playlist-btn" value="${media.media_id}">Remove from playlist</button>
+            </div>`;
+  },
+  card => {
+    for (const deleteBtn of card.querySelectorAll(".deleting-rating-btn")) {
+      addDeleteRatingListener(deleteBtn);
+    }
+    for (const deleteBtn of card.querySelectorAll(".deleting-from-playlist-btn")) {
+      addDeleteFromPlaylistListener(deleteBtn);
+    }
+  });
+}
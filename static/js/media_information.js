@@ -23,4 +23,74 @@ for (const deleteBtn of deleteRatingBtns) {
       document.querySelector(`#rating_div_${deleteBtn.value}`).remove();
       });
   })
-}
\ No newline at end of file
+}
+
+// loading the rest of the friends ratings as the user scrolls
+const friendRatings = document.querySelector("#friend_ratings");
+
+if (friendRatings) {
+  loadMoreOnScroll(friendRatings, rating => {
+    return `<div class="rating_div">
+              <h2><a class="list_title" href="/display-friend/${encodeURIComponent(rating.username)}">${escapeHTML(rating.username)}:</a></h2>
+              ${starsHTML(rating.score)}
+              <div class="review_input">${escapeHTML(rating.review_input)}</div>
+            </div>`;
+  });
+}
+
+// rating, sorting into a list and adding to a playlist without reloading the page:
+// each form is sent as json and the users new state for the media is shown in place
+const formJSON = {
+  score: form => ({score: form.score.value, comment: form.comment.value, watchTime: form.watch_time.value}),
+  list: form => ({list: form.list.value, watchTime: form.watch_time.value}),
+  playlist: form => ({playlistID: form.playlist.value}),
+};
+
+function showMediaState(state) {
+  document.querySelector("#state_rating").innerHTML = state.rating
+    ? `Your rating: <span class="star">${"★".repeat(state.rating.score)}</span>` : "";
+
+  if (state.lists.watched) {
+    document.querySelector("#state_lists").innerHTML = "In your Watched List";
+  } else if (state.lists.to_be_watched) {
+    document.querySelector("#state_lists").innerHTML = "In your To Be Watched List";
+  } else {
+    document.querySelector("#state_lists").innerHTML = "";
+  }
+
+  document.querySelector("#state_playlists").innerHTML = state.playlists.length
+    ? `In your playlists: ${state.playlists.map(playlist => escapeHTML(playlist.name)).join(", ")}` : "";
+
+  // the users own rating further down the page, if it's showing
+  const ratingDiv = state.rating && document.querySelector(`#rating_div_${state.rating.rating_id}`);
+  if (ratingDiv) {
+    ratingDiv.querySelector(".star").outerHTML = starsHTML(state.rating.score);
+  }
+}
+
+for (const form of document.querySelectorAll(".media_state_form")) {
+
+  form.addEventListener("submit", evt => {
+    evt.preventDefault();
+    const field = Object.keys(formJSON).find(name => form[name]);
+
+    fetch(form.dataset.jsonUrl, {
+              method: 'POST',
+              body: JSON.stringify(formJSON[field](form)),
+              headers: {
+                'Content-Type': 'application/json',
+              },
+          })
+
+    .then((response) => response.json())
+    .then((responseJson) => {
+      if (responseJson.error) {
+        alert(responseJson.error);
+        return;
+      }
+      showMediaState(responseJson);
+      bootstrap.Modal.getInstance(form.closest(".modal")).hide();
+      form.reset();
+      });
+  })
+}
@@ -0,0 +1,61 @@
+'use-strict';
+
+// infinite scrolling for lists that are paged on the server:
+// when the end of a .paged_list scrolls into view, the next page is fetched
+// from its data-page-url (starting after data-next-after) and added to the list
+
+function escapeHTML(text) {
+  const div = document.createElement("div");
+  div.innerText = text ?? "";
+  return div.innerHTML;
+}
+
+function starsHTML(score) {
+  if (!score) {
+    return "";
+  }
+  return `<div class="star">${"★".repeat(score)}</div>`;
+}
+
+// renderItem turns one item from the page json into html,
+// onAdded (optional) is called with each new element so buttons can get their listeners
+function loadMoreOnScroll(list, renderItem, onAdded) {
+  let nextAfter = list.dataset.nextAfter;
+  let loading = false;
+
+  if (!nextAfter) {
+    return;
+  }
+
+  const sentinel = document.createElement("div");
+  sentinel.className = "page_sentinel";
+  list.appendChild(sentinel);
+
+  const observer = new IntersectionObserver(entries => {
+    if (!entries[0].isIntersecting || loading || !nextAfter) {
+      return;
+    }
+    loading = true;
+
+    fetch(`${list.dataset.pageUrl}?after=${nextAfter}`)
+    .then((response) => response.json())
+    .then((responseJson) => {
+      for (const item of responseJson.items) {
+        sentinel.insertAdjacentHTML("beforebegin", renderItem(item));
+        if (onAdded) {
+          onAdded(sentinel.previousElementSibling, item);
+        }
+      }
+
+      nextAfter = responseJson.next_after;
+      loading = false;
+
+      if (!nextAfter) {
+        observer.disconnect();
+        sentinel.remove();
+      }
+    });
+  });
+
+  observer.observe(sentinel);
+}
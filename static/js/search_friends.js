@@ -0,0 +1,115 @@
+'use-strict';
+
+// as you type friend search
+
+const searchInput = document.querySelector("#searchInput");
+const suggestions = document.querySelector("#friend_suggestions");
+const moreBtn = document.querySelector("#more_friend_suggestions");
+let nextOffset = null;
+let typingTimer = null;
+
+function showSuggestions(search, offset) {
+  fetch(`/search-friends.json?q=${encodeURIComponent(search)}&offset=${offset}`)
+  .then((response) => response.json())
+  .then((responseJson) => {
+    // ignore answers for text the user has already changed
+    if (search != searchInput.value.trim()) {
+      return;
+    }
+    if (offset == 0) {
+      suggestions.innerHTML = "";
+    }
+    for (const user of responseJson.users) {
+      const link = document.createElement("a");
+      link.className = "row list_title";
+      link.href = `/display-friend/${encodeURIComponent(user.username)}`;
+      link.innerText = user.username;
+      suggestions.appendChild(link);
+    }
+    nextOffset = responseJson.next_offset;
+    moreBtn.hidden = nextOffset == null;
+  });
+}
+
+searchInput.addEventListener("input", evt => {
+  // wait until the user stops typing for a moment
+  clearTimeout(typingTimer);
+  typingTimer = setTimeout(() => {
+    const search = searchInput.value.trim();
+    if (search == "") {
+      suggestions.innerHTML = "";
+      moreBtn.hidden = true;
+      return;
+    }
+    showSuggestions(search, 0);
+  }, 200);
+});
+
+moreBtn.addEventListener("click", evt => {
+  if (nextOffset != null) {
+    showSuggestions(searchInput.value.trim(), nextOffset);
+  }
+});
+
+// people you may know
+
+fetch("/friend-suggestions.json")
+.then((response) => response.json())
+.then((responseJson) => {
+  const peopleYouMayKnow = document.querySelector("#people_you_may_know");
+
+  for (const suggestion of responseJson.suggestions) {
+    const link = document.createElement("a");
+    link.className = "row list_title";
+    link.href = `/display-friend/${encodeURIComponent(suggestion.username)}`;
+    link.innerText = suggestion.username;
+
+    const details = document.createElement("p");
+    details.innerText = `${suggestion.mutual_count} mutual follow${suggestion.mutual_count == 1 ? "" : "s"}, ${suggestion.shared_watched} watched in common`;
+
+    peopleYouMayKnow.append(link, details);
+  }
+
+  peopleYouMayKnow.hidden = responseJson.suggestions.length == 0;
+});
+
+// friends activity
+
+const ACTIVITY_VERBS = {
+  rated: "rated",
+  watched: "watched",
+  to_be_watched: "wants to watch",
+  added_to_playlist: "added to a playlist",
+};
+
+function activityHTML(activity) {
+  let verb = ACTIVITY_VERBS[activity.verb] ?? activity.verb;
+  if (activity.playlist_name) {
+    verb = `added to ${escapeHTML(activity.playlist_name)}:`;
+  }
+  return `<div class="row activity">
+    <p>
+      <a href="/display-friend/${encodeURIComponent(activity.username)}">${escapeHTML(activity.username)}</a>
+      ${verb}
+      <a href="/media-info/${activity.media_type}/${activity.TMDB_id}">${escapeHTML(activity.title)}</a>
+    </p>
+    ${starsHTML(activity.score)}
+  </div>`;
+}
+
+const friendsActivity = document.querySelector("#friends_activity");
+
+fetch(friendsActivity.dataset.pageUrl)
+.then((response) => response.json())
+.then((responseJson) => {
+  for (const activity of responseJson.items) {
+    friendsActivity.insertAdjacentHTML("beforeend", activityHTML(activity));
+  }
+  friendsActivity.hidden = responseJson.items.length == 0;
+
+  // the rest loads as the user scrolls
+  if (responseJson.next_after) {
+    friendsActivity.dataset.nextAfter = responseJson.next_after;
+    loadMoreOnScroll(friendsActivity, activityHTML);
+  }
+});
@@ -48,4 +48,14 @@
 //       document.querySelector(`#playlist_div_${deleteBtn.value}`).remove();
 //       });
 //   })
-// }
\ No newline at end of file
+// }
+// loading the rest of each list as the user scrolls
+for (const pagedList of document.querySelectorAll(".paged_list")) {
+  loadMoreOnScroll(pagedList, media => {
+    return `<div class="col media_card text-center">
+              <div class="media_title"><a class="media_title text-wrap" href="/media-info/${media.media_type}/${media.TMDB_id}">${escapeHTML(media.title)}</a></div>
+              <div class="media_rating">${starsHTML(media.score)}</div>
+              <div class="media_poster_path"><img src="https://image.tmdb.org/t/p/original${media.poster_path}" alt=""></div>
+            </div>`;
+  });
+}
@@ -1,10 +1,18 @@
 'use strict';
 
-// for genres
+// every chart's data comes from one request
 
-fetch('/user-profile/genres.json')
+fetch('/user-profile/dashboard.json')
 .then(response => response.json())
 .then(responseJson => {
+  genreChart(responseJson.genres);
+  watchHistoryChart(responseJson.moviedata, responseJson.showdata);
+  showTotals(responseJson.totals);
+});
+
+// for genres
+
+function genreChart(genres) {
 
   const xvalues = [];
   const yvalues = [];
@@ -20,7 +28,7 @@ fetch('/user-profile/genres.json')
 
   const barColorsDynamic = [];
   
-  for (const value of responseJson.data){
+  for (const value of genres){
     xvalues.push(value["genre"]);
     yvalues.push(value["number_of_genre"]);
   }
@@ -74,19 +82,17 @@ fetch('/user-profile/genres.json')
     },
   });
 
-});
+}
 
 // for watch history
 
-fetch('/user-profile/watch_history.json')
-  .then(response => response.json())
-  .then(responseJson => {
+function watchHistoryChart(moviedata, showdata) {
 
     let movievalues = [];
     let showvalues = [];
   
   
-    for (const movie_value of responseJson.moviedata){
+    for (const movie_value of moviedata){
         movievalues.push({
           // x: movie_value["day"],
           x: movie_value["month"],
@@ -95,7 +101,7 @@ fetch('/user-profile/watch_history.json')
        
     };
 
-    for (const show_value of responseJson.showdata){
+    for (const show_value of showdata){
       showvalues.push({
         // x: show_value["day"],
         x: show_value["month"],
@@ -177,4 +183,14 @@ fetch('/user-profile/watch_history.json')
         }
       }
   });
-});
\ No newline at end of file
+}
+
+// for list and rating totals
+
+function showTotals(totals) {
+  const averageScore = totals.average_score === null ? "" : `, averaging ${totals.average_score} ★`;
+
+  document.querySelector("#dashboard_totals").innerHTML =
+    `${totals.watched} watched · ${totals.to_be_watched} to be watched · ` +
+    `${totals.ratings} ratings${averageScore} · ${totals.playlists} playlists`;
+}
@@ -1,7 +1,31 @@
 from unittest import TestCase
-from server import app
-from model import connect_to_db, db, example_data
-from flask import session
+from server import app, get_bulk_media_ids, get_bulk_watch_time, MAX_BULK_MEDIA, save_rating, sort_into_folder, set_time_watched, add_to_user_playlist, get_media_state, user_data_etag, user_data_not_modified
+from model import connect_to_db, db, example_data, friend, FriendSuggestions, User, Media, Activity, TimelineEntry, Job, TrendBucket, pool_metrics, mark_user_wrote
+import crud
+from social_graph import AdjacencyCache
+import recommender
+import similar_media
+import recommendation_job
+import trending
+import cache
+import job_queue
+import tmdb
+import autocomplete
+import multi_search
+from ann_index import IvfIndex, benchmark
+from flask import Flask, session
+from sqlalchemy import inspect, select, func
+from sqlalchemy.exc import OperationalError
+import time
+import os
+import random
+import threading
+import tempfile
+from datetime import date, datetime, timedelta
+
+# set the app up for the database before any test makes a request with it,
+# the tests that use it reconnect it to their own database
+connect_to_db(app, "sqlite:///:memory:")
 
 class FlaskTestsLoggedOut(TestCase):
     """Flask Tests"""
@@ -106,6 +130,1136 @@ class FlaskTestsDatabase(TestCase):
                                   follow_redirects=True)
         self.assertIn(b'script src="/static/js/all_media.jsx', result.data)
 
+class FlaskTestsReadReplica(TestCase):
+    """Tests that reads go to the replica and writes go to the primary."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        # a separate app so the main app's db setup isn't touched
+        self.replica_app = Flask(__name__)
+        self.replica_app.secret_key = "key"
+        connect_to_db(self.replica_app, "sqlite:///:memory:", replica_uri="sqlite:///:memory:")
+        self.user_mapper = inspect(User)
+
+    def test_get_reads_from_replica(self):
+        """Tests GET requests read from the replica"""
+
+        with self.replica_app.test_request_context("/", method="GET"):
+            self.assertIs(db.session.get_bind(self.user_mapper), db.get_engine(bind="replica"))
+
+    def test_post_uses_primary(self):
+        """Tests POST requests use the primary"""
+
+        with self.replica_app.test_request_context("/", method="POST"):
+            self.assertIs(db.session.get_bind(self.user_mapper), db.engine)
+
+    def test_pool_metrics_per_engine(self):
+        """Tests the primary and the replica count their connections separately"""
+
+        with self.replica_app.app_context():
+            self.assertIsNot(pool_metrics["primary"], pool_metrics["replica"])
+            self.assertIs(db.engine.pool.metrics, pool_metrics["primary"])
+            self.assertIs(db.get_engine(bind="replica").pool.metrics, pool_metrics["replica"])
+
+    def test_pool_metrics_not_public(self):
+        """Tests only the server itself can see the pool metrics"""
+
+        result = app.test_client().get("/metrics/db-pool.json", environ_base={"REMOTE_ADDR": "203.0.113.5"})
+        self.assertEqual(result.status_code, 404)
+
+    def test_read_your_writes(self):
+        """Tests a user who just wrote keeps reading from the primary"""
+
+        with self.replica_app.test_request_context("/", method="GET"):
+            session["last_write_at"] = time.time()
+            self.assertIs(db.session.get_bind(self.user_mapper), db.engine)
+
+    def test_only_user_writes_stick(self):
+        """Tests only a logged in users POST pins them to the primary, not writes made serving a GET"""
+
+        with self.replica_app.test_request_context("/", method="GET"):
+            session["username"] = "test1"
+            mark_user_wrote()
+            self.assertNotIn("last_write_at", session)
+
+        with self.replica_app.test_request_context("/", method="POST"):
+            mark_user_wrote()
+            self.assertNotIn("last_write_at", session)
+            session["username"] = "test1"
+            mark_user_wrote()
+            self.assertIn("last_write_at", session)
+
+class DatabaseTestCase(TestCase):
+    """Sets up a database with example data for each test, an in memory one unless db_uri is set."""
+
+    db_uri = "sqlite:///:memory:"
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        self.crud_app = self.make_app()
+        connect_to_db(self.crud_app, self.db_uri)
+
+        self.ctx = self.crud_app.app_context()
+        self.ctx.push()
+
+        self.create_tables()
+        example_data()
+        # nothing cached by another test's db
+        cache.get_backend().clear()
+
+        self.user = crud.get_user_by_username("test1")
+        self.medias = [Media(TMDB_id=i, media_type="movie", title=f"Movie {i}") for i in range(1, 4)]
+        db.session.add_all(self.medias)
+        db.session.commit()
+
+    def make_app(self):
+        """A separate app so the main app's db setup isn't touched"""
+
+        crud_app = Flask(__name__)
+        crud_app.secret_key = "key"
+
+        return crud_app
+
+    def create_tables(self):
+        db.create_all()
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.ctx.pop()
+
+class CrudTests(DatabaseTestCase):
+    """Tests crud functions for lists, playlists, paging and the profile against an in memory database."""
+
+    def test_bulk_sort_into_folder(self):
+        """Tests moving many media between lists at once"""
+
+        first, second, third = [media.media_id for media in self.medias]
+        db.session.add(crud.add_to_ToBeWatchedList(self.medias[0], self.user))
+        db.session.add(crud.add_to_WatchedList(self.medias[1], self.user))
+        db.session.commit()
+
+        results = crud.bulk_sort_into_folder([first, second, third, 999], self.user, "watched", date.today())
+        db.session.commit()
+
+        self.assertEqual([result["status"] for result in results], ["moved", "already_in_list", "added", "not_found"])
+        self.assertEqual(crud.get_media_ids_in_list(crud.WatchedList, [first, second, third], self.user), {first, second, third})
+        self.assertFalse(crud.user_sorted_ToBeWatched(self.medias[0], self.user))
+
+    def test_bulk_request_validation(self):
+        """Tests a bulk request with a bad or too many ids is turned down whole instead of partly done"""
+
+        with app.test_request_context(json={"mediaIDs": [3, "3", 4], "watchTime": "2022-12-31"}):
+            self.assertEqual(get_bulk_media_ids(), ([3, 4], None))
+            self.assertEqual(get_bulk_watch_time(), (date(2022, 12, 31), None))
+
+        for media_ids in (["3", "x"], [True], [1.5], list(range(MAX_BULK_MEDIA + 1)), "1,2"):
+            with app.test_request_context(json={"mediaIDs": media_ids}):
+                self.assertIsNotNone(get_bulk_media_ids()[1])
+
+        with app.test_request_context(json={"watchTime": "last tuesday"}):
+            self.assertIsNotNone(get_bulk_watch_time()[1])
+
+    def test_bulk_playlist_changes(self):
+        """Tests adding and removing many media from a playlist at once"""
+
+        playlist = crud.create_playlist("favorites", self.user)
+        db.session.add(playlist)
+        db.session.commit()
+        media_ids = [media.media_id for media in self.medias]
+
+        crud.bulk_add_to_playlist(media_ids, playlist)
+        results = crud.bulk_delete_from_playlist(media_ids[:2] + [999], playlist)
+        db.session.commit()
+
+        self.assertEqual([result["status"] for result in results], ["removed", "removed", "not_in_playlist"])
+        self.assertEqual(crud.get_media_ids_in_playlist(playlist, media_ids), {media_ids[2]})
+
+    def test_list_pages(self):
+        """Tests paging through a list with the after key"""
+
+        for media in self.medias:
+            db.session.add(crud.add_to_WatchedList(media, self.user))
+        db.session.commit()
+
+        first_page, next_after = crud.get_list_page(crud.WatchedList, self.user, limit=2)
+        second_page, last_after = crud.get_list_page(crud.WatchedList, self.user, after=next_after, limit=2)
+
+        self.assertEqual(first_page + second_page, self.medias)
+        self.assertIsNone(last_after)
+
+    def test_friend_ratings_page(self):
+        """Tests friends ratings show once each, even when a follow was saved twice"""
+
+        test2 = crud.get_user_by_username("test2")
+        media = self.medias[0]
+        db.session.add(crud.add_rating_to_db(5, test2.user_id, media.media_id))
+        db.session.add(crud.add_rating_to_db(2, test2.user_id, self.medias[1].media_id))
+        # a follow saved twice, from before follows were checked against the db
+        db.session.execute(friend.insert(), [{"f1_id": self.user.user_id, "f2_id": test2.user_id}] * 2)
+        db.session.commit()
+
+        ratings, next_after = crud.get_friend_ratings_page(media.media_id, self.user)
+
+        self.assertEqual([(rating.user.username, rating.score) for rating in ratings], [("test2", 5)])
+        self.assertIsNone(next_after)
+
+    def test_media_state(self):
+        """Tests the users state for a media after rating, sorting and adding it to a playlist"""
+
+        media = self.medias[0]
+        playlist = crud.create_playlist("favorites", self.user)
+        db.session.add(playlist)
+        db.session.add(crud.add_to_ToBeWatchedList(media, self.user))
+        db.session.commit()
+
+        save_rating(media, self.user, 4, "good")
+        add_to_user_playlist(media, self.user, playlist.playlist_id)
+        add_to_user_playlist(media, self.user, playlist.playlist_id)
+        state = get_media_state(media, self.user)
+
+        self.assertEqual((state["rating"]["score"], state["rating"]["review_input"]), (4, "good"))
+        self.assertEqual(state["lists"], {"watched": True, "to_be_watched": False})
+        self.assertEqual(state["playlists"], [{"playlist_id": playlist.playlist_id, "name": "favorites"}])
+
+        sort_into_folder(media, self.user, "to_be_watched")
+        self.assertEqual(get_media_state(media, self.user)["lists"], {"watched": False, "to_be_watched": True})
+
+    def test_rating_activity(self):
+        """Tests only a new rating or a changed score is shared with followers and counted towards trending"""
+
+        media = self.medias[0]
+        save_rating(media, self.user, 4, "good")
+        save_rating(media, self.user, 4, "still good")
+        save_rating(media, self.user, "4", None)
+        save_rating(media, self.user, 5, None)
+
+        self.assertEqual([activity.score for activity in Activity.query.order_by(Activity.activity_id)], [4, 5])
+        events = db.session.execute(select(func.sum(TrendBucket.events)).where(TrendBucket.media_id == media.media_id)).scalar()
+        self.assertEqual(events, 2 * crud.TREND_WEIGHTS["rated"])
+
+    def test_user_states(self):
+        """Tests getting the users state for a search grid at once"""
+
+        first, second, third = self.medias
+        db.session.add(crud.add_to_WatchedList(first, self.user))
+        db.session.add(crud.add_to_ToBeWatchedList(second, self.user))
+        db.session.add(crud.add_rating_to_db(4, self.user.user_id, first.media_id))
+        playlist = crud.create_playlist("Favorites", self.user)
+        db.session.add(playlist)
+        db.session.commit()
+        crud.bulk_add_to_playlist([first.media_id], playlist)
+        db.session.commit()
+
+        states = crud.get_user_states(self.user, [("movie", 1), ("movie", 2), ("movie", 3), ("tv", 1), ("movie", 999)])
+
+        self.assertEqual(set(states), {("movie", 1), ("movie", 2), ("movie", 3)})
+        self.assertEqual(states[("movie", 1)], {"watched": True, "to_be_watched": False, "score": 4,
+                                                "playlists": [{"playlist_id": playlist.playlist_id, "name": "Favorites"}]})
+        self.assertTrue(states[("movie", 2)]["to_be_watched"])
+        self.assertEqual(states[("movie", 3)], {"watched": False, "to_be_watched": False, "score": None, "playlists": []})
+
+    def test_user_data_etag(self):
+        """Tests that the users etag changes with their data, and a matching one gets a 304"""
+
+        etag = user_data_etag(self.user)
+        with self.crud_app.test_request_context(headers={"If-None-Match": f'"{etag}"'}):
+            self.assertEqual(user_data_not_modified(self.user).status_code, 304)
+
+        sort_into_folder(self.medias[0], self.user, "watched")
+
+        self.assertNotEqual(user_data_etag(self.user), etag)
+        with self.crud_app.test_request_context(headers={"If-None-Match": f'"{etag}"'}):
+            self.assertIsNone(user_data_not_modified(self.user))
+
+        # when the media was watched is in the watch history of everyone who watched it
+        etag = user_data_etag(self.user)
+        set_time_watched(self.medias[0], "2022-05-01")
+        self.assertNotEqual(user_data_etag(self.user), etag)
+
+        etag = user_data_etag(self.user)
+        set_time_watched(self.medias[0], "2022-05-01")
+        self.assertEqual(user_data_etag(self.user), etag)
+
+        # sorting into the list it's already in changes nothing
+        etag = user_data_etag(self.user)
+        sort_into_folder(self.medias[0], self.user, "watched")
+        self.assertEqual(user_data_etag(self.user), etag)
+        self.assertEqual(len(self.user.watched_list), 1)
+        self.assertEqual(Activity.query.filter_by(user_id=self.user.user_id, verb="watched").count(), 1)
+
+    def test_user_dashboard(self):
+        """Tests the dashboard matches the separate genre and watch history queries"""
+
+        drama = crud.add_genre_to_db({"id": 18, "name": "Drama"})
+        comedy = crud.add_genre_to_db({"id": 35, "name": "Comedy"})
+        self.medias[0].genres = [drama, comedy]
+        self.medias[1].genres = [drama]
+        self.medias[2].media_type = "tv"
+        for month, media in enumerate(self.medias, start=1):
+            media.time_watched = date(2022, month, 1)
+            db.session.add(crud.add_to_WatchedList(media, self.user))
+        db.session.add(crud.add_rating_to_db(4, self.user.user_id, self.medias[0].media_id))
+        db.session.commit()
+
+        dashboard = crud.get_user_dashboard(self.user)
+
+        self.assertEqual(dict(dashboard["genres"]), {genre.genre_name: total for genre, total in crud.get_user_genres(self.user).items()})
+        self.assertEqual(dashboard["genres"][0], ("Drama", 2))
+        self.assertEqual(dict(dashboard["movie_history"]), crud.get_user_movie_watch_history(self.user))
+        self.assertEqual(dict(dashboard["show_history"]), crud.get_user_show_watch_history(self.user))
+        self.assertEqual(dashboard["totals"], {"watched": 3, "to_be_watched": 0, "ratings": 1, "average_score": 4.0, "playlists": 0})
+
+        # someone else changing when a media was watched changes the cached dashboard too
+        set_time_watched(self.medias[0], "2022-05-01")
+        self.assertEqual(dict(crud.get_user_dashboard(self.user)["movie_history"]), {"2022-02": 1, "2022-05": 1})
+
+class SearchTests(DatabaseTestCase):
+    """Tests media and username search, autocomplete and multi-search."""
+
+    def test_search_local_media(self):
+        """Tests searching media saved in the db"""
+
+        results = crud.search_local_media("movie 2", "movie")
+
+        self.assertEqual(results, [self.medias[1]])
+        self.assertEqual(crud.search_local_media("movie", "tv"), [])
+
+    def test_search_usernames(self):
+        """Tests partial username search puts prefix matches first and leaves out the user"""
+
+        db.session.add(crud.create_user("my_test", "mytest@test.com", None))
+        db.session.commit()
+
+        users, next_offset = crud.search_usernames("test", self.user)
+
+        self.assertEqual([user.username for user in users], ["test2", "test3", "my_test"])
+        self.assertIsNone(next_offset)
+        self.assertEqual(crud.search_usernames("t_", self.user)[0], [])
+
+    def test_autocomplete(self):
+        """Tests title prefixes are matched from any word, most popular first"""
+
+        self.medias.append(Media(TMDB_id=4, media_type="tv", title="Movie Night Live"))
+        db.session.add(self.medias[-1])
+        db.session.add(crud.add_to_WatchedList(self.medias[1], self.user))
+        db.session.commit()
+
+        fetch_popular = autocomplete.fetch_popular
+        autocomplete.fetch_popular = lambda: [("movie", 50, "Amélie", "/a.jpg", 0)]
+        try:
+            index = autocomplete.TitleIndex()
+            index.load()
+        finally:
+            autocomplete.fetch_popular = fetch_popular
+
+        self.assertEqual([suggestion["id"] for suggestion in index.suggest("Movie", "movie")], [2, 1, 3])
+        self.assertEqual(index.suggest("mo", "movie")[0]["id"], 2)
+        self.assertEqual([suggestion["id"] for suggestion in index.suggest("night", limit=5)], [4])
+        self.assertEqual(index.suggest("ame")[0], {"id": 50, "media_type": "movie", "title": "Amélie", "poster_path": "/a.jpg"})
+        self.assertEqual(index.suggest("  "), [])
+
+    def test_autocomplete_loads_in_background(self):
+        """Tests a request doesn't wait for the title index to be built"""
+
+        index = autocomplete.TitleIndex()
+        release = threading.Event()
+        def load():
+            release.wait(5)
+            index.loaded_at = time.monotonic()
+        index.load = load
+
+        index.ensure_loaded()
+        self.assertIsNone(index.loaded_at)
+        self.assertEqual(index.suggest("movie"), [])
+
+        release.set()
+        index.loader.join(5)
+        self.assertIsNotNone(index.loaded_at)
+
+    def test_multi_search(self):
+        """Tests movie and tv are searched at the same time, and results past the deadline are left out"""
+
+        class Response:
+            def __init__(self, results):
+                self.results = results
+
+            def json(self):
+                return {"results": self.results}
+
+        # each search waits for the other to start, so they only finish if they run at the same time
+        started = {"search/movie": threading.Event(), "search/tv": threading.Event()}
+        # until set, the movie search hangs like a slow TMDB
+        movie_answers = threading.Event()
+        movie_answers.set()
+
+        def search(path, query):
+            started[path].set()
+            other = "search/tv" if path == "search/movie" else "search/movie"
+            if not started[other].wait(5):
+                raise tmdb.TMDBUnavailable()
+            if path == "search/movie":
+                movie_answers.wait(5)
+                return Response([{"id": 1, "original_title": "Dark", "popularity": 5}])
+            return Response([{"id": 1, "name": "Dark", "popularity": 50}, {"id": 2, "name": "The Dark Side", "popularity": 500}])
+
+        get = tmdb.get
+        tmdb.get = search
+        try:
+            results, degraded, partial = multi_search.search_tmdb("dark", deadline=5)
+
+            movie_answers.clear()
+            for event in started.values():
+                event.clear()
+            late_results, late_degraded, late_partial = multi_search.search_tmdb("dark", deadline=0.2)
+        finally:
+            movie_answers.set()
+            tmdb.get = get
+
+        self.assertEqual((len(results), degraded, partial), (3, False, False))
+        self.assertEqual({result["media_type"] for result in late_results}, {"tv"})
+        self.assertEqual((late_degraded, late_partial), (False, True))
+
+        local = {"id": 2, "name": "The Dark Side", "media_type": "tv", "source": "local"}
+        ranked = multi_search.rank_results("Dark", [local] + results)
+        self.assertEqual([(result["media_type"], result["id"]) for result in ranked], [("tv", 1), ("movie", 1), ("tv", 2)])
+        self.assertIs(ranked[2], local)
+
+class SocialTests(DatabaseTestCase):
+    """Tests following, friend suggestions and the activity feed."""
+
+    def test_friend_suggestions(self):
+        """Tests friends of friends are suggested and the cache clears when follows change"""
+
+        test2 = crud.get_user_by_username("test2")
+        test3 = crud.get_user_by_username("test3")
+        self.user.following.append(test2)
+        test2.following.append(test3)
+        db.session.add(crud.add_to_WatchedList(self.medias[0], self.user))
+        db.session.add(crud.add_to_WatchedList(self.medias[0], test3))
+        db.session.commit()
+
+        suggestions = crud.get_friend_suggestions(self.user)
+        db.session.commit()
+
+        self.assertEqual([(s["username"], s["mutual_count"], s["shared_watched"]) for s in suggestions], [("test3", 1, 1)])
+
+        # shared watched media only show up once the stored suggestions are old enough to be recomputed
+        db.session.add(crud.add_to_WatchedList(self.medias[1], self.user))
+        db.session.add(crud.add_to_WatchedList(self.medias[1], test3))
+        db.session.commit()
+        self.assertEqual(crud.get_friend_suggestions(self.user)[0]["shared_watched"], 1)
+
+        FriendSuggestions.query.get(self.user.user_id).refreshed_at -= crud.SUGGESTIONS_MAX_AGE
+        self.assertEqual(crud.get_friend_suggestions(self.user)[0]["shared_watched"], 2)
+        db.session.commit()
+
+        self.user.following.append(test3)
+        crud.invalidate_friend_suggestions_for_follow(self.user)
+        db.session.commit()
+
+        self.assertEqual(crud.get_friend_suggestions(self.user), [])
+
+    def test_adjacency_cache(self):
+        """Tests follow counts and checks, and that follows write through to the cache"""
+
+        test2 = crud.get_user_by_username("test2")
+        test3 = crud.get_user_by_username("test3")
+        self.user.following.append(test2)
+        test2.following.append(self.user)
+        db.session.commit()
+        cache = AdjacencyCache()
+
+        self.assertTrue(cache.is_following(self.user.user_id, test2.user_id))
+        self.assertEqual(cache.follower_count(self.user.user_id), 1)
+        self.assertEqual(len(self.user.get_all_friends()), 1)
+
+        cache.follow(test3.user_id, self.user.user_id)
+
+        self.assertEqual(cache.follower_count(self.user.user_id), 2)
+        self.assertEqual(cache.follower_count(test2.user_id), 1)
+
+        cache.unfollow(self.user.user_id, test2.user_id)
+
+        self.assertFalse(cache.is_following(self.user.user_id, test2.user_id))
+        self.assertEqual(cache.follower_count(test2.user_id), 0)
+
+    def test_follow_user(self):
+        """Tests following twice saves one follow and unfollowing removes every saved copy"""
+
+        test2 = crud.get_user_by_username("test2")
+        crud.add_activities(test2, "watched", [self.medias[0].media_id])
+        db.session.commit()
+
+        self.assertTrue(crud.follow_user(self.user, test2))
+        db.session.commit()
+        self.assertFalse(crud.follow_user(self.user, test2))
+        db.session.commit()
+
+        follows = select(func.count()).select_from(friend).where(friend.c.f1_id == self.user.user_id)
+        self.assertEqual(db.session.execute(follows).scalar(), 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.user.user_id).count(), 1)
+
+        # a follow saved twice before follows were checked
+        db.session.execute(friend.insert().values(f1_id=self.user.user_id, f2_id=test2.user_id))
+        db.session.commit()
+
+        self.assertTrue(crud.unfollow_user(self.user, test2))
+        db.session.commit()
+        self.assertEqual(db.session.execute(follows).scalar(), 0)
+        self.assertFalse(crud.unfollow_user(self.user, test2))
+
+    def test_friends_activity(self):
+        """Tests fanning activity out to followers, pulling it in for popular users, and paging the feed"""
+
+        test2 = crud.get_user_by_username("test2")
+        test3 = crud.get_user_by_username("test3")
+        test2.following.append(self.user)
+        test2.following.append(test3)
+        db.session.commit()
+
+        crud.add_activities(self.user, "watched", [media.media_id for media in self.medias])
+        db.session.commit()
+
+        # test3 counts as popular, so their activity isn't copied into timelines
+        crud.FANOUT_MAX_FOLLOWERS = 0
+        try:
+            popular, = crud.add_activities(test3, "rated", [self.medias[0].media_id], score=5)
+            db.session.commit()
+        finally:
+            crud.FANOUT_MAX_FOLLOWERS = 5000
+
+        self.assertFalse(popular.fanned_out)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=test2.user_id).count(), 3)
+
+        first_page, next_after = crud.get_feed_page(test2, limit=2)
+        second_page, last_after = crud.get_feed_page(test2, after=next_after, limit=2)
+
+        self.assertEqual([activity.verb for activity in first_page], ["rated", "watched"])
+        self.assertEqual(len(second_page), 2)
+        self.assertIsNone(last_after)
+        self.assertEqual(crud.get_feed_page(self.user), ([], None))
+
+        crud.remove_from_timeline(test2, self.user)
+        db.session.commit()
+
+        self.assertEqual(len(crud.get_feed_page(test2)[0]), 1)
+
+class RecommendationTests(DatabaseTestCase):
+    """Tests recommendations, more like this and trending."""
+
+    def test_item_neighbors(self):
+        """Tests recommending media liked by people who rated the same media alike"""
+
+        first, second, third = [media.media_id for media in self.medias]
+        neighbors = recommender.compute_item_neighbors({1: {first: 5, second: 1, third: 5}, 2: {first: 4, second: 2, third: 4}})
+
+        self.assertEqual([neighbor_id for similarity, neighbor_id in neighbors[first]], [third])
+        self.assertNotIn(second, [neighbor_id for similarity, neighbor_id in neighbors[third]])
+
+        test2 = crud.get_user_by_username("test2")
+        test3 = crud.get_user_by_username("test3")
+        for user, scores in [(self.user, [5, 1]), (test2, [5, 1, 5]), (test3, [4, 2, 4])]:
+            for media, score in zip(self.medias, scores):
+                db.session.add(crud.add_rating_to_db(score, user.user_id, media.media_id))
+        db.session.commit()
+
+        recommender.rebuild_item_neighbors()
+
+        self.assertEqual(recommender.get_recommendations(self.user), [self.medias[2]])
+        self.assertEqual(recommender.get_recommendations(test2), [])
+
+        # watching it takes it out of the cached recommendations
+        sort_into_folder(self.medias[2], self.user, "watched")
+        self.assertEqual(recommender.get_recommendations(self.user), [])
+
+    def test_similar_media(self):
+        """Tests more like this from overviews and genres, and adding new media to it"""
+
+        titles = ["Voyage", "Croissant", "Orbit"]
+        overviews = ["A space crew travels to a distant planet", "A baker opens a bakery in Paris", "Astronauts on a space station above a planet"]
+        for media, title, overview in zip(self.medias, titles, overviews):
+            media.title = title
+            media.overview = overview
+        db.session.commit()
+
+        similar_media.rebuild_similar_media()
+
+        self.assertEqual(similar_media.get_similar_media(self.medias[0]), [self.medias[2]])
+        self.assertEqual(similar_media.get_similar_media(self.medias[1]), [])
+
+        new_media = Media(TMDB_id=4, media_type="movie", title="Bakery", overview="Two bakers compete at a Paris bakery")
+        db.session.add(new_media)
+        db.session.commit()
+        similar_media.add_media(new_media)
+        db.session.commit()
+
+        self.assertEqual(similar_media.get_similar_media(new_media), [self.medias[1]])
+        self.assertEqual(similar_media.get_similar_media(self.medias[1]), [new_media])
+
+        # media saved by other workers are caught up into the content index and the ann index
+        with tempfile.TemporaryDirectory() as directory:
+            media_ann_index = similar_media.media_ann_index
+            similar_media.media_ann_index = IvfIndex(os.path.join(directory, "media.idx"))
+            try:
+                with similar_media.content_index.lock:
+                    similar_media.build_ann_index()
+
+                other_media = Media(TMDB_id=5, media_type="movie", title="Patisserie", overview="A Paris bakery in trouble")
+                db.session.add(other_media)
+                db.session.commit()
+                similar_media.content_index.loaded_at -= similar_media.INDEX_TTL_SECONDS + 1
+                job_queue.add_similar_media(other_media.media_id)
+                db.session.commit()
+
+                self.assertIn(other_media.media_id, similar_media.media_ann_index.media_ids())
+                self.assertIn(other_media, similar_media.get_similar_media(new_media))
+            finally:
+                similar_media.media_ann_index = media_ann_index
+
+    def test_ann_index(self):
+        """Tests the ivf index against exact search, reloading it from disk, adding to it, and rebuilding it"""
+
+        rng = random.Random(0)
+        centers = [[rng.gauss(0, 1) for i in range(16)] for center in range(20)]
+        vectors = [[value + rng.gauss(0, 0.3) for value in centers[i % 20]] for i in range(1000)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = IvfIndex(os.path.join(directory, "media.idx"))
+            index.build(list(range(1000)), vectors)
+
+            result = benchmark(index, vectors[:50], k=10, nprobe=4)
+            self.assertGreater(result["recall"], 0.9)
+            self.assertEqual(index.search(vectors[3], k=1)[0][1], 3)
+
+            reloaded = IvfIndex(index.path)
+            self.assertEqual(reloaded.search(vectors[7], k=5), index.search(vectors[7], k=5))
+
+            new_vector = [value * 2 for value in vectors[5]]
+            self.assertTrue(index.add(1000, new_vector))
+            self.assertEqual(len(reloaded), 1001)
+            self.assertIn(1000, [media_id for score, media_id in reloaded.search(vectors[5], k=2)])
+
+            # the build picked an nprobe with the target recall
+            self.assertGreaterEqual(benchmark(index, vectors[50:100], k=10)["recall"], 0.9)
+
+            # vectors added while a build runs are kept
+            index.rotate_delta()
+            self.assertTrue(index.add(1001, vectors[9]))
+            index.build(list(range(1000)), vectors)
+            self.assertIn(1001, IvfIndex(index.path).media_ids())
+
+    def test_recommendation_job(self):
+        """Tests merging the recommendations of several seeds, leaving out media the user knows"""
+
+        watched, rated, to_be_watched = self.medias
+        db.session.add(crud.add_to_WatchedList(watched, self.user))
+        db.session.add(crud.add_rating_to_db(5, self.user.user_id, rated.media_id))
+        db.session.add(crud.add_to_ToBeWatchedList(to_be_watched, self.user))
+        db.session.commit()
+
+        tmdb_results = {
+            watched.TMDB_id: [{"id": 100, "title": "Both"}, {"id": 101, "title": "One"}, {"id": watched.TMDB_id, "title": "Seen"}],
+            rated.TMDB_id: [{"id": 102, "title": "Two"}, {"id": 100, "title": "Both"}],
+            to_be_watched.TMDB_id: [{"id": rated.TMDB_id, "title": "Rated"}],
+        }
+        fetch_recommendations = recommendation_job.fetch_recommendations
+        recommendation_job.fetch_recommendations = lambda media_type, TMDB_id: tmdb_results[TMDB_id]
+        try:
+            self.assertEqual(recommendation_job.run([self.user.user_id]), [])
+        finally:
+            recommendation_job.fetch_recommendations = fetch_recommendations
+
+        recommendations = crud.get_user_recommendations(self.user, "movie")
+
+        self.assertEqual([recommendation.TMDB_id for recommendation in recommendations], [100, 102, 101])
+        self.assertEqual(crud.get_user_recommendations(self.user, "tv"), [])
+
+        # watched after the recommendations were made
+        seen = Media(TMDB_id=100, media_type="movie", title="Both")
+        db.session.add(seen)
+        db.session.flush()
+        db.session.add(crud.add_to_WatchedList(seen, self.user))
+        db.session.commit()
+
+        recommendations = crud.get_user_recommendations(self.user, "movie")
+        self.assertEqual([recommendation.TMDB_id for recommendation in recommendations], [102, 101])
+
+    def test_tmdb_recommendations_cache(self):
+        """Tests TMDB recommendations are shared between seeds until their ttl runs out"""
+
+        class Response:
+            ok = True
+
+            def json(self):
+                return {"results": [{"id": 100}]}
+
+        calls = []
+        def recommendations(path):
+            calls.append(path)
+            return Response()
+
+        get = tmdb.get
+        tmdb.get = recommendations
+        try:
+            recommendation_job.fetch_recommendations("movie", 1)
+            self.assertEqual(recommendation_job.fetch_recommendations("movie", 1), ({"id": 100},))
+
+            # as if the ttl ran out
+            recommendation_job.tmdb_recommendations_cache.invalidate("movie/1")
+            recommendation_job.fetch_recommendations("movie", 1)
+        finally:
+            tmdb.get = get
+
+        self.assertEqual(calls, ["movie/1/recommendations"] * 2)
+
+    def test_local_trending(self):
+        """Tests that recent activity outweighs older activity, and the windows it counts in"""
+
+        first, second, third = [media.media_id for media in self.medias]
+        now = time.time()
+
+        for i in range(3):
+            crud.add_trend_events("watched", [first], timestamp=now - 3 * 3600)
+        crud.add_trend_events("rated", [second], timestamp=now - 60)
+        crud.add_trend_events("to_be_watched", [third], timestamp=now - 3 * 24 * 3600)
+        db.session.commit()
+
+        self.assertEqual([media_id for score, media_id in trending.compute_trending("hour", now)], [second])
+        self.assertEqual([media_id for score, media_id in trending.compute_trending("day", now)], [first, second])
+        self.assertEqual([media_id for score, media_id in trending.compute_trending("week", now)], [first, second, third])
+
+class CacheTests(DatabaseTestCase):
+    """Tests the shared cache."""
+
+    def test_local_cache_backend(self):
+        """Tests values expire after their ttl, and the least recently used key is dropped first"""
+
+        backend = cache.LocalBackend(max_entries=2)
+        backend.set("one", b"1", ttl=60)
+        backend.set("two", b"2", ttl=60)
+        backend.get("one")
+        backend.set("three", b"3", ttl=60)
+
+        self.assertEqual(backend.get("one"), b"1")
+        self.assertIsNone(backend.get("two"))
+
+        backend.set("expired", b"4", ttl=-1)
+        self.assertIsNone(backend.get("expired"))
+
+    def test_cache_namespaces(self):
+        """Tests keys are kept apart by namespace and version, and clearing a namespace"""
+
+        fragments = cache.Cache("test_fragments")
+        pages = cache.Cache("test_pages")
+        computed = []
+
+        fragments.set("movie/1", {"title": "One"}, version=1)
+        pages.set("movie/1", None)
+
+        self.assertEqual(fragments.get("movie/1", version=1), {"title": "One"})
+        self.assertIsNone(fragments.get("movie/1", version=2))
+        self.assertEqual(pages.get("movie/1", default="missing"), None)
+        self.assertEqual(pages.get_or_set("movie/1", lambda: computed.append(1)), None)
+        self.assertEqual(computed, [])
+
+        fragments.clear()
+        self.assertIsNone(fragments.get("movie/1", version=1))
+        self.assertEqual(pages.get("movie/1", default="missing"), None)
+
+    def test_cache_stampede(self):
+        """Tests a request waits for the value another request is computing instead of computing it too"""
+
+        shared = cache.Cache("test_stampede")
+        computed = []
+        lock_key = f"{shared.make_key('popular')}:lock"
+        cache.get_backend().add(lock_key, b"1", cache.LOCK_SECONDS)
+
+        # the other request finishes while this one waits
+        threading.Timer(0.1, lambda: shared.set("popular", "from the other request")).start()
+
+        self.assertEqual(shared.get_or_set("popular", lambda: computed.append(1) or "computed"), "from the other request")
+        self.assertEqual(computed, [])
+
+class JobQueueTests(DatabaseTestCase):
+    """Tests the background job queue."""
+
+    def test_job_queue(self):
+        """Tests jobs run by priority, are only enqueued once per idempotency key, and retry until they fail"""
+
+        ran = []
+        job_queue.task("test_record")(lambda name: ran.append(name))
+        job_queue.task("test_fail")(lambda: 1 / 0)
+        self.addCleanup(job_queue.TASKS.pop, "test_record")
+        self.addCleanup(job_queue.TASKS.pop, "test_fail")
+
+        job_queue.enqueue("test_record", {"name": "low"})
+        job_queue.enqueue("test_record", {"name": "high"}, priority=5)
+        first = job_queue.enqueue("test_record", {"name": "once"}, idempotency_key="once")
+        again = job_queue.enqueue("test_record", {"name": "twice"}, idempotency_key="once")
+        failing = job_queue.enqueue("test_fail", max_attempts=2)
+        db.session.commit()
+
+        self.assertEqual(first, again)
+        self.assertEqual(job_queue.work(once=True), 4)
+        self.assertEqual(ran, ["high", "low", "once"])
+
+        # the failed job waits out its backoff before its last attempt
+        job = db.session.get(Job, failing)
+        self.assertEqual((job.status, job.attempts), ("queued", 1))
+        job.run_at = job.created_at
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(once=True), 1)
+        job = db.session.get(Job, failing)
+        self.assertEqual(job.status, "failed")
+        self.assertIn("ZeroDivisionError", job.last_error)
+        self.assertEqual(job_queue.retry_failed(), 1)
+
+    def test_warm_dashboard(self):
+        """Tests changing a users lists has a worker compute their dashboard ahead of time, when the cache is shared"""
+
+        sort_into_folder(self.medias[0], self.user, "to_be_watched")
+        self.assertEqual(Job.query.filter_by(task="warm_dashboard").count(), 0)
+
+        # stands in for redis, the worker runs in this process
+        cache.get_backend().shared = True
+        try:
+            sort_into_folder(self.medias[0], self.user, "watched")
+        finally:
+            del cache.get_backend().shared
+        job = Job.query.filter_by(task="warm_dashboard").one()
+        job.run_at = job.created_at
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(once=True), 1)
+        dashboard = crud.dashboard_cache.get(self.user.user_id, version=self.user.data_version)
+        self.assertEqual(dashboard["totals"]["watched"], 1)
+
+class TMDBTests(DatabaseTestCase):
+    """Tests TMDB snapshots and the circuit breaker."""
+
+    def test_tmdb_snapshot(self):
+        """Tests a stale TMDB snapshot is fetched again by a worker"""
+
+        media = self.medias[0]
+        crud.update_tmdb_snapshot(media, {"original_title": "Old Title", "overview": "Old", "poster_path": "/old.jpg"})
+        self.assertFalse(crud.snapshot_is_stale(media))
+
+        media.tmdb_fetched_at = datetime.now() - crud.SNAPSHOT_MAX_AGE - timedelta(minutes=1)
+        job_queue.enqueue("refresh_tmdb_snapshot", {"media_id": media.media_id})
+        db.session.commit()
+        self.assertTrue(crud.snapshot_is_stale(media))
+
+        get_details = tmdb.get_details
+        long_title = "New Title" + " and more" * 10
+        tmdb.get_details = lambda media_type, TMDB_id: {"original_title": long_title, "overview": "New", "poster_path": "/new.jpg"}
+        try:
+            job_queue.work(once=True)
+        finally:
+            tmdb.get_details = get_details
+
+        # cut to fit the title column, the snapshot keeps all of it
+        media = db.session.get(Media, media.media_id)
+        self.assertEqual((media.title, media.tmdb_snapshot["overview"]), (long_title[:crud.MAX_TITLE_LENGTH], "New"))
+        self.assertFalse(crud.snapshot_is_stale(media))
+
+    def test_circuit_breaker(self):
+        """Tests the TMDB breaker opens on failures and slow calls, and closes after a good probe"""
+
+        now = [0]
+        breaker = tmdb.CircuitBreaker(min_calls=4, slow_seconds=3, open_seconds=30, clock=lambda: now[0])
+
+        for ok in (True, False, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record(ok, 0.1)
+        self.assertFalse(breaker.allow())
+
+        # one probe at a time once it has been open long enough
+        now[0] = 31
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False, 0.1)
+        self.assertFalse(breaker.allow())
+
+        now[0] = 62
+        self.assertTrue(breaker.allow())
+        breaker.record(True, 0.1)
+        self.assertFalse(breaker.is_open())
+
+        for seconds in (5, 5, 0.1, 5):
+            breaker.record(True, seconds)
+        self.assertTrue(breaker.is_open())
+
+class RouteTests(DatabaseTestCase):
+    """Tests the JSON routes through the test client: bad payloads get a 400, and logged out requests a 401."""
+
+    def make_app(self):
+        app.config["TESTING"] = True
+
+        return app
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+    def log_in(self, username="test1"):
+        with self.client.session_transaction() as sess:
+            sess["username"] = username
+
+    def test_bulk_routes(self):
+        """Tests the bulk routes turn down logged out users and malformed batches"""
+
+        sort_url = "/user-profile/bulk-sort-folder.json"
+        for url in (sort_url, "/user-profile/bulk-delete-from-list.json",
+                    "/user-profile/bulk-add-to-playlist.json", "/user-profile/bulk-delete-from-playlist.json"):
+            self.assertEqual(self.client.post(url, json={"list": "watched", "mediaIDs": [1]}).status_code, 401)
+
+        self.log_in()
+        for payload in ({"list": "watched", "mediaIDs": ["²"]}, {"list": "watched", "mediaIDs": 5},
+                        {"list": "seen", "mediaIDs": [1]}, {"list": "watched", "mediaIDs": [1], "watchTime": "yesterday"},
+                        ["not", "an", "object"]):
+            self.assertEqual(self.client.post(sort_url, json=payload).status_code, 400, payload)
+
+        result = self.client.post(sort_url, json={"list": "watched", "mediaIDs": [self.medias[0].media_id, 999]})
+        self.assertEqual([item["status"] for item in result.json["results"]], ["added", "not_found"])
+
+        for playlist_id in (999, "²", "x", None):
+            for url in ("/user-profile/bulk-add-to-playlist.json", "/user-profile/bulk-delete-from-playlist.json"):
+                result = self.client.post(url, json={"playlistID": playlist_id, "mediaIDs": [1]})
+                self.assertEqual(result.status_code, 404, (url, playlist_id))
+
+        playlist = crud.create_playlist("Favorites", self.user)
+        db.session.add(playlist)
+        db.session.commit()
+        result = self.client.post("/user-profile/bulk-add-to-playlist.json",
+                                  json={"playlistID": str(playlist.playlist_id), "mediaIDs": [self.medias[1].media_id, "²"]})
+        self.assertEqual(result.status_code, 400)
+        result = self.client.post("/user-profile/bulk-add-to-playlist.json",
+                                  json={"playlistID": str(playlist.playlist_id), "mediaIDs": [self.medias[1].media_id]})
+        self.assertEqual([item["status"] for item in result.json["results"]], ["added"])
+
+    def test_search_friends_json(self):
+        """Tests the friend search turns down logged out users and keeps the offset in range"""
+
+        self.assertEqual(self.client.get("/search-friends.json?q=test").status_code, 401)
+
+        self.log_in()
+        result = self.client.get("/search-friends.json?q=test&offset=-5")
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("test2", [user["username"] for user in result.json["users"]])
+
+    def test_friend_suggestions_json(self):
+        """Tests friend suggestions turn down logged out users"""
+
+        self.assertEqual(self.client.get("/friend-suggestions.json").status_code, 401)
+
+        self.log_in()
+        result = self.client.get("/friend-suggestions.json")
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("suggestions", result.json)
+
+    def test_friend_pages(self):
+        """Tests friend profiles and follows need a login, and unknown users get a 404"""
+
+        self.assertEqual(self.client.get("/display-friend/test2").location, "/")
+        self.assertEqual(self.client.post("/friend/follow-status.js", json={"user2ID": 2, "action": "follow"}).status_code, 401)
+
+        self.log_in()
+        self.assertEqual(self.client.get("/display-friend/nobody").status_code, 404)
+        self.assertEqual(self.client.get("/display-friend/test2").status_code, 200)
+
+        test2 = crud.get_user_by_username("test2")
+        for payload in ({"user2ID": 999, "action": "follow"}, {"user2ID": "²", "action": "follow"}, {"user2ID": test2.user_id, "action": "like"}):
+            self.assertIn(self.client.post("/friend/follow-status.js", json=payload).status_code, (400, 404), payload)
+
+        result = self.client.post("/friend/follow-status.js", json={"user2ID": str(test2.user_id), "action": "follow"})
+        self.assertTrue(result.json["following"])
+        self.assertTrue(crud.is_following(self.user, test2))
+
+    def test_friends_activity_json(self):
+        """Tests the friends feed turns down logged out users"""
+
+        self.assertEqual(self.client.get("/friends-activity.json").status_code, 401)
+
+        self.log_in()
+        result = self.client.get("/friends-activity.json")
+        self.assertEqual(result.json, {"items": [], "next_after": None})
+
+    def test_media_json_routes(self):
+        """Tests rating, sorting and adding to a playlist from the media page turn down logged out users and bad input"""
+
+        rating_url = "/media-info/movie/1/rating.json"
+        sort_url = "/movie/1/sort-folder.json"
+        playlist_url = "/movie/1/add-to-playlist.json"
+        for url, payload in ((rating_url, {"score": "5"}), (sort_url, {"list": "watched"}), (playlist_url, {"playlistID": "1"})):
+            self.assertEqual(self.client.post(url, json=payload).status_code, 401)
+
+        self.log_in()
+        for url, payload in ((rating_url, {"score": "6"}), (rating_url, {"score": [5]}), (rating_url, {"score": 5, "comment": {}}),
+                             (rating_url, ["not", "an", "object"]), (sort_url, {"list": "seen"}), (playlist_url, {"playlistID": "²"})):
+            self.assertEqual(self.client.post(url, json=payload).status_code, 400, payload)
+        self.assertEqual(self.client.post("/book/1/sort-folder.json", json={"list": "watched"}).status_code, 404)
+
+        result = self.client.post(rating_url, json={"score": "4", "comment": "good", "watchTime": "2022-05-01"})
+        self.assertEqual(result.json["rating"]["score"], 4)
+        self.assertTrue(result.json["lists"]["watched"])
+
+    def test_dashboard_json(self):
+        """Tests the dashboard turns down logged out users, and answers a matching etag with a 304"""
+
+        self.assertEqual(self.client.get("/user-profile/dashboard.json").status_code, 401)
+
+        self.log_in()
+        result = self.client.get("/user-profile/dashboard.json")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self.client.get("/user-profile/dashboard.json", headers={"If-None-Match": result.headers["ETag"]}).status_code, 304)
+
+    def test_media_page_fragments(self):
+        """Tests a refreshed snapshot isn't hidden by fragments cached from the old one, wherever it was refreshed"""
+
+        media = self.medias[0]
+        crud.update_tmdb_snapshot(media, {"original_title": "Old Title", "overview": "Old", "poster_path": "/old.jpg"})
+        db.session.commit()
+        self.assertIn(b"Old Title", self.client.get("/media-info/movie/1").data)
+
+        # saved by a worker in another process, so nothing here was invalidated
+        crud.update_tmdb_snapshot(media, {"original_title": "New Title", "overview": "New", "poster_path": "/new.jpg"})
+        media.tmdb_fetched_at += timedelta(seconds=1)
+        db.session.commit()
+        self.assertIn(b"New Title", self.client.get("/media-info/movie/1").data)
+
+    def test_media_state_json(self):
+        """Tests the search grid states are empty for guests and turn down items that aren't a list of media"""
+
+        # guests can search too, they just have no lists
+        result = self.client.post("/media-state.json", json={"items": [{"mediaType": "movie", "TMDB_id": 1}]})
+        self.assertEqual(result.json, {"states": {}})
+
+        self.log_in()
+        for payload in ({"items": 5}, {"items": "movie/1"}, {"items": [5]}, {"items": [{"mediaType": "movie"}]},
+                        {"items": [{"mediaType": "movie", "TMDB_id": "x"}] * (crud.MAX_STATE_ITEMS + 1)}):
+            self.assertEqual(self.client.post("/media-state.json", json=payload).status_code, 400, payload)
+
+        result = self.client.post("/media-state.json", json={"items": [{"mediaType": "movie", "TMDB_id": 1}]})
+        self.assertEqual(result.json["states"]["movie/1"]["watched"], False)
+
+class PostgresTests(DatabaseTestCase):
+    """Tests the postgres only queries: full text and trigram search, upserts and SKIP LOCKED.
+    Runs against TEST_DATABASE_URL (postgresql:///testdb by default), skipped if it can't be reached."""
+
+    db_uri = os.environ.get("TEST_DATABASE_URL", "postgresql:///testdb")
+
+    def create_tables(self):
+        try:
+            db.create_all()
+        except OperationalError as error:
+            self.ctx.pop()
+            self.skipTest(f"no postgres test database: {error.orig}")
+
+    def test_search_local_media_full_text(self):
+        """Tests media are found by words in their overview and by misspelled titles"""
+
+        heist = Media(TMDB_id=10, media_type="movie", title="Inside Job", overview="A heist on a space station")
+        space = Media(TMDB_id=11, media_type="movie", title="Interstellar", overview="Explorers travel through a wormhole")
+        db.session.add_all([heist, space])
+        db.session.commit()
+
+        self.assertEqual(crud.search_local_media("heists", "movie"), [heist])
+        self.assertEqual(crud.search_local_media("Intersteller", "movie"), [space])
+        self.assertEqual(crud.search_local_media("wormhole", None), [space])
+
+    def test_search_usernames_fuzzy(self):
+        """Tests the trigram index finds misspelled usernames"""
+
+        db.session.add(crud.create_user("filmfanatic", "fan@test.com", None))
+        db.session.commit()
+
+        users, next_offset = crud.search_usernames("filmfanatik", self.user)
+
+        self.assertEqual([user.username for user in users], ["filmfanatic"])
+
+    def test_trend_upsert(self):
+        """Tests events in the same bucket add up with ON CONFLICT DO UPDATE"""
+
+        media_id = self.medias[0].media_id
+        crud.add_trend_events("watched", [media_id])
+        crud.add_trend_events("watched", [media_id])
+        db.session.commit()
+
+        self.assertEqual(TrendBucket.query.filter_by(media_id=media_id).one().events, 2 * crud.TREND_WEIGHTS["watched"])
+
+    def test_enqueue_idempotent(self):
+        """Tests a job enqueued twice with the same key is only added once"""
+
+        first = job_queue.enqueue("rebuild_item_neighbors", idempotency_key="nightly")
+        second = job_queue.enqueue("rebuild_item_neighbors", idempotency_key="nightly")
+        db.session.commit()
+
+        self.assertEqual(first, second)
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_claim_job_skip_locked(self):
+        """Tests a worker skips the job another worker has locked instead of waiting for it"""
+
+        locked = job_queue.enqueue("rebuild_item_neighbors", priority=1)
+        other = job_queue.enqueue("rebuild_similar_media")
+        db.session.commit()
+
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute(select(Job.job_id).where(Job.job_id == locked).with_for_update())
+
+            self.assertEqual(job_queue.claim_job("worker-2").job_id, other)
+            transaction.rollback()
+
+        self.assertEqual(job_queue.claim_job("worker-2").job_id, locked)
+
+    def test_job_heartbeat(self):
+        """Tests a job that runs longer than the timeout isn't queued again while its heartbeats keep coming"""
+
+        statuses = []
+        def slow():
+            time.sleep(0.6)
+            job_queue.maintain()
+            statuses.append(db.session.execute(select(Job.status).where(Job.task == "test_slow")).scalar())
+
+        job_queue.task("test_slow")(slow)
+        self.addCleanup(job_queue.TASKS.pop, "test_slow")
+        for name, value in [("HEARTBEAT_SECONDS", 0.1), ("JOB_TIMEOUT_SECONDS", 0.3)]:
+            self.addCleanup(setattr, job_queue, name, getattr(job_queue, name))
+            setattr(job_queue, name, value)
+
+        job_queue.enqueue("test_slow")
+        db.session.commit()
+
+        self.assertEqual(job_queue.work(once=True), 1)
+        self.assertEqual(statuses, ["running"])
+
+    def test_replica_routing(self):
+        """Tests GET reads go to the replica engine and still get results"""
+
+        replica_app = Flask(__name__)
+        replica_app.secret_key = "key"
+        connect_to_db(replica_app, self.db_uri, replica_uri=self.db_uri)
+
+        with replica_app.test_request_context("/", method="GET"):
+            self.assertIs(db.session.get_bind(inspect(User)), db.get_engine(bind="replica"))
+            self.assertEqual(crud.get_user_by_username("test1").email, "test1@test.com")
+            db.session.remove()
+            for bind in (None, "replica"):
+                db.get_engine(bind=bind).dispose()
+
+        # back to the test's own app for tearDown
+        connect_to_db(self.crud_app, self.db_uri)
+
 if __name__ == "__main__":
     import unittest
 
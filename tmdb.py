@@ -0,0 +1,134 @@
+"""Client for the TMDB api.
+
+Every call goes through a circuit breaker, so when TMDB is down or slow the site
+stops waiting on it and serves what it has saved instead."""
+
+from collections import deque
+import os
+import threading
+import time
+
+import requests
+
+API_URL = "https://api.themoviedb.org/3"
+API_KEY = os.environ.get("TMDB_KEY")
+TIMEOUT_SECONDS = 5
+
+# the breaker opens when at least half of the calls in the window failed or were slow
+WINDOW_SECONDS = 30
+MIN_CALLS = 10
+FAILURE_RATE = 0.5
+SLOW_SECONDS = 3
+SLOW_RATE = 0.5
+# how long it stays open before one call is let through to see if TMDB is back
+OPEN_SECONDS = 30
+
+
+class TMDBUnavailable(Exception):
+    """TMDB is down, too slow, or the breaker is open"""
+
+
+class CircuitBreaker:
+    """Tracks the calls of the last window_seconds.
+
+    closed: calls go through. open: calls fail right away for open_seconds.
+    half open: one probe call goes through, closing the breaker if it works and opening it again if not."""
+
+    def __init__(self, window_seconds=WINDOW_SECONDS, min_calls=MIN_CALLS, failure_rate=FAILURE_RATE,
+                 slow_seconds=SLOW_SECONDS, slow_rate=SLOW_RATE, open_seconds=OPEN_SECONDS, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (finished at, ok, slow)
+        self.calls = deque()
+        self.state = "closed"
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        """Whether a call may go to TMDB now"""
+
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and self.clock() - self.opened_at >= self.open_seconds:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record(self, ok, seconds):
+        """Records how a call that was allowed went"""
+
+        now = self.clock()
+        slow = seconds >= self.slow_seconds
+
+        with self.lock:
+            if self.state == "half_open":
+                self.probing = False
+                if ok and not slow:
+                    self.state = "closed"
+                    self.calls.clear()
+                else:
+                    self.trip(now)
+                return
+
+            self.calls.append((now, ok, slow))
+            while self.calls and self.calls[0][0] < now - self.window_seconds:
+                self.calls.popleft()
+
+            if self.state == "closed" and len(self.calls) >= self.min_calls:
+                failed = sum(1 for finished_at, call_ok, call_slow in self.calls if not call_ok)
+                slowed = sum(1 for finished_at, call_ok, call_slow in self.calls if call_slow)
+                if failed / len(self.calls) >= self.failure_rate or slowed / len(self.calls) >= self.slow_rate:
+                    self.trip(now)
+
+    def trip(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.calls.clear()
+
+    def is_open(self):
+        with self.lock:
+            return self.state != "closed"
+
+
+breaker = CircuitBreaker()
+
+def is_degraded():
+    """Whether pages should say TMDB data may be missing or out of date"""
+
+    return breaker.is_open()
+
+def get(path, **params):
+    """GETs a path of the TMDB api, returns the response, raises TMDBUnavailable when TMDB can't be reached"""
+
+    if not breaker.allow():
+        raise TMDBUnavailable(f"circuit open, not calling TMDB for {path}")
+
+    started = time.monotonic()
+    try:
+        res = requests.get(f"{API_URL}/{path}", params={"api_key": API_KEY, **params}, timeout=TIMEOUT_SECONDS)
+    except requests.RequestException as error:
+        breaker.record(False, time.monotonic() - started)
+        raise TMDBUnavailable(str(error)) from error
+
+    # a missing title is TMDB working, errors on its side and rate limiting are not
+    breaker.record(res.status_code < 500 and res.status_code != 429, time.monotonic() - started)
+
+    return res
+
+def get_details(media_type, TMDB_id):
+    """The full details of a movie or show, raises for an error response"""
+
+    res = get(f"{media_type}/{TMDB_id}")
+    res.raise_for_status()
+
+    return res.json()
@@ -0,0 +1,54 @@
+"""What is trending on MyViews: time decayed counts of local activity over the last hour, day and week."""
+
+import heapq
+import time
+
+from sqlalchemy import select
+
+from model import db, Media, TrendBucket
+from crud import BUCKET_SECONDS, get_bucket
+from cache import Cache
+
+# window: (how far back it looks, how long until a bucket counts for half as much)
+WINDOWS = {
+    "hour": (3600, 20 * 60),
+    "day": (24 * 3600, 6 * 3600),
+    "week": (7 * 24 * 3600, 2 * 24 * 3600),
+}
+TOP_K = 50
+# the top media are recomputed this often, by one worker for all of them
+REFRESH_SECONDS = 60
+
+
+def compute_trending(window, now=None, k=TOP_K):
+    """Decayed score of every media with activity in the window, the top k: [(score, media_id)]"""
+
+    span, half_life = WINDOWS[window]
+    current = get_bucket(now)
+    first = get_bucket((now or time.time()) - span) + 1
+
+    # one weight per bucket age, a bucket half_life old counts half
+    decay = [0.5 ** (age * BUCKET_SECONDS / half_life) for age in range(current - first + 1)]
+
+    scores = {}
+    rows = db.session.execute(select(TrendBucket.media_id, TrendBucket.bucket, TrendBucket.events).where(TrendBucket.bucket >= first))
+    for media_id, bucket, events in rows:
+        if bucket <= current:
+            scores[media_id] = scores.get(media_id, 0) + events * decay[current - bucket]
+
+    return heapq.nlargest(k, ((score, media_id) for media_id, score in scores.items()))
+
+
+# window: the top media of that window
+trending_cache = Cache("trending", ttl=REFRESH_SECONDS)
+
+def get_trending(window, media_type=None, limit=20):
+    """The media trending on MyViews in the window, most first: [(Media, score)]"""
+
+    top = trending_cache.get_or_set(window, lambda: compute_trending(window))
+    medias = {media.media_id: media for media in Media.query.filter(Media.media_id.in_([media_id for score, media_id in top]))}
+
+    trending = [(medias[media_id], score) for score, media_id in top
+                if media_id in medias and (media_type is None or medias[media_id].media_type == media_type)]
+
+    return trending[:limit]